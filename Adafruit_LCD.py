@@ -42,11 +42,31 @@ LCD_5x8DOTS             = 0x00
 # Offset for up to 4 rows.
 LCD_ROW_OFFSETS         = (0x00, 0x40, 0x14, 0x54)
 
+# Execution times from the HD44780 datasheet (270kHz oscillator), with some
+# margin. Clear and home are the only slow commands.
+LCD_EXEC_US             = 50
+LCD_EXEC_LONG_US        = 2000
+
+# Number of cells service() writes per call by default.
+LCD_SERVICE_CELLS       = 4
+
 class CharLCD(object):
     def __init__(self, rs, en, d4, d5, d6, d7, cols, lines):
         # Save column and line state.
         self._cols = cols
         self._lines = lines
+        # Shadow copy of the display RAM and the text update() wants on it,
+        # service() writes the difference. The controller is always set up in
+        # 2 line mode, so keep at least 2 rows around.
+        self._rows = max(lines, 2)
+        self._shadow = bytearray(b' ' * (cols * self._rows))
+        self._target = bytearray(self._shadow)
+        self._cursor = -1    # shadow index the address counter points at, -1 if unknown
+        self._dirty = False
+        # Time at which the controller will be done with the last command.
+        self._ready_at = time.ticks_us()
+        # Total time spent writing to the display (including waits).
+        self.io_us = 0
         # Setup all pins as outputs.
         self._rs = Pin(rs, mode=Pin.OUT, pull=Pin.PULL_DOWN, value=0)
         self._en = Pin(en, mode=Pin.OUT, pull=Pin.PULL_DOWN, value=0)
@@ -55,9 +75,17 @@ class CharLCD(object):
         self._d6 = Pin(d6, mode=Pin.OUT, pull=Pin.PULL_DOWN, value=0)
         self._d7 = Pin(d7, mode=Pin.OUT, pull=Pin.PULL_DOWN, value=0)
   
-        # Initialize the display.
-        self.write8(0x33)
-        self.write8(0x32)
+        # Initialize the display (4-bit mode by instruction, see figure 24 of
+        # the datasheet).
+        self._delay_microseconds(50000)
+        self._write4(0x3)
+        self._delay_microseconds(5000)
+        self._write4(0x3)
+        self._delay_microseconds(1000)
+        self._write4(0x3)
+        self._delay_microseconds(1000)
+        self._write4(0x2)
+        self._delay_microseconds(1000)
         # Initialize display control, function, and mode registers.
         self.displaycontrol = LCD_DISPLAYON | LCD_CURSOROFF | LCD_BLINKOFF
         self.displayfunction = LCD_4BITMODE | LCD_1LINE | LCD_2LINE | LCD_5x8DOTS
@@ -70,13 +98,15 @@ class CharLCD(object):
 
     def home(self):
         """Move the cursor back to its home (first line and first column)."""
-        self.write8(LCD_RETURNHOME)  # set cursor position to zero
-        self._delay_microseconds(10000)  # this command takes a long time!
+        self.write8(LCD_RETURNHOME)  # set cursor position to zero, this command takes a long time!
 
     def clear(self):
         """Clear the LCD."""
-        self.write8(LCD_CLEARDISPLAY)  # command to clear display
-        self._delay_microseconds(10000)  # 3000 microsecond sleep, clearing the display takes a long time
+        self.write8(LCD_CLEARDISPLAY)  # command to clear display, this takes a long time as well
+        for i in range(len(self._shadow)):
+            self._shadow[i] = 0x20
+            self._target[i] = 0x20
+        self._dirty = False
 
     def set_cursor(self, col, row):
         """Move the cursor to an explicit column and row position."""
@@ -152,28 +182,103 @@ class CharLCD(object):
             # Write the character to the display.
             else:
                 self.write8(ord(char), True)
+        # What is on the display is unknown to us from here on, so the next
+        # update() redraws everything.
+        for i in range(len(self._shadow)):
+            self._shadow[i] = 0xFF
+            self._target[i] = 0xFF
+        self._cursor = -1
+        self._dirty = False
+
+    def update(self, text):
+        """Set the text to show on the display. Text can include newlines and
+        every line is padded with spaces to the full width. Nothing is written
+        here, service() or flush() send the cells that differ from what is
+        already on the display. Unlike message() this doesn't need a clear()
+        first, and is always written left to right.
+        """
+        cols = self._cols
+        target = self._target
+        index = 0
+        end = cols
+        for char in text:
+            if char == '\n':
+                while index < end:
+                    target[index] = 0x20
+                    index += 1
+                end += cols
+                if index >= len(target):
+                    break
+            elif index < end:
+                # Characters beyond the last column are dropped.
+                target[index] = ord(char)
+                index += 1
+        # Blank out the rest of the display.
+        while index < len(target):
+            target[index] = 0x20
+            index += 1
+        self._dirty = True
+
+    def service(self, max_cells=LCD_SERVICE_CELLS):
+        """Write up to max_cells changed cells to the display. Meant to be
+        called from the main loop, returns without writing anything while the
+        controller is still busy with a slow command. Returns True if the
+        display is up to date.
+        """
+        if not self._dirty:
+            return True
+        if time.ticks_diff(self._ready_at, time.ticks_us()) > 0:
+            return False
+        cols = self._cols
+        shadow = self._shadow
+        target = self._target
+        for index in range(len(target)):
+            value = target[index]
+            if shadow[index] == value:
+                continue
+            if max_cells <= 0:
+                return False
+            max_cells -= 1
+            if self._cursor != index or not self.displaymode & LCD_ENTRYLEFT:
+                self.write8(LCD_SETDDRAMADDR | (index % cols + LCD_ROW_OFFSETS[index // cols]))
+            self.write8(value, True)
+            shadow[index] = value
+            # The address counter auto increments after each data write.
+            self._cursor = index + 1 if (index + 1) % cols else -1
+        self._dirty = False
+        return True
+
+    def flush(self):
+        """Write all pending update() changes to the display."""
+        while not self.service(len(self._target)):
+            pass
 
     def write8(self, value, char_mode=False):
         """Write 8-bit value in character or data mode.  Value should be an int
         value from 0-255, and char_mode is True if character data or False if
         non-character data (default).
         """
-        # One millisecond delay to prevent writing too quickly.
-        time.sleep_us(1000)
+        start = time.ticks_us()
+        # Wait for the previous command to complete, this is usually over
+        # by the time we get here.
+        while time.ticks_diff(self._ready_at, time.ticks_us()) > 0:
+            pass
         # Set character / data bit.
         self._rs(char_mode)
         # Write upper 4 bits.
-        self._d4((value >> 4) & 1)
-        self._d5((value >> 5) & 1)
-        self._d6((value >> 6) & 1)
-        self._d7((value >> 7) & 1)
-        self._pulse_enable()
+        self._write4(value >> 4)
         # Write lower 4 bits.
-        self._d4(value        & 1)
-        self._d5((value >> 1) & 1)
-        self._d6((value >> 2) & 1)
-        self._d7((value >> 3) & 1)
-        self._pulse_enable()
+        self._write4(value)
+        now = time.ticks_us()
+        if not char_mode:
+            self._cursor = -1
+            if value == LCD_CLEARDISPLAY or value == LCD_RETURNHOME:
+                self._ready_at = time.ticks_add(now, LCD_EXEC_LONG_US)
+            else:
+                self._ready_at = time.ticks_add(now, LCD_EXEC_US)
+        else:
+            self._ready_at = time.ticks_add(now, LCD_EXEC_US)
+        self.io_us += time.ticks_diff(now, start)
 
     def create_char(self, location, pattern):
           # only position 0..7 are allowed
@@ -185,11 +290,16 @@ class CharLCD(object):
     def _delay_microseconds(self, microseconds):
         time.sleep_ms(microseconds // 1000)
 
+    def _write4(self, value):
+        self._d4(value        & 1)
+        self._d5((value >> 1) & 1)
+        self._d6((value >> 2) & 1)
+        self._d7((value >> 3) & 1)
+        self._pulse_enable()
+
     def _pulse_enable(self):
-        # Pulse the clock enable line off, on, off to send command.
-        self._en(0)
-        time.sleep_us(5)
+        # Pulse the clock enable line on, off to send the nibble. The enable
+        # pulse only needs to be 450ns wide, data is latched on the falling edge.
         self._en(1)
-        time.sleep_us(5)
+        time.sleep_us(1)
         self._en(0)
-        time.sleep_us(50)
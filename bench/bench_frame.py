@@ -0,0 +1,70 @@
+# Host side benchmark of the LoRa telemetry frames: compares the legacy JSON
+# payload against frame.encode_uplink() in size, encode/decode time and
+# estimated time on air for every spreading factor.
+#
+#   $ python3 bench/bench_frame.py [iterations]
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import frame
+from frame import airtime_ms
+
+
+def json_encode(bike_id, status, crank, distance, speed):
+    return json.dumps({'id': str(bike_id), 'cr': crank, 'ds': distance, 'sp': speed,
+                       'st': frame.STATUS_CODES[status]}).encode('ascii')
+
+
+def json_decode(data):
+    parsed_json = json.loads(data.decode('ascii'))
+    return (parsed_json['id'], parsed_json['st'], parsed_json['cr'],
+            parsed_json['ds'], parsed_json['sp'])
+
+
+def timeit(fn, args, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn(*args)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    sample = (12, frame.STATUS_RUNNING, 1234, 312, 17)
+
+    json_packet = json_encode(*sample)
+    bin_packet = bytes(frame.encode_uplink(*sample))
+    # a frame carrying the crank samples of a whole 2.5s uplink period
+    samples = [(age, 1234 - age // 250) for age in (2000, 1500, 1000, 500)]
+    batch_packet = bytes(frame.encode_uplink(*(sample + (samples,))))
+    assert frame.decode_uplink(bin_packet)[:5] == sample
+    assert frame.decode_uplink(batch_packet)[:6] == sample + (samples,)
+    assert frame.decode_uplink(json_packet)[:5] == sample
+
+    print('{:<8} {:>6} {:>12} {:>12}'.format('format', 'bytes', 'encode us', 'decode us'))
+    print('{:<8} {:>6} {:>12.2f} {:>12.2f}'.format(
+        'json', len(json_packet), timeit(json_encode, sample, iterations),
+        timeit(json_decode, (json_packet,), iterations)))
+    print('{:<8} {:>6} {:>12.2f} {:>12.2f}'.format(
+        'binary', len(bin_packet), timeit(frame.encode_uplink, sample, iterations),
+        timeit(frame.decode_uplink, (bin_packet,), iterations)))
+    print('{:<8} {:>6} {:>12.2f} {:>12.2f}'.format(
+        'batched', len(batch_packet), timeit(frame.encode_uplink, sample + (samples,), iterations),
+        timeit(frame.decode_uplink, (batch_packet,), iterations)))
+
+    print()
+    print('{:<4} {:>12} {:>12} {:>8} {:>12}'.format('SF', 'json ms', 'binary ms', 'ratio', 'batched ms'))
+    for sf in range(7, 13):
+        t_json = airtime_ms(len(json_packet), sf)
+        t_bin = airtime_ms(len(bin_packet), sf)
+        t_batch = airtime_ms(len(batch_packet), sf)
+        print('{:<4} {:>12.1f} {:>12.1f} {:>8.2f} {:>12.1f}'.format(sf, t_json, t_bin, t_json / t_bin, t_batch))
+
+
+if __name__ == '__main__':
+    main()
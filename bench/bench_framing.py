@@ -0,0 +1,128 @@
+# Fuzz and benchmark harness for framing.LineFramer. A stream of gateway
+# records is cut at random points (single bytes up to several records
+# coalesced together) and fed through the framer, which must give back
+# every record exactly once. The naive recv() + splitlines() approach the
+# server used to have is run over the same stream for comparison.
+#
+#   $ python3 bench/bench_framing.py [records] [seed]
+
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from framing import LineFramer
+
+
+def make_records(count, rnd):
+    records = []
+    for i in range(count):
+        record = {"RiderName": "Rider " + str(rnd.randrange(1000)), "Company": "ACME",
+                  "BadgeNumber": rnd.randrange(100000), "EventID": "event-1",
+                  "RideTimestamp": '{:f}'.format(1500000000 + i), "BikeID": rnd.randrange(1, 40),
+                  "RideStatus": "counting",
+                  "RideInfo": [{"CounterTimestamp": float(i * 100), "CrankCounter": i,
+                                "WheelCounter": i * 7}]}
+        records.append(json.dumps(record).encode('ascii'))
+    return records
+
+
+def fragment(stream, rnd, max_chunk):
+    chunks = []
+    pos = 0
+    while pos < len(stream):
+        # mostly small fragments, now and then a big coalesced read
+        if rnd.random() < 0.1:
+            size = rnd.randint(1, max_chunk)
+        else:
+            size = rnd.randint(1, 64)
+        chunks.append(stream[pos:pos + size])
+        pos += size
+    return chunks
+
+
+class ChunkSocket:
+    """Plays back chunks through recv_into(), like a non-blocking socket."""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._index = 0
+        self._rest = b''
+
+    def recv_into(self, buf):
+        if not self._rest:
+            if self._index == len(self._chunks):
+                return 0
+            self._rest = self._chunks[self._index]
+            self._index += 1
+        n = min(len(buf), len(self._rest))
+        buf[:n] = self._rest[:n]
+        self._rest = self._rest[n:]
+        return n
+
+
+def run_framer(chunks, size):
+    framer = LineFramer(size)
+    sock = ChunkSocket(chunks)
+    out = []
+    while framer.recv_into(sock):
+        for record in framer.records():
+            out.append(bytes(record))
+    return out, framer
+
+
+def run_splitlines(chunks):
+    out = []
+    errors = 0
+    for chunk in chunks:
+        for line in chunk.decode('ascii').splitlines():
+            try:
+                json.loads(line)
+                out.append(line)
+            except ValueError:
+                errors += 1
+    return out, errors
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    rnd = random.Random(seed)
+    records = make_records(count, rnd)
+    stream = b'\n'.join(records) + b'\n'
+    chunks = fragment(stream, rnd, 8192)
+    print('{} records, {} bytes in {} reads'.format(count, len(stream), len(chunks)))
+
+    start = time.perf_counter()
+    out, framer = run_framer(chunks, 4096)
+    elapsed = time.perf_counter() - start
+    assert out == records, 'framer lost or corrupted records'
+    assert framer.overflows == 0 and framer.pending() == 0
+    print('framer:     {:>10.0f} records/s, {:.1f} MB/s, all records intact'.format(
+        count / elapsed, len(stream) / elapsed / 1e6))
+
+    start = time.perf_counter()
+    out, errors = run_splitlines(chunks)
+    elapsed = time.perf_counter() - start
+    print('splitlines: {:>10.0f} records/s, {} of {} records lost, {} unparseable fragments'.format(
+        len(out) / elapsed, count - len(out), count, errors))
+
+    # oversized records are dropped without losing the following ones
+    framer = LineFramer(64)
+    stream = b'x' * 200 + b'\nok\n' + b'y' * 70 + b'\nok2\n'
+    out = []
+    for chunk in fragment(stream, rnd, 100):
+        chunk = memoryview(chunk)
+        while len(chunk):
+            n = framer.feed(chunk)
+            chunk = chunk[n:]
+            out.extend(bytes(r) for r in framer.records())
+    assert out == [b'ok', b'ok2'] and framer.overflows == 2, out
+    print('oversized records dropped: {}'.format(framer.overflows))
+
+
+if __name__ == '__main__':
+    main()
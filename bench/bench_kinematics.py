@@ -0,0 +1,137 @@
+# Host side benchmark of the bike's per tick ride maths: the float maths
+# Rider.ride() used to do against the integer maths of kinematics.py. For
+# every simulated tick it measures the memory allocated, with the debug
+# output on and off, the time taken and how far the integer results are
+# from the float ones.
+#
+#   $ python3 bench/bench_kinematics.py [ticks]
+#
+# On CPython allocations are measured with tracemalloc (peak bytes per tick).
+# CPython's free list of floats is drained before every tick so that floats
+# show up, but CPython boxes every int above 256 where MicroPython only does
+# so above 2**30, so the integer numbers are on the high side. Under the
+# MicroPython unix port gc.mem_alloc() is used instead, which sees the heap
+# the way the LoPy does.
+
+import gc
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import kinematics
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+DISTANCE_TARGET = 500
+DISTANCE_PER_REVOLUTION = 2.1362
+SPEED_WINDOW_MS = 5000
+TICK_MS = 1000
+FLOAT_FREE_LIST = 200      # more than CPython keeps
+
+
+def float_tick(counter, now_ms, starttime, pulses, span_ms, verbose):
+    # Rider.ride() before kinematics.py, starttime in seconds
+    wheel_counter_local_calc = (counter // 2) * 2.8
+    calc_current_timestamp = now_ms / 1000
+    distance_travelled = (wheel_counter_local_calc * DISTANCE_PER_REVOLUTION) * 2.2237
+    speed = (distance_travelled / (calc_current_timestamp - starttime))
+    distance_remaining = DISTANCE_TARGET - distance_travelled
+    live_speed = (pulses / 2 * 2.8 * DISTANCE_PER_REVOLUTION * 2.2237) / (span_ms / 1000)
+    if verbose:
+        msg = ("Wheel Counter: " + str(wheel_counter_local_calc) + " | Average Speed (miles per hour): " + str(speed) +
+               " | Speed (miles per hour): " + str(live_speed) + " | Distance Remaining (meters): " + str(distance_remaining))
+    text = "MPH:" + str(int(live_speed)) + "\nMtrs:" + str(int(distance_remaining))
+    return int(speed), int(live_speed), int(distance_remaining)
+
+
+def int_tick(counter, now_ms, starttime, pulses, span_ms, verbose):
+    # Rider.ride() with kinematics.py, starttime in ms
+    distance_travelled = kinematics.distance_mm(counter)
+    distance_remaining = kinematics.metres(DISTANCE_TARGET * 1000 - distance_travelled)
+    speed = kinematics.speed(distance_travelled, now_ms - starttime)
+    live_speed = kinematics.window_speed(pulses, span_ms)
+    if verbose:
+        msg = ("Crank Counter: " + str(counter) + " | Average Speed (miles per hour): " + str(speed) +
+               " | Speed (miles per hour): " + str(live_speed) + " | Distance Remaining (meters): " + str(distance_remaining))
+    text = "MPH:" + str(live_speed) + "\nMtrs:" + str(distance_remaining)
+    return speed, live_speed, distance_remaining
+
+
+def ride(ticks):
+    # (counter, now_ms, pulses in the speed window) once a second, pedalling
+    # at 60 to 100 rpm, two pulses per revolution
+    out = []
+    counter = 0
+    for i in range(1, ticks + 1):
+        rpm = 60 + (i * 7) % 41
+        pulses = rpm * 2 * SPEED_WINDOW_MS // 60000
+        counter += rpm * 2 // 60
+        out.append((counter, i * TICK_MS, pulses))
+    return out
+
+
+def measure(tick, samples, starttime, verbose):
+    per_tick = []
+    if tracemalloc:
+        tracemalloc.start()
+        for counter, now_ms, pulses in samples:
+            # keep enough floats alive to empty the free list
+            hold = [i + 0.5 for i in range(FLOAT_FREE_LIST)]
+            base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            tick(counter, now_ms, starttime, pulses, SPEED_WINDOW_MS, verbose)
+            per_tick.append(tracemalloc.get_traced_memory()[1] - base)
+            del hold
+        tracemalloc.stop()
+    else:
+        gc.collect()
+        gc.disable()
+        for counter, now_ms, pulses in samples:
+            before = gc.mem_alloc()
+            tick(counter, now_ms, starttime, pulses, SPEED_WINDOW_MS, verbose)
+            per_tick.append(gc.mem_alloc() - before)
+            gc.collect()
+        gc.enable()
+    return sum(per_tick) / len(per_tick), max(per_tick)
+
+
+def timed(tick, samples, starttime):
+    t0 = time.perf_counter() if hasattr(time, 'perf_counter') else time.time()
+    for counter, now_ms, pulses in samples:
+        tick(counter, now_ms, starttime, pulses, SPEED_WINDOW_MS, False)
+    t1 = time.perf_counter() if hasattr(time, 'perf_counter') else time.time()
+    return (t1 - t0) * 1e6 / len(samples)
+
+
+def main():
+    ticks = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    samples = ride(ticks)
+    unit = 'peak bytes' if tracemalloc else 'bytes'
+    print('{} ticks, allocations measured with {}'.format(
+        ticks, 'tracemalloc' if tracemalloc else 'gc.mem_alloc()'))
+    print('{:<8} {:>6} {:>22} {:>22} {:>10}'.format(
+        'maths', 'debug', 'mean ' + unit + '/tick', 'max ' + unit + '/tick', 'us/tick'))
+    for name, tick, starttime in (('float', float_tick, 0.0), ('integer', int_tick, 0)):
+        us = timed(tick, samples, starttime)
+        for verbose in (True, False):
+            mean, peak = measure(tick, samples, starttime, verbose)
+            print('{:<8} {:>6} {:>22.1f} {:>22} {:>10.2f}'.format(
+                name, 'on' if verbose else 'off', mean, peak, us))
+
+    # MM_PER_REVOLUTION is rounded to the mm and integer division truncates
+    worst = [0, 0, 0]
+    for counter, now_ms, pulses in samples:
+        a = float_tick(counter, now_ms, 0.0, pulses, SPEED_WINDOW_MS, False)
+        b = int_tick(counter, now_ms, 0, pulses, SPEED_WINDOW_MS, False)
+        for i in range(3):
+            worst[i] = max(worst[i], abs(a[i] - b[i]))
+    print('largest difference from the float maths: speed {} live speed {} distance {}m'.format(*worst))
+
+
+if __name__ == '__main__':
+    main()
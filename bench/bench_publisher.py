@@ -0,0 +1,84 @@
+# Benchmark of publisher.Publisher against a local MQTT stand-in with a
+# configurable broker round trip and periodic stalls. Records arrive at a
+# fixed rate and the enqueue-to-publish latency is reported, next to
+# publishing synchronously from the ingest loop like server.py used to.
+#
+#   $ python3 bench/bench_publisher.py [records] [rate] [broker_ms] [stall_every]
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from publisher import Publisher, percentile
+from sim.mqtt import NullClient
+
+
+def make_payloads(count):
+    return [json.dumps({"BikeID": i % 30, "RideStatus": "counting", "RideTimestamp": 1500000000.0,
+                        "RideInfo": [{"CrankCounter": i}]}) for i in range(count)]
+
+
+def pace(start, index, rate):
+    # records arrive from the gateways at a steady rate
+    arrival = start + index / rate
+    delay = arrival - time.perf_counter()
+    if delay > 0:
+        time.sleep(delay)
+    return arrival
+
+
+def report(name, total_s, count, blocked, latencies):
+    # blocked: time the ingest loop spent handing each record over
+    print('{:<12} {:>6.0f} rec/s   ingest blocked p99 {:>7.3f} ms max {:>7.2f} ms   '
+          'latency p50 {:>7.2f} ms p99 {:>7.2f} ms'.format(
+              name, count / total_s, percentile(blocked, 99) * 1000, max(blocked) * 1000,
+              percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    broker_ms = float(sys.argv[3]) if len(sys.argv) > 3 else 0.2
+    stall_every = int(sys.argv[4]) if len(sys.argv) > 4 else 500
+    payloads = make_payloads(count)
+    print('{} records at {:.0f} rec/s, broker round trip {} ms, 50 ms stall every {} messages'.format(
+        count, rate, broker_ms, stall_every))
+
+    # publishing from the ingest loop, a stall delays every record behind it
+    client = NullClient(broker_ms, stall_every)
+    latencies = []
+    blocked = []
+    start = time.perf_counter()
+    for i, payload in enumerate(payloads):
+        arrival = pace(start, i, rate)
+        t = time.perf_counter()
+        client.publish("my/topic", payload)
+        done = time.perf_counter()
+        blocked.append(done - t)
+        latencies.append(done - arrival)
+    report('synchronous', time.perf_counter() - start, count, blocked, latencies)
+
+    for coalesce in (False, True):
+        client = NullClient(broker_ms, stall_every)
+        publisher = Publisher(client, coalesce_topics=["my/topic"] if coalesce else ())
+        publisher.start()
+        blocked = []
+        start = time.perf_counter()
+        for i, payload in enumerate(payloads):
+            pace(start, i, rate)
+            t = time.perf_counter()
+            publisher.publish("my/topic", payload, key=i % 30)
+            blocked.append(time.perf_counter() - t)
+        publisher.stop()
+        stats = publisher.stats()
+        report('coalesced' if coalesce else 'pipelined', time.perf_counter() - start, count,
+               blocked, list(publisher.latencies))
+        print('{:<12} {} broker messages, {} coalesced, queue high water {}'.format(
+            '', client.published, stats["Coalesced"], stats["HighWater"]))
+
+
+if __name__ == '__main__':
+    main()
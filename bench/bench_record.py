@@ -0,0 +1,90 @@
+# Host side benchmark of the ride records the gateway forwards for every
+# LoRa packet: a dict run through json.dumps(), as the gateway used to do,
+# against the prefix and RecordWriter of record.py. Both must produce the
+# same bytes.
+#
+#   $ python3 bench/bench_record.py [iterations] [samples per packet]
+
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from record import RecordWriter, record_prefix, STATUS_BYTES
+
+RIDER = ("Rider 17", "ACME", 12345, "event-1", 1500000000.5, 7)
+
+
+def packet(i, count):
+    # (tx_ms, crank, [(sample timestamp, sample crank)])
+    tx_ms = 100000 + i * 2500
+    crank = i * 10
+    return tx_ms, crank, [(tx_ms - 500 * (count - n), crank - (count - n)) for n in range(count)]
+
+
+def dumps_record(tx_ms, crank, samples):
+    name, company, badge, eventid, ridetimestamp, bike_id = RIDER
+    ride_info = []
+    for sample_ms, sample_crank in samples:
+        ride_info.append({"CounterTimestamp": float(sample_ms),
+                          "CrankCounter": sample_crank, "WheelCounter": sample_crank * 7})
+    ride_info.append({"CounterTimestamp": float(tx_ms),
+                      "CrankCounter": crank, "WheelCounter": crank * 7})
+    json_d = {"RiderName": name, "Company": company, "BadgeNumber": badge,
+              "EventID": eventid, "RideTimestamp": '{:f}'.format(ridetimestamp), "BikeID": bike_id,
+              "RideStatus": "counting", "RideInfo": ride_info}
+    return (json.dumps(json_d) + "\n").encode()
+
+
+def make_writer_record():
+    prefix = record_prefix(*RIDER)
+    writer = RecordWriter()
+    status = STATUS_BYTES['counting']
+
+    def writer_record(tx_ms, crank, samples):
+        writer.begin(prefix, status)
+        for sample_ms, sample_crank in samples:
+            writer.add_info(sample_ms, sample_crank, sample_crank * 7)
+        writer.add_info(tx_ms, crank, crank * 7)
+        return writer.end()
+    return writer_record
+
+
+def run(build, packets):
+    t0 = time.perf_counter()
+    for args in packets:
+        build(*args)
+    return (time.perf_counter() - t0) * 1e6 / len(packets)
+
+
+def peak_bytes(build, packets):
+    tracemalloc.start()
+    peaks = []
+    for args in packets[:1000]:
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        build(*args)
+        peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+    return sum(peaks) / len(peaks)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    packets = [packet(i, count) for i in range(iterations)]
+    writer_record = make_writer_record()
+    for args in packets[:100]:
+        assert bytes(writer_record(*args)) == dumps_record(*args)
+
+    print('{} packets, {} samples each'.format(iterations, count))
+    print('{:<14} {:>10} {:>22}'.format('record', 'us/packet', 'peak bytes/packet'))
+    for name, build in (('json.dumps', dumps_record), ('RecordWriter', writer_record)):
+        print('{:<14} {:>10.2f} {:>22.1f}'.format(name, run(build, packets), peak_bytes(build, packets)))
+
+
+if __name__ == '__main__':
+    main()
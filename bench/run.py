@@ -0,0 +1,333 @@
+# Benchmark suite of the ride telemetry hot paths, on the host:
+#
+#   uplink/downlink  frame.py encode and decode, as done by the bikes and
+#                    gateways for every LoRa packet
+#   record           record.RecordWriter, the gateway's ride records
+#   gateway          NanoGateWay.process_lora(), LoRa packet to record
+#   server           server.py ingest: framing, parsing, re-serializing and
+#                    publishing through publisher.Publisher
+#   leaderboard      leaderboard.Leaderboard.update(), a ride's counting and
+#                    finished records with thousands of rides on the board
+#   lcd              Adafruit_LCD.CharLCD message() and update() + flush()
+#                    against the simulated pins of the sim package
+#
+# The gateway and server cases run with JSON records and, as *_binary, with
+# the binary records of wire.py.
+#
+# For every case it reports operations per second, bytes per operation
+# (packet, record or characters written) and the peak memory allocated
+# per operation (tracemalloc). The results are compared against a stored
+# baseline, ops/s with a tolerance as they depend on the machine, bytes and
+# allocations more strictly. The ops/s of the stored baseline are those of
+# the machine it was saved on, save your own before comparing.
+#
+#   $ python3 bench/run.py               # compare against bench/baseline.json
+#   $ python3 bench/run.py --save        # store the results as the baseline
+#   $ python3 bench/run.py --check       # exit with 1 on a regression
+#   $ python3 bench/run.py --only server --only lcd
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import sim
+
+# gateway.py and Adafruit_LCD.py need the machine and network stand-ins
+CLOCK = sim.install(seed=1)
+
+import frame
+import gateway
+import server
+import Adafruit_LCD as LCD
+from leaderboard import Leaderboard
+from merge import RecordMerger
+from publisher import Publisher
+from record import RecordWriter, record_prefix, STATUS_BYTES
+from sim.mqtt import NullClient
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+MIN_TIME_S = 0.1        # per timing run, the best of REPEAT runs counts
+REPEAT = 7
+ALLOC_CALLS = 200
+OPS_TOLERANCE = 0.30    # slower than this fraction of the baseline is a regression
+ALLOC_TOLERANCE = 0.10
+ALLOC_SLACK = 16        # bytes, tracemalloc's own noise
+
+RIDER = ("Rider 17", "ACME", 12345, "event-1", 1500000000.5, 7)
+UPLINK = (7, frame.STATUS_RUNNING, 1234, 312, 17)
+SAMPLES = [(age, 1234 - age // 250) for age in (2000, 1500, 1000, 500)]
+
+
+# Every case returns (operation, operations per call, bytes per operation)
+
+def uplink_encode():
+    args = UPLINK + (SAMPLES,)
+    return (lambda: frame.encode_uplink(*args)), 1, len(frame.encode_uplink(*args))
+
+
+def uplink_decode():
+    packet = bytes(frame.encode_uplink(*(UPLINK + (SAMPLES,))))
+    return (lambda: frame.decode_uplink(packet)), 1, len(packet)
+
+
+def downlink_encode():
+    args = (frame.CMD_START, 7, 1234, 3, 25, 100, 42)
+    return (lambda: frame.encode_downlink(*args)), 1, len(frame.encode_downlink(*args))
+
+
+def downlink_decode():
+    packet = bytes(frame.encode_downlink(frame.CMD_START, 7, 1234, 3, 25, 100, 42))
+    return (lambda: frame.decode_downlink(packet)), 1, len(packet)
+
+
+def record_assembly():
+    prefix = record_prefix(*RIDER)
+    writer = RecordWriter()
+    status = STATUS_BYTES['counting']
+
+    def build():
+        writer.begin(prefix, status)
+        for age, crank in SAMPLES:
+            writer.add_info(100000 - age, crank, crank * 7)
+        writer.add_info(100000, 1234, 1234 * 7)
+        return writer.end()
+    return build, 1, len(build())
+
+
+def make_gateway(binary, sent):
+    # what the gateway sends to the server is passed to sent()
+    gateway.BACKLOG_SPILL_PATH = None
+    g = gateway.NanoGateWay()
+    g.new_rider(*RIDER[:3] + (RIDER[5], RIDER[3], RIDER[4]))
+    g.send = sent
+    if binary:
+        # connected to a server that accepted binary records, which are
+        # written straight to the socket
+        g.binary = True
+        g.can_write = lambda: True
+        g.write = lambda data: sent(data) or len(data)
+    return g
+
+
+def gateway_lora(binary=False):
+    sent = []
+    g = make_gateway(binary, sent.append)
+    packet = bytes(frame.encode_uplink(*(UPLINK + (SAMPLES,))))
+
+    def process():
+        del sent[:]
+        g.process_lora(packet, 100000)
+    process()
+    # the ride definition goes out with the first binary record only
+    process()
+    return process, 1, len(sent[0])
+
+
+def server_ingest(binary=False):
+    # every record published, no coalescing
+    ingest = server.IngestServer(0, coalesce_window_s=0)
+    ingest.publisher = Publisher(NullClient())
+    # the same records are ingested over and over, don't drop them as copies
+    ingest.merger = RecordMerger(window_s=0)
+    connection = server.GatewayConnection(None, ('bench', 0))
+    # what a gateway sends, several records per read
+    sent = []
+    g = make_gateway(binary, lambda msg: sent.append(bytes(msg)))
+    packet = bytes(frame.encode_uplink(*(UPLINK + (SAMPLES,))))
+    g.process_lora(packet, 100000)
+    g.process_lora(packet, 100000)
+    if binary:
+        # the ride definition, once per connection
+        connection.rx.feed(sent[0])
+        for frame_ in connection.rx.records():
+            ingest.process_frame(connection, frame_, time.monotonic())
+    record = sent[1]
+    records = 16
+    chunk = record * records
+    framer = connection.rx
+
+    def ingest_chunk():
+        framer.feed(chunk)
+        received = time.monotonic()
+        for line in framer.records():
+            if line[0] & 0x80:
+                ingest.process_frame(connection, line, received)
+            else:
+                ingest.process_record(connection, bytes(line), received)
+        ingest.publisher.flush()
+    return ingest_chunk, records, len(record)
+
+
+def leaderboard_update():
+    board = Leaderboard()
+    rides = [0]
+
+    def ride():
+        rides[0] += 1
+        n = rides[0]
+        board.update('gw', '7', n, 'counting', 'event-1', 'Rider', 'ACME',
+                     (1000, 0), (1500, 1))
+        # the finish report, from the start of the ride to the finish
+        board.update('gw', '7', n, 'finished', 'event-1', 'Rider', 'ACME',
+                     (1000, 0), (31000 + n % 5000, 80))
+    for _ in range(5000):
+        ride()
+    return ride, 2, None
+
+
+LCD_PINS = ('G11', 'G12', 'G15', 'G16', 'G13', 'G28')
+
+
+def make_lcd():
+    lcd = LCD.CharLCD(*(LCD_PINS + (16, 1)))
+    # don't count the controller's execution time, only ours
+    CLOCK.read_cost_us = LCD.LCD_EXEC_LONG_US
+    return lcd
+
+
+def lcd_message():
+    lcd = make_lcd()
+    text = "MPH:17  \nMtrs:312"
+
+    def message():
+        lcd.message(text)
+    return message, 1, len(text) - 1
+
+
+def lcd_update():
+    lcd = make_lcd()
+    texts = ["MPH:{}\nMtrs:{}".format(17 + i % 3, 500 - i) for i in range(50)]
+    state = [0]
+
+    def update():
+        i = state[0] = (state[0] + 1) % len(texts)
+        lcd.update(texts[i])
+        lcd.flush()
+    return update, 1, None
+
+
+CASES = [
+    ('uplink.encode', uplink_encode),
+    ('uplink.decode', uplink_decode),
+    ('downlink.encode', downlink_encode),
+    ('downlink.decode', downlink_decode),
+    ('record.assembly', record_assembly),
+    ('gateway.process_lora', gateway_lora),
+    ('gateway.process_lora_binary', lambda: gateway_lora(True)),
+    ('server.ingest', server_ingest),
+    ('server.ingest_binary', lambda: server_ingest(True)),
+    ('leaderboard.update', leaderboard_update),
+    ('lcd.message', lcd_message),
+    ('lcd.update_flush', lcd_update),
+]
+
+
+def ops_per_s(op, per_call):
+    op()
+    calls = 1
+    # find a number of calls that takes long enough to time
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            op()
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_TIME_S:
+            break
+        calls *= 2
+    best = elapsed
+    for _ in range(REPEAT - 1):
+        start = time.perf_counter()
+        for _ in range(calls):
+            op()
+        best = min(best, time.perf_counter() - start)
+    return calls * per_call / best
+
+
+def alloc_per_op(op, per_call):
+    op()
+    tracemalloc.start()
+    total = 0
+    for _ in range(ALLOC_CALLS):
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        op()
+        total += tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return total / float(ALLOC_CALLS * per_call)
+
+
+def measure(setup):
+    with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+        op, per_call, size = setup()
+        ops = ops_per_s(op, per_call)
+        alloc = alloc_per_op(op, per_call)
+    return {"ops_s": round(ops, 1), "bytes": size, "alloc": round(alloc, 1)}
+
+
+def compare(result, base, tolerance=OPS_TOLERANCE):
+    """Returns the regressions of result against the baseline base."""
+    problems = []
+    if result["ops_s"] < base["ops_s"] * (1 - tolerance):
+        problems.append("slower")
+    if result["alloc"] > base["alloc"] * (1 + ALLOC_TOLERANCE) + ALLOC_SLACK:
+        problems.append("allocates more")
+    if base.get("bytes") is not None and result["bytes"] != base["bytes"]:
+        problems.append("size changed")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the telemetry hot paths.')
+    parser.add_argument('--save', action='store_true', help='store the results as the baseline')
+    parser.add_argument('--check', action='store_true', help='exit with 1 on a regression')
+    parser.add_argument('--only', action='append', help='run the cases starting with this')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--tolerance', type=float, default=OPS_TOLERANCE,
+                        help='ops/s below this fraction of the baseline is a regression')
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = 0
+    print('{:<28} {:>12} {:>8} {:>12} {:>10}  {}'.format(
+        'case', 'ops/s', 'bytes', 'alloc B/op', 'vs base', ''))
+    for name, setup in CASES:
+        if args.only and not any(name.startswith(o) for o in args.only):
+            continue
+        result = results[name] = measure(setup)
+        base = baseline.get(name)
+        change = ''
+        problems = []
+        if base:
+            change = '{:+.0f}%'.format((result["ops_s"] / base["ops_s"] - 1) * 100)
+            problems = compare(result, base, args.tolerance)
+            regressions += bool(problems)
+        print('{:<22} {:>12.0f} {:>8} {:>12.1f} {:>10}  {}'.format(
+            name, result["ops_s"], '-' if result["bytes"] is None else result["bytes"],
+            result["alloc"], change, ', '.join(problems)))
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('Saved to ' + args.baseline)
+    if regressions:
+        print('{} regression(s) against the baseline'.format(regressions))
+        if args.check:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+# Host side simulation of the bike uplinks on one gateway channel, comparing
+# the old randomly delayed periodic uplinks with the TDMA slots of tdma.py.
+# Two uplinks that overlap on air are both lost, and so is anything sent
+# while the gateway transmits a beacon. Reports the delivery ratio against
+# the number of bikes riding at the same time.
+#
+# Every point is the average of several rides with random start times.
+# The uplinks are as large as a bike's frames while riding: the crank
+# samples taken over one TDMA frame (see rider.CrankSampler).
+#
+#   $ python3 bench/sim_tdma.py [duration_s] [trials] [seed]
+
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import sim
+
+sim.install(seed=1)
+
+import frame
+import rider
+import tdma
+from frame import airtime_ms
+
+SF = 7
+SAMPLES_PER_UPLINK = min(tdma.FRAME_MS // rider.SAMPLE_PERIOD_MS, rider.MAX_SAMPLES)
+UPLINK_SIZE = len(frame.encode_uplink(
+    12, frame.STATUS_RUNNING, 1234, 312, 17,
+    [(age, 1234 - i) for i, age in enumerate(range(
+        SAMPLES_PER_UPLINK * rider.SAMPLE_PERIOD_MS, 0, -rider.SAMPLE_PERIOD_MS))]))
+UPLINK_MS = airtime_ms(UPLINK_SIZE, SF)
+DOWNLINK_MS = airtime_ms(frame.DOWNLINK_SIZE, SF)
+LORA_SEND_PERIOD_MS = 2500
+CLOCK_PPM = 50          # worst case crystal error of a bike
+SYNC_JITTER_MS = 3      # error of a bike's frame start estimate on sync
+WAKEUP_JITTER_MS = 5    # how late the bike's main loop gets to transmit
+BEACON_LOSS = 0.05
+
+
+def legacy_uplinks(rnd, duration_ms):
+    # rider.main() before TDMA: a 1 second loop, sending once the random
+    # start delay is over and LORA_SEND_PERIOD_MS has passed
+    start = rnd.uniform(0, 30000)
+    start_delay = (rnd.randrange(30)) * 100
+    last_sent = start
+    uplinks = []
+    t = start
+    while t < duration_ms:
+        if t - start >= start_delay and t > last_sent + LORA_SEND_PERIOD_MS:
+            last_sent = t
+            uplinks.append(t)
+        t += 1000 + rnd.uniform(0, WAKEUP_JITTER_MS)
+    return uplinks
+
+
+def tdma_uplinks(rnd, slot, duration_ms):
+    # the bike's clock runs at (1 + drift) and is resynced by every beacon
+    drift = rnd.uniform(-CLOCK_PPM, CLOCK_PPM) * 1e-6
+    frame_ms = tdma.FRAME_MS
+    error = rnd.uniform(-SYNC_JITTER_MS, SYNC_JITTER_MS)
+    synced_at = 0
+    uplinks = []
+    n = rnd.randrange(12)   # joins a few frames in
+    while True:
+        frame_start = n * frame_ms
+        if frame_start >= duration_ms:
+            return uplinks
+        if frame_start - synced_at >= tdma.BEACON_PERIOD_MS:
+            synced_at = frame_start
+            if rnd.random() > BEACON_LOSS:
+                error = rnd.uniform(-SYNC_JITTER_MS, SYNC_JITTER_MS)
+        scheduled = slot * tdma.SLOT_MS + tdma.GUARD_MS + rnd.uniform(0, WAKEUP_JITTER_MS)
+        elapsed = frame_start + scheduled - synced_at
+        uplinks.append(frame_start + scheduled + error + elapsed * drift)
+        n += 1
+
+
+def beacons(duration_ms):
+    return [t for t in range(0, duration_ms, tdma.BEACON_PERIOD_MS)]
+
+
+def delivered(uplinks, busy):
+    # uplinks: start times of the bike transmissions, busy: start times of
+    # the gateway's own transmissions, during which it can't receive
+    events = sorted([(t, t + UPLINK_MS, True) for t in uplinks] +
+                    [(t, t + DOWNLINK_MS, False) for t in busy])
+    lost = [False] * len(events)
+    last = None     # the event ending last so far
+    for i, (start, end, _) in enumerate(events):
+        if last is not None and start < events[last][1]:
+            lost[i] = lost[last] = True
+        if last is None or end > events[last][1]:
+            last = i
+    return sum(1 for i, event in enumerate(events) if event[2] and not lost[i])
+
+
+def simulate(bikes, duration_ms, rnd):
+    legacy = []
+    for _ in range(bikes):
+        legacy.extend(legacy_uplinks(rnd, duration_ms))
+
+    scheduled = []
+    for bike in range(1, bikes + 1):
+        # same order as tdma.SlotAllocator, slot 0 is the gateway's
+        if bike < tdma.SLOT_COUNT:
+            scheduled.extend(tdma_uplinks(rnd, bike, duration_ms))
+        else:
+            # out of slots, the bike falls back to the old behaviour
+            scheduled.extend(legacy_uplinks(rnd, duration_ms))
+
+    return (delivered(legacy, []) / float(len(legacy)),
+            delivered(scheduled, beacons(duration_ms)) / float(len(scheduled)))
+
+
+def main():
+    duration_ms = int(float(sys.argv[1]) * 1000) if len(sys.argv) > 1 else 300000
+    trials = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    rnd = random.Random(int(sys.argv[3]) if len(sys.argv) > 3 else 1)
+    print('SF{}, uplink of {} bytes ({} samples) {} ms on air, {} slots of {} ms, {:.0f} s simulated'.format(
+        SF, UPLINK_SIZE, SAMPLES_PER_UPLINK, UPLINK_MS, tdma.SLOT_COUNT - 1, tdma.SLOT_MS,
+        duration_ms / 1000.0))
+    print('{:>6} {:>10} {:>10}'.format('bikes', 'random', 'tdma'))
+    for bikes in (1, 2, 4, 8, 12, 16, 20, 24, 28, 32, 40):
+        legacy = scheduled = 0.0
+        for _ in range(trials):
+            result = simulate(bikes, duration_ms, rnd)
+            legacy += result[0] / trials
+            scheduled += result[1] / trials
+        print('{:>6} {:>9.1f}% {:>9.1f}%'.format(bikes, legacy * 100, scheduled * 100))
+
+
+if __name__ == '__main__':
+    main()
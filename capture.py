@@ -0,0 +1,159 @@
+import mmap
+import struct
+import threading
+import time
+
+# Capture of what the server receives, for replaying it later (replay.py):
+# the raw TCP stream of every gateway connection and the commands from the
+# dashboard. A capture is two files, the records and their index:
+#
+#   capture    "RIDECAP1", then one record after another:
+#                time   ms since the start of the capture (4 bytes)
+#                stream connection number, 0 for the dashboard (2 bytes)
+#                kind   OPEN, DATA, CLOSE or COMMAND (1 byte)
+#                length of the data that follows (4 bytes)
+#              OPEN's data is the gateway's address, DATA's what was read
+#              from the socket, COMMAND's the MQTT payload.
+#   .idx       (time, file offset) of the first record of every
+#              INDEX_PERIOD_MS (4 + 8 bytes), read through mmap to seek
+#
+# All fields are little endian.
+
+MAGIC = b'RIDECAP1'
+OPEN = 1
+DATA = 2
+CLOSE = 3
+COMMAND = 4
+
+INDEX_PERIOD_MS = 1000
+BUFFER_SIZE = 65536
+
+_RECORD = struct.Struct('<IHBI')
+_INDEX = struct.Struct('<IQ')
+
+
+def index_path(path):
+    return path + '.idx'
+
+
+class CaptureWriter:
+    """Appends records to a new capture. Thread safe, the commands are
+    captured from the MQTT thread."""
+
+    def __init__(self, path, clock=time.monotonic):
+        self.clock = clock
+        self.start = clock()
+        self._lock = threading.Lock()
+        self._file = open(path, 'wb', BUFFER_SIZE)
+        self._index = open(index_path(path), 'wb')
+        self._file.write(MAGIC)
+        self._offset = len(MAGIC)
+        self._next_index_ms = 0
+        self._streams = 0
+        self.records = 0
+
+    def open(self, addr):
+        """A new gateway connection, returns its stream number."""
+        with self._lock:
+            self._streams += 1
+            stream = self._streams
+        self._write(stream, OPEN, '{}:{}'.format(*addr).encode())
+        return stream
+
+    def data(self, stream, data):
+        self._write(stream, DATA, data)
+
+    def close(self, stream):
+        self._write(stream, CLOSE, b'')
+
+    def command(self, payload):
+        self._write(0, COMMAND, payload)
+
+    def _write(self, stream, kind, data):
+        with self._lock:
+            if self._file is None:
+                return
+            ms = int((self.clock() - self.start) * 1000)
+            if ms >= self._next_index_ms:
+                self._index.write(_INDEX.pack(ms, self._offset))
+                self._next_index_ms = ms - ms % INDEX_PERIOD_MS + INDEX_PERIOD_MS
+            self._file.write(_RECORD.pack(ms, stream, kind, len(data)))
+            self._file.write(data)
+            self._offset += _RECORD.size + len(data)
+            self.records += 1
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                self._index.flush()
+
+    def close_file(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._index.close()
+                self._file = self._index = None
+
+    def stats(self):
+        return {"Records": self.records, "Bytes": self._offset}
+
+
+class CaptureReader:
+    """A capture mapped into memory. The data of the records it yields are
+    memoryviews of the mapping, valid until close()."""
+
+    def __init__(self, path):
+        self._f = open(path, 'rb')
+        self._map = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mv = memoryview(self._map)
+        if self._mv[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError('not a capture: ' + path)
+        try:
+            self._index_f = open(index_path(path), 'rb')
+            self._index_map = mmap.mmap(self._index_f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # no index, or an empty one: seeking starts from the beginning
+            self._index_f = self._index_map = None
+
+    def seek(self, ms):
+        """File offset of the first indexed record at or before ms."""
+        index = self._index_map
+        if index is None:
+            return len(MAGIC)
+        low, high = 0, len(index) // _INDEX.size
+        offset = len(MAGIC)
+        # the last entry not after ms
+        while low < high:
+            mid = (low + high) // 2
+            entry_ms, entry_offset = _INDEX.unpack_from(index, mid * _INDEX.size)
+            if entry_ms <= ms:
+                offset = entry_offset
+                low = mid + 1
+            else:
+                high = mid
+        return offset
+
+    def records(self, start_ms=0):
+        """Generate (ms, stream, kind, data) from start_ms on."""
+        mv = self._mv
+        n = self.seek(start_ms)
+        end = len(mv)
+        while n + _RECORD.size <= end:
+            ms, stream, kind, length = _RECORD.unpack_from(mv, n)
+            n += _RECORD.size
+            if n + length > end:
+                # cut short, the capture wasn't closed
+                return
+            if ms >= start_ms:
+                yield ms, stream, kind, mv[n:n + length]
+            n += length
+
+    def close(self):
+        self._mv.release()
+        self._map.close()
+        self._f.close()
+        if self._index_map is not None:
+            self._index_map.close()
+            self._index_f.close()
@@ -0,0 +1,83 @@
+import time
+
+# Rate limiting of the records published for each bike. A bike's first
+# record goes out straight away; records that follow within window_s of the
+# last one published are held, and only the latest of them is published
+# once the window is over, the ones it supersedes are dropped. Status
+# changes (started, finished, aborted) bypass the window: they go out
+# straight away and drop the record held for the bike, which they
+# supersede.
+#
+# Used from the ingest loop only, which calls due() regularly, see
+# IngestServer.poll(). A window of 0 publishes everything straight away.
+
+COALESCE_WINDOW_S = 1.0
+
+
+class Coalescer:
+    """publish is called as publish(topic, payload, qos, trace) for every
+    record that goes out."""
+
+    def __init__(self, publish, window_s=COALESCE_WINDOW_S, clock=time.monotonic):
+        self.publish = publish
+        self.window_s = window_s
+        self.clock = clock
+        self._last = {}         # key -> time a record was last published
+        self._held = {}         # key -> [due, topic, payload, qos, trace]
+        # statistics
+        self.published = 0
+        self.coalesced = 0
+        self.bypassed = 0
+
+    def update(self, key, topic, payload, qos=0, trace=None):
+        """A record that may be held back."""
+        now = self.clock()
+        last = self._last.get(key)
+        if last is None or now - last >= self.window_s:
+            self._publish(key, now, topic, payload, qos, trace)
+            return
+        if key in self._held:
+            self.coalesced += 1
+        self._held[key] = [last + self.window_s, topic, payload, qos, trace]
+
+    def bypass(self, key, topic, payload, qos=0, trace=None):
+        """A status change, published straight away."""
+        if self._held.pop(key, None):
+            self.coalesced += 1
+        self.bypassed += 1
+        self._publish(key, self.clock(), topic, payload, qos, trace)
+
+    def due(self):
+        """Publish the held records whose window is over."""
+        if not self._held:
+            return
+        now = self.clock()
+        for key in [key for key, held in self._held.items() if held[0] <= now]:
+            due, topic, payload, qos, trace = self._held.pop(key)
+            self._publish(key, now, topic, payload, qos, trace)
+
+    def drain(self):
+        """Publish everything held, window or not."""
+        for key in list(self._held):
+            due, topic, payload, qos, trace = self._held.pop(key)
+            self._publish(key, self.clock(), topic, payload, qos, trace)
+
+    def wait(self, timeout):
+        """timeout, or less if a held record is due sooner."""
+        if not self._held:
+            return timeout
+        due = min(held[0] for held in self._held.values()) - self.clock()
+        return max(0, min(timeout, due))
+
+    def forget(self, key):
+        # the ride is over, the next one starts without a window
+        self._last.pop(key, None)
+
+    def _publish(self, key, now, topic, payload, qos, trace):
+        self._last[key] = now
+        self.published += 1
+        self.publish(topic, payload, qos, trace)
+
+    def stats(self):
+        return {"Held": len(self._held), "Published": self.published,
+                "Coalesced": self.coalesced, "Bypassed": self.bypassed}
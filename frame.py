@@ -0,0 +1,306 @@
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+import json
+
+try:
+    from micropython import const
+except ImportError:
+    def const(x):
+        return x
+
+# Binary LoRa frame format shared by rider.py (bike) and gateway.py.
+#
+# Uplink (bike -> gateway), all fields big endian:
+#
+#   byte 0     : header, (UPLINK_VERSION << 4) | status
+#   byte 1     : bike id
+#   bytes 2-3  : crank counter (unsigned)
+#   bytes 4-5  : distance remaining in meters (signed)
+#   byte 6     : average speed (unsigned, saturated at 255)
+#   byte 7     : number of crank samples that follow, n (version 2 only)
+#   3 * n      : crank samples, oldest first, each made of
+#                  age of the sample when the frame was built, in ms (2 bytes)
+#                  crank counter minus the counter of the sample (1 byte)
+#   last byte  : CRC-8 of all the bytes before it
+#
+# Version 1 uplinks have no sample count nor samples, they are 8 bytes long
+# and are still sent when there are no samples.
+#
+# Version 3 uplinks are version 2 ones with, between the samples and the CRC,
+#
+#   bytes 0-3  : age of the start of the ride when the frame was built, in ms
+#
+# The bike's finish report is one, its last sample being the crank pulse
+# that took the rider past the finish: the ride is timed on the bike's own
+# clock, whenever and through whichever gateway the report gets through.
+#
+# Any of them may be followed by a sequence number trailer, used to acknowledge
+# and deduplicate the frames sent reliably (see reliable.py):
+#
+#   byte 0     : sequence number
+#   byte 1     : CRC-8 of the whole frame, trailer included
+#
+# Decoders that don't know about the trailer ignore it, as the frame before
+# it is complete on its own.
+#
+# Downlink (gateway -> bike):
+#
+#   byte 0     : header, (FRAME_VERSION << 4) | command
+#   byte 1     : bike id, BROADCAST_ID for all bikes
+#   bytes 2-3  : phase of the gateway's TDMA frame when sent, in ms
+#   byte 4     : uplink slot assigned to the bike (CMD_START, 0 otherwise)
+#   byte 5     : number of slots in a frame, 0 if no slot could be assigned
+#   bytes 6-7  : slot length in ms
+#   byte 8     : CRC-8 of bytes 0..7
+#
+# and may have a sequence number trailer too. CMD_START and CMD_ABORT carry
+# the gateway's sequence number, CMD_ACK the sequence number of the uplink
+# it acknowledges.
+#
+# Packets starting with '{' are legacy JSON frames and are still accepted
+# by decode_uplink() and decode_downlink() so that old bikes and gateways
+# keep working with new ones.
+
+FRAME_VERSION = const(1)
+UPLINK_VERSION = const(2)
+UPLINK_TIMED_VERSION = const(3)
+
+STATUS_STARTED = const(0)
+STATUS_RUNNING = const(1)
+STATUS_FINISHED = const(2)
+STATUS_IDLE = const(3)
+STATUS_ABORTED = const(4)
+
+# status enum <-> the single letter codes used on the JSON frames
+STATUS_CODES = 'srfia'
+
+_UPLINK_FMT = '>BBHhB'
+UPLINK_SIZE = const(8)          # version 1, or version 2 without samples + 1
+_UPLINK_SAMPLE_FMT = '>HB'
+_UPLINK_SAMPLE_SIZE = const(3)
+MAX_SAMPLES = const(16)
+_UPLINK_START_FMT = '>I'
+_UPLINK_START_SIZE = const(4)
+
+CMD_START = const(0)
+CMD_BEACON = const(1)
+CMD_ABORT = const(2)        # end the ride now, the bike reports STATUS_ABORTED
+CMD_RESET = const(3)        # drop everything and go back to idle, no report
+CMD_ACK = const(4)          # uplink received, in the sequence number trailer
+
+BROADCAST_ID = const(0)
+
+_DOWNLINK_FMT = '>BBHBBH'
+DOWNLINK_SIZE = const(9)
+
+_TRAILER_SIZE = const(2)
+
+_JSON_START = const(0x7B)   # '{'
+
+# the radio settings of rider.py and gateway.py, for airtime_ms()
+LORA_SF = const(7)
+LORA_BW_KHZ = const(125)
+LORA_PREAMBLE = const(8)
+LORA_CODING_RATE = const(1)     # 4/5
+
+
+def _make_crc8_table():
+    # CRC-8, polynomial 0x07 (ATM / SMBus)
+    table = bytearray(256)
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            if crc & 0x80:
+                crc = ((crc << 1) ^ 0x07) & 0xFF
+            else:
+                crc = (crc << 1) & 0xFF
+        table[i] = crc
+    return table
+
+_CRC8_TABLE = _make_crc8_table()
+
+
+def crc8(data, length):
+    crc = 0
+    table = _CRC8_TABLE
+    for i in range(length):
+        crc = table[crc ^ data[i]]
+    return crc
+
+
+def _add_trailer(buf, size, seq):
+    buf[size] = seq & 0xFF
+    buf[size + 1] = crc8(buf, size + 1)
+
+
+def _trailer(data, size):
+    # sequence number of a frame of size bytes, None if it has none
+    if len(data) < size + _TRAILER_SIZE or crc8(data, size + 1) != data[size + 1]:
+        return None
+    return data[size]
+
+
+def uplink_size(count, trailer=False, timed=False):
+    """Length of an uplink frame with count samples, the start of the ride
+    if timed is True and a sequence number trailer if trailer is True."""
+    count = min(count, MAX_SAMPLES)
+    if timed:
+        size = UPLINK_SIZE + 1 + count * _UPLINK_SAMPLE_SIZE + _UPLINK_START_SIZE
+    else:
+        size = UPLINK_SIZE + 1 + count * _UPLINK_SAMPLE_SIZE if count else UPLINK_SIZE
+    return size + _TRAILER_SIZE if trailer else size
+
+
+def encode_uplink(bike_id, status, crank, distance, speed, samples=(), seq=None,
+                  start_age=None):
+    """Pack a telemetry frame. status is one of the STATUS_* values, samples
+    a sequence of up to MAX_SAMPLES (age_ms, crank) pairs, oldest first. seq
+    adds a sequence number trailer, start_age the age of the start of the
+    ride in ms.
+    """
+    if speed > 255:
+        speed = 255
+    elif speed < 0:
+        speed = 0
+    count = min(len(samples), MAX_SAMPLES)
+    timed = start_age is not None
+    if timed:
+        version = UPLINK_TIMED_VERSION
+    else:
+        # nothing to add to a version 1 frame without samples
+        version = UPLINK_VERSION if count else 1
+    size = uplink_size(count, timed=timed)
+    buf = bytearray(size if seq is None else size + _TRAILER_SIZE)
+    struct.pack_into(_UPLINK_FMT, buf, 0, (version << 4) | status,
+                     bike_id, crank & 0xFFFF, distance, speed)
+    if version > 1:
+        buf[UPLINK_SIZE - 1] = count
+    offset = UPLINK_SIZE
+    for i in range(len(samples) - count, len(samples)):
+        age_ms, sample_crank = samples[i]
+        struct.pack_into(_UPLINK_SAMPLE_FMT, buf, offset,
+                         min(age_ms, 0xFFFF), min(crank - sample_crank, 0xFF))
+        offset += _UPLINK_SAMPLE_SIZE
+    if timed:
+        struct.pack_into(_UPLINK_START_FMT, buf, offset, min(max(start_age, 0), 0xFFFFFFFF))
+    buf[size - 1] = crc8(buf, size - 1)
+    if seq is not None:
+        _add_trailer(buf, size, seq)
+    return buf
+
+
+def decode_uplink(data):
+    """Unpack a telemetry frame into
+    (bike_id, status, crank, distance, speed, samples, seq, start_age),
+    samples being a list of (age_ms, crank) pairs, oldest first. seq is None
+    for frames without a sequence number, start_age for frames without the
+    start of the ride.
+
+    Raises ValueError if the frame is malformed or fails the CRC check.
+    """
+    if len(data) and data[0] == _JSON_START:
+        return _decode_json_uplink(data)
+    if len(data) < UPLINK_SIZE:
+        raise ValueError('short frame')
+    version = data[0] >> 4
+    if version == 1:
+        size = UPLINK_SIZE
+        count = 0
+    elif (version == UPLINK_VERSION or version == UPLINK_TIMED_VERSION) and len(data) > UPLINK_SIZE:
+        count = data[UPLINK_SIZE - 1]
+        size = UPLINK_SIZE + 1 + count * _UPLINK_SAMPLE_SIZE
+        if version == UPLINK_TIMED_VERSION:
+            size += _UPLINK_START_SIZE
+    else:
+        raise ValueError('unsupported frame version')
+    if len(data) < size:
+        raise ValueError('short frame')
+    if crc8(data, size - 1) != data[size - 1]:
+        raise ValueError('bad crc')
+    header, bike_id, crank, distance, speed = struct.unpack_from(_UPLINK_FMT, data, 0)
+    status = header & 0x0F
+    if status >= len(STATUS_CODES):
+        raise ValueError('bad status')
+    samples = []
+    offset = UPLINK_SIZE
+    for _ in range(count):
+        age_ms, back = struct.unpack_from(_UPLINK_SAMPLE_FMT, data, offset)
+        samples.append((age_ms, (crank - back) & 0xFFFF))
+        offset += _UPLINK_SAMPLE_SIZE
+    start_age = None
+    if version == UPLINK_TIMED_VERSION:
+        start_age = struct.unpack_from(_UPLINK_START_FMT, data, offset)[0]
+    return bike_id, status, crank, distance, speed, samples, _trailer(data, size), start_age
+
+
+def _decode_json_uplink(data):
+    try:
+        parsed_json = json.loads(bytes(data).decode('ascii'))
+        return (int(parsed_json['id']), STATUS_CODES.index(parsed_json['st']),
+                parsed_json['cr'], parsed_json['ds'], parsed_json['sp'], [], None, None)
+    except Exception:
+        raise ValueError('bad json frame')
+
+
+def downlink_size(trailer=False):
+    """Length of a command frame, with a sequence number trailer if trailer
+    is True."""
+    return DOWNLINK_SIZE + _TRAILER_SIZE if trailer else DOWNLINK_SIZE
+
+
+def encode_downlink(cmd, bike_id, phase_ms, slot=0, slot_count=0, slot_ms=0, seq=None):
+    """Pack a command frame. cmd is one of the CMD_* values, seq adds a
+    sequence number trailer."""
+    buf = bytearray(downlink_size(seq is not None))
+    struct.pack_into(_DOWNLINK_FMT, buf, 0, (FRAME_VERSION << 4) | cmd,
+                     bike_id, phase_ms, slot, slot_count, slot_ms)
+    buf[DOWNLINK_SIZE - 1] = crc8(buf, DOWNLINK_SIZE - 1)
+    if seq is not None:
+        _add_trailer(buf, DOWNLINK_SIZE, seq)
+    return buf
+
+
+def decode_downlink(data):
+    """Unpack a command frame into
+    (cmd, bike_id, phase_ms, slot, slot_count, slot_ms, seq), seq being None
+    for frames without a sequence number.
+
+    Raises ValueError if the frame is malformed or fails the CRC check.
+    """
+    if len(data) and data[0] == _JSON_START:
+        return _decode_json_downlink(data)
+    if len(data) < DOWNLINK_SIZE:
+        raise ValueError('short frame')
+    if crc8(data, DOWNLINK_SIZE - 1) != data[DOWNLINK_SIZE - 1]:
+        raise ValueError('bad crc')
+    header, bike_id, phase_ms, slot, slot_count, slot_ms = struct.unpack_from(_DOWNLINK_FMT, data, 0)
+    if header >> 4 != FRAME_VERSION:
+        raise ValueError('unsupported frame version')
+    return header & 0x0F, bike_id, phase_ms, slot, slot_count, slot_ms, _trailer(data, DOWNLINK_SIZE)
+
+
+def _decode_json_downlink(data):
+    try:
+        parsed_json = json.loads(bytes(data).decode('ascii'))
+        if parsed_json['cm'] != 's':
+            raise ValueError
+        # old gateways don't assign slots
+        return CMD_START, int(parsed_json['id']), 0, 0, 0, 0, None
+    except Exception:
+        raise ValueError('bad json frame')
+
+
+def airtime_ms(length, sf=LORA_SF, bw_khz=LORA_BW_KHZ, preamble=LORA_PREAMBLE,
+               cr=LORA_CODING_RATE):
+    """Time on air in ms, rounded down, of a packet of length bytes with
+    explicit header and payload CRC (Semtech AN1200.13). cr is 1 for 4/5
+    up to 4 for 4/8."""
+    t_sym_us = (1 << sf) * 1000 // bw_khz
+    low_dr_optimize = 1 if t_sym_us > 16000 else 0
+    bits = 8 * length - 4 * sf + 28 + 16
+    per_symbols = 4 * (sf - 2 * low_dr_optimize)
+    payload_symbols = 8 + max(-(-bits // per_symbols) * (cr + 4), 0)
+    # preamble + 4.25 symbols
+    return ((4 * preamble + 17) * t_sym_us // 4 + payload_symbols * t_sym_us) // 1000
@@ -0,0 +1,133 @@
+try:
+    from micropython import const
+except ImportError:
+    def const(x):
+        return x
+
+# Incremental framing of the newline terminated records exchanged between
+# the gateways and the server. Data is read straight into a preallocated
+# buffer and complete records are handed out as memoryview slices of it, a
+# record split over several reads is carried over to the next one.
+#
+# With binary set, the framer also hands out the length prefixed binary
+# records of wire.py, which can be mixed with the lines: a record starting
+# with a byte >= 0x80 (which no text line does) is a binary one.
+
+_NEWLINE = const(0x0A)
+_CR = const(0x0D)
+_BINARY = const(0x80)
+_BINARY_HEADER = const(3)    # type, 16 bit length of what follows
+
+
+class LineFramer:
+    def __init__(self, size=2048, binary=False):
+        self.buf = bytearray(size)
+        self._binary = binary
+        self._mv = memoryview(self.buf)
+        self._start = 0     # first byte of the current record
+        self._scan = 0      # bytes before this have been searched for a newline
+        self._end = 0       # end of the valid data
+        self._has_find = hasattr(self.buf, 'find')
+        self._discard = False   # skipping the rest of an oversized record
+        # records dropped because they didn't fit in the buffer
+        self.overflows = 0
+
+    def pending(self):
+        """Number of bytes of incomplete records held in the buffer."""
+        return self._end - self._start
+
+    def recv_into(self, sock):
+        """Read from sock into the buffer. Returns the number of bytes read,
+        0 if the connection was closed or None if there was nothing to read
+        on a non-blocking socket. Socket errors are not handled here.
+        """
+        self._make_room()
+        if hasattr(sock, 'recv_into'):
+            return self._commit(sock.recv_into(self._mv[self._end:]))
+        return self._commit(sock.readinto(self._mv[self._end:]))
+
+    def received(self, n):
+        """The last n bytes read or fed, as a memoryview valid until the
+        next read."""
+        return self._mv[self._end - n:self._end]
+
+    def feed(self, data):
+        """Copy as much of data as fits into the buffer, for sources that
+        can't read into it. Returns the number of bytes taken, the records
+        must be consumed before feeding the rest.
+        """
+        self._make_room()
+        n = min(len(data), len(self.buf) - self._end)
+        self.buf[self._end:self._end + n] = memoryview(data)[:n]
+        self._end += n
+        return n
+
+    def records(self):
+        """Generate the complete records in the buffer as memoryviews, without
+        the line terminator. The views are only valid until the next read.
+        """
+        buf = self.buf
+        while True:
+            start = self._start
+            if self._binary and start < self._end and buf[start] & _BINARY and not self._discard:
+                # the whole binary record, header included
+                if self._end - start < _BINARY_HEADER:
+                    return
+                end = start + _BINARY_HEADER + (buf[start + 1] << 8 | buf[start + 2])
+                if end > self._end:
+                    return
+                self._start = self._scan = end
+                yield self._mv[start:end]
+                continue
+            i = self._find_newline()
+            if i < 0:
+                self._scan = self._end
+                return
+            start = self._start
+            self._start = self._scan = i + 1
+            if self._discard:
+                self._discard = False
+                continue
+            if i > start and self.buf[i - 1] == _CR:
+                i -= 1
+            if i > start:
+                yield self._mv[start:i]
+
+    def _find_newline(self):
+        if self._has_find:
+            return self.buf.find(b'\n', self._scan, self._end)
+        buf = self.buf
+        for i in range(self._scan, self._end):
+            if buf[i] == _NEWLINE:
+                return i
+        return -1
+
+    def _commit(self, n):
+        if n:
+            self._end += n
+        return n
+
+    def _make_room(self):
+        start = self._start
+        if start == self._end:
+            # nothing pending, start over at the beginning of the buffer
+            self._start = self._scan = self._end = 0
+            return
+        if self._end < len(self.buf):
+            return
+        if not start:
+            # a single record fills the whole buffer, drop it
+            if not self._discard:
+                self.overflows += 1
+                self._discard = True
+            self._start = self._scan = self._end = 0
+            return
+        # move the incomplete record to the front
+        n = self._end - start
+        if n <= start:
+            self.buf[0:n] = self._mv[start:self._end]
+        else:
+            self.buf[0:n] = bytes(self._mv[start:self._end])
+        self._scan -= start
+        self._start = 0
+        self._end = n
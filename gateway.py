@@ -4,13 +4,62 @@ import socket
 import config
 import time
 import json
+import frame
+import tdma
+import kinematics
+import reliable
+import log
+import wire
+import heap
+import metrics
+from record import RecordWriter, record_prefix, STATUS_BYTES
+from scheduler import Scheduler
+from ringbuf import RecordRing, OVERFLOW_DROP_OLDEST
+from framing import LineFramer
 
 TCP_PORT = 50140            # FIXME
 TCP_IP = '192.168.10.101'        # TODO: Needs to be replaced with the actual IP
 
 EAGAIN = const(11)
+EINPROGRESS = const(115)
+
+# Scheduler periods. LoRa packets can't be waited on like sockets, so the
+# radio is polled, often enough to keep the forwarding delay small.
+LORA_POLL_MS = const(5)
+TCP_TX_PERIOD_MS = const(20)
+RECONNECT_PERIOD_MS = const(1000)
+RETRY_POLL_MS = const(100)
+SERVER_CONNECT_TIMEOUT_MS = const(2000)
+
+# Records that can't be sent while the server is unreachable are kept in the
+# backlog and replayed on reconnect, at most one batch per TX pass so live
+# traffic keeps flowing. What spilled to flash is replayed after a reboot
+# too. Set BACKLOG_SPILL_PATH to None to keep the backlog in RAM only.
+BACKLOG_SIZE = const(8192)
+BACKLOG_OVERFLOW = OVERFLOW_DROP_OLDEST
+BACKLOG_SPILL_PATH = '/flash/backlog.log'
+BACKLOG_SPILL_MAX = const(65536)
+BACKLOG_BATCH_SIZE = const(1024)
+LIVE_QUEUE_MAX = const(16)
+RX_BUFFER_SIZE = const(1024)
+LORA_RX_SIZE = const(256)   # larger than any LoRa packet
+SLOT_RELEASE_DELAY_MS = const(15000)
+# Add the latency trace of latency.py to every record sent to the server
+TRACE_LATENCY = False
+# Ask the server for the binary records of wire.py, JSON lines otherwise
+BINARY_RECORDS = True
+# Run the garbage collector and send a health record to the server this
+# often: the heap (see heap.py), the counters of metrics.py and the signal
+# of every bike heard. 0 to let the heap look after itself and send nothing.
+HEALTH_PERIOD_MS = const(60000)
+HEALTH_PROBE_LARGEST = True
+SIGNAL_BIKES_MAX = const(64)
 
 class Rider:
+    __slots__ = ('name', 'company', 'badge', 'bike', 'status', 'eventid', 'speed',
+                 'distance', 'crank', 'starttime', 'ridetimestamp', 'prefix',
+                 'wire_id', 'fields')
+
     def __init__(self, name, company, badge, bike, eventid, ridetimestamp):
         self.name = name
         self.company = company
@@ -21,110 +70,537 @@ class Rider:
         self.speed = 0
         self.distance = 0
         self.crank = 0
-        self.starttime = time.ticks_ms() / 1000
+        self.starttime = time.ticks_ms()
         self.ridetimestamp = ridetimestamp
+        # the part of the ride records that never changes, see record.py
+        self.prefix = record_prefix(name, company, badge, eventid, ridetimestamp, int(bike))
+        # the same for the binary records, sent once per connection
+        self.wire_id = 0
+        try:
+            self.fields = wire.ride_fields(name, company, badge, eventid, ridetimestamp)
+        except ValueError:
+            self.fields = None
 
 class NanoGateWay:
-    def __init__(self):
+    def __init__(self, sched=None):
         self.sock = None
         self.connected = False
+        self.connecting = False # connect() started, see connect_task()
+        self.connect_ms = 0
+        self.wlan_connecting = False
         self.wlan = WLAN(mode=WLAN.STA)
         self.riders = {} # dictionary of riders
+        self.tx_queue = [] # messages waiting to be written to the server socket
+        self.tx_offset = 0 # bytes of tx_queue[0] already written
+        self.tx_rest = False # tx_queue[0] is the rest of a partially written record
+        self.rx = LineFramer(RX_BUFFER_SIZE) # commands from the server, one per line
+        self.lora_rx = bytearray(LORA_RX_SIZE) # LoRa packets are read into this
+        self.lora_mv = memoryview(self.lora_rx)
+        self.record = RecordWriter() # reused for every record sent to the server
+        self.wire = wire.FrameWriter() # the same for binary records
+        self.binary = False # the server accepted binary records on this connection
+        self.defined = set() # wire ids of the rides sent on this connection
+        self.next_wire_id = 0
+        self.backlog = RecordRing(BACKLOG_SIZE, BACKLOG_OVERFLOW, BACKLOG_SPILL_PATH, BACKLOG_SPILL_MAX)
+        self.batch = bytearray(BACKLOG_BATCH_SIZE)
+        self.batch_len = 0 # backlog batch being written, 0 if none
+        self.batch_sent = 0
+        self.batch_records = 0
+        self.sched = sched if sched else Scheduler()
+        self.slots = tdma.SlotAllocator()
+        self.frames = 0
+        self.downlinks = [] # (message, counter) waiting for the next beacon slot
+        # start and abort commands waiting for the bike to answer, by bike id
+        self.retries = reliable.Retransmitter()
+        self.dedup = reliable.Deduplicator()
+        # bikes started by another gateway, forwarded but not answered
+        self.listening = set()
+        self.seq = 0
         # initialize LoRa as a Gateway (with Tx IQ inversion)
         self.lora = LoRa(tx_iq=True, rx_iq=False)
+        self.lora_recv_into = hasattr(self.lora, 'recv_into')
+        self.heap = heap.HeapMonitor(HEALTH_PROBE_LARGEST)
+        self.metrics = metrics.Registry()
+        self.signal = {} # bike id -> [rssi, snr] of its last packet
+
+    def start(self):
+        # every I/O path is its own task, the TCP receive side is woken up by
+        # the socket itself once connected
+        self.sched.every(LORA_POLL_MS, self.lora_rx_task)
+        self.sched.every(TCP_TX_PERIOD_MS, self.tcp_tx_task)
+        self.sched.every(RECONNECT_PERIOD_MS, self.reconnect_task)
+        self.sched.every(RETRY_POLL_MS, self.retry_task)
+        if HEALTH_PERIOD_MS:
+            self.sched.every(HEALTH_PERIOD_MS, self.health_task, HEALTH_PERIOD_MS)
+        # beacons go out at the start of a frame, in the slot no bike uses
+        self.sched.every(tdma.FRAME_MS, self.beacon_task,
+                         tdma.FRAME_MS - self.slots.phase())
 
     def connect_to_wlan(self):
-        if not self.wlan.isconnected():
+        if self.wlan.isconnected():
+            self.wlan_connecting = False
+            return True
+        if not self.wlan_connecting:
             # TODO: change for the correct credentials here (ssid and password)
             self.wlan.connect(ssid='KCOMIoT', auth=(None, '10noCHOSun'), timeout=7000)
-            while not self.wlan.isconnected():
-                time.sleep_ms(50)
+            self.wlan_connecting = True
+        return False
 
     def connect_to_server(self):
-        if self.sock:
-            self.sock.close()
+        # the connection is set up without blocking the scheduler, LoRa
+        # has to keep going while the server is unreachable: connect_task()
+        # runs once it is, reconnect_task() gives up after a while
+        self.disconnect()
         self.sock = socket.socket()                 # TCP
+        self.sock.setblocking(False)
+        try:
+            # records are small and written one at a time, Nagle would hold
+            # each one back until the server ACKs the previous one
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (AttributeError, OSError):
+            pass    # ports without the option
         try:
             self.sock.connect((TCP_IP, TCP_PORT))   # TODO
-            self.sock.settimeout(1)
-            self.connected = True
-        except Exception:
-             self.sock.close() # just close the socket and try again later
-             print('Socket connect failed, retrying...')
-             time.sleep_ms(500)
-    
+        except OSError as e:
+            if e.args[0] not in (EINPROGRESS, EAGAIN):
+                self.connect_failed()
+                return
+        self.connecting = True
+        self.connect_ms = time.ticks_ms()
+        self.sched.add_writer(self.sock, self.connect_task)
+
+    def connect_task(self):
+        # the socket is writable, connected unless connect() failed, which
+        # the first read or write finds out
+        self.sched.remove_writer(self.sock)
+        self.connecting = False
+        self.connected = True
+        self.rx = LineFramer(RX_BUFFER_SIZE)
+        self.binary = False
+        self.defined = set()
+        self.sched.add_reader(self.sock, self.tcp_rx_task)
+        if BINARY_RECORDS:
+            self.send_hello()
+            if not self.sock:
+                self.connect_failed()
+                return
+        self.metrics.inc('tcp_connects')
+        if len(self.backlog):
+            print('Replaying {} queued records'.format(len(self.backlog)))
+
+    def connect_failed(self):
+        self.disconnect() # just close the socket and try again later
+        self.metrics.inc('tcp_connect_failures')
+        print('Socket connect failed, retrying...')
+
+    def send_hello(self):
+        # the first bytes on a new connection, never queued for the next
+        # one: if they can't be written the connection stays on JSON lines
+        sent = self.write(wire.HELLO)
+        if sent and sent < len(wire.HELLO):
+            self.tx_queue.append(wire.HELLO[sent:])
+            self.tx_rest = True
+
+    def disconnect(self):
+        if self.sock:
+            self.sched.remove_reader(self.sock)
+            self.sched.remove_writer(self.sock)
+            self.sock.close()
+            self.sock = None
+        self.connected = False
+        self.connecting = False
+        # keep whatever wasn't sent for the next connection, the batch in
+        # flight is still in the backlog and is sent again from the start.
+        # The rest of a record cut short means nothing to the next one.
+        if self.tx_rest:
+            self.tx_queue.pop(0)
+            self.tx_rest = False
+        for msg in self.tx_queue:
+            self.backlog.put(msg)
+        self.tx_queue = []
+        self.tx_offset = 0
+        self.batch_len = 0
+
+    def can_write(self):
+        # True if send() writes straight to the socket
+        return self.connected and self.sock and not self.tx_queue and not self.batch_len
+
     def send(self, msg):
-        if self.connected and self.sock:
-            try:
-                self.sock.send(msg)
-            except Exception:
-                self.connected = False
-                self.sock.close()
-                self.sock = None
+        # msg may be a view of a reused buffer, it's copied if it can't be
+        # written out straight away
+        if self.can_write():
+            sent = self.write(msg)
+            if sent == len(msg):
+                return
+            if sent:
+                # the rest of a partially written record goes out first
+                self.tx_queue.append(bytes(msg[sent:]))
+                self.tx_rest = True
+                return
+        if self.connected and self.sock and len(self.tx_queue) < LIVE_QUEUE_MAX:
+            self.tx_queue.append(bytes(msg))
+            self.tcp_tx_task()
+        else:
+            self.backlog.put(msg)
+            self.metrics.inc('records_backlogged')
 
     def new_rider(self, name, company, badge, bike, eventid, ridetimestamp):
         rider = Rider(name, company, badge, bike, eventid, ridetimestamp)
-        self.riders[bike] = rider
+        # bike ids arrive as ints or strings from the server, LoRa frames carry ints
+        self.riders[int(bike)] = rider
+        self.next_wire_id = (self.next_wire_id + 1) & 0xFF
+        rider.wire_id = self.next_wire_id
+        self.defined.discard(rider.wire_id)
+        # the bike may have restarted since its last ride
+        self.dedup.forget(int(bike))
 
     def recv(self):
+        # returns True if new data was read into self.rx
         if self.connected and self.sock:
             try:
-                data = self.sock.recv(1024)
-            except socket.timeout:
-                return None
+                n = self.rx.recv_into(self.sock)
             except socket.error as e:
                 if e.args[0] != EAGAIN:
-                    self.connected = False
-                return None
-            return data
-
-    def run(self):
-        data = self.recv()
-        if data:
-            print(data)
-            parsed_json = json.loads(data.decode('ascii'))
-            print(parsed_json)
-            if parsed_json['RideStatus'] == "started":
-                self.new_rider(parsed_json['RiderName'], parsed_json['Company'], 
-                               parsed_json['BadgeNumber'], parsed_json['BikeID'],parsed_json['EventID'],parsed_json['RideTimestamp'])
-                # start the race
-                print(str({'id':parsed_json['BikeID'], 'cm': 's'}))
-                packet_tx = json.dumps({'id':parsed_json['BikeID'], 'cm': 's'})
-                print ("packet_tx = " + packet_tx)
-                self.lora.send(packet_tx, True)
-
-        lora_d = self.lora.recv()
-        if lora_d:
-            parsed_json = json.loads(lora_d.decode('ascii'))
-            print(parsed_json)
-            # update the rider info (if the rider already exists)
-            bike_id = parsed_json['id']
-            if bike_id in self.riders:
-                self.riders[bike_id].speed = parsed_json['sp']
-                self.riders[bike_id].distance = parsed_json['ds']
-                self.riders[bike_id].crank = parsed_json['cr']
-                if parsed_json['st'] == 'i' or parsed_json['st'] == 'f':
-                    self.riders[bike_id].status = 'finished'
-                elif parsed_json['st'] == 'r':
-                    self.riders[bike_id].status = 'counting'
-                else:
-                    self.riders[bike_id].status = 'started'
-                # Assemble the TCP packet
-                wheel_count=self.riders[bike_id].crank * 7
-                json_d = {"RiderName":self.riders[bike_id].name, "Company":self.riders[bike_id].company, "BadgeNumber":self.riders[bike_id].badge, \
-                          "EventID":self.riders[bike_id].eventid, "RideTimestamp":'{:f}'.format(self.riders[bike_id].ridetimestamp), "BikeID":bike_id, \
-                          "RideStatus":self.riders[bike_id].status, "RideInfo":[{"CounterTimestamp": float(time.ticks_ms()), \
-                          "CrankCounter":self.riders[bike_id].crank, "WheelCounter":wheel_count}]}
-                json_str = json.dumps(json_d)
-                print("Outgoing from Gateway: " + str(json_str))
-                self.send(json_str+"\n")
+                    self.disconnect()
+                return False
+            if n == 0:
+                # the server closed the connection
+                self.disconnect()
+            return bool(n)
+        return False
+
+    def lora_rx_task(self):
+        if not self.lora_recv_into:
+            lora_d = self.lora.recv()
+            while lora_d:
+                self.process_lora(lora_d, time.ticks_ms())
+                lora_d = self.lora.recv()
+            return
+        # every packet is read into the same buffer, process_lora() must not
+        # keep a reference to it
+        n = self.lora.recv_into(self.lora_rx)
+        while n:
+            self.process_lora(self.lora_mv[:n], time.ticks_ms())
+            n = self.lora.recv_into(self.lora_rx)
+
+    def tcp_rx_task(self):
+        if self.recv():
+            for data in self.rx.records():
+                self.process_server(data)
+
+    def write(self, data):
+        # returns the number of bytes written, or None if the socket is busy or gone
+        try:
+            sent = self.sock.send(data)
+        except socket.error as e:
+            if e.args[0] != EAGAIN:
+                self.disconnect()
+            return None
+        if sent is None:
+            sent = len(data)
+        self.metrics.inc('tcp_tx_bytes', sent)
+        return sent
+
+    def tcp_tx_task(self):
         if not self.connected:
-            self.connect_to_wlan()
-            self.connect_to_server()
+            return
+        # a record must be written out completely before the next one starts,
+        # so finish a backlog batch that is half way through first
+        if self.batch_len and not self.flush_batch():
+            return
+        while self.tx_queue and self.sock:
+            msg = self.tx_queue[0]
+            sent = self.write(memoryview(msg)[self.tx_offset:])
+            if sent is None:
+                return
+            self.tx_offset += sent
+            if self.tx_offset < len(msg):
+                # partial write, the rest goes out on the next pass
+                return
+            self.tx_queue.pop(0)
+            self.tx_offset = 0
+            self.tx_rest = False
+        # live traffic is out, replay one batch of the backlog
+        if self.sock and len(self.backlog):
+            self.batch_len, self.batch_records = self.backlog.batch(self.batch)
+            self.batch_sent = 0
+            if not self.batch_records:
+                # can't happen unless a record is larger than the batch buffer
+                self.backlog.drop(1)
+                return
+            self.flush_batch()
+
+    def flush_batch(self):
+        sent = self.write(memoryview(self.batch)[self.batch_sent:self.batch_len])
+        if sent is None:
+            return False
+        self.batch_sent += sent
+        if self.batch_sent < self.batch_len:
+            return False
+        self.backlog.drop(self.batch_records)
+        self.batch_len = 0
+        return True
+
+    def reconnect_task(self):
+        if self.connecting:
+            if time.ticks_diff(time.ticks_ms(), self.connect_ms) >= SERVER_CONNECT_TIMEOUT_MS:
+                self.connect_failed()
+        elif not self.connected:
+            if self.connect_to_wlan():
+                self.connect_to_server()
+
+    def release_slot(self, bike_id):
+        # unless the bike was started again in the meantime
+        if bike_id in self.riders and self.riders[bike_id].status in ('finished', 'aborted'):
+            self.slots.release(bike_id)
+
+    def send_command(self, cmd, bike_id, slot=0, slot_count=0, slot_ms=0):
+        # send cmd, and again until the bike answers (see reliable.py)
+        self.seq = (self.seq + 1) & 0xFF
+        message = (cmd, bike_id, slot, slot_count, slot_ms, self.seq)
+        airtime = self.queue_downlink(message, 'lora_tx_command')
+        self.retries.sent(bike_id, message, time.ticks_ms(), airtime)
+
+    def queue_downlink(self, message, counter):
+        # Downlinks only go out in the beacon slot, where no bike transmits
+        # (see downlink_task()). Returns the airtime of the frame.
+        entry = (message, counter)
+        if entry not in self.downlinks:
+            self.downlinks.append(entry)
+        return frame.airtime_ms(frame.downlink_size(message[5] is not None))
+
+    def send_downlink(self, message, counter):
+        cmd, bike_id, slot, slot_count, slot_ms, seq = message
+        packet_tx = frame.encode_downlink(cmd, bike_id, self.slots.phase(),
+                                          slot, slot_count, slot_ms, seq)
+        if log.enabled(log.DEBUG):
+            print("packet_tx = {}".format(packet_tx))
+        self.transmit(packet_tx, counter)
+        return packet_tx
+
+    def transmit(self, packet, counter):
+        self.lora.send(packet, True)
+        metrics = self.metrics
+        metrics.inc(counter)
+        metrics.inc('lora_tx_bytes', len(packet))
+        metrics.inc('lora_tx_airtime_ms', frame.airtime_ms(len(packet)))
 
+    def retry_task(self):
+        now = time.ticks_ms()
+        retry = self.retries.due(now)
+        if retry:
+            bike_id, message = retry
+            airtime = self.queue_downlink(message, 'lora_tx_retry')
+            self.retries.resent(bike_id, now, airtime)
+
+    def beacon_task(self):
+        # the start of a frame, the beacon slot is ours
+        self.frames += 1
+        if self.slots.active() and self.frames % (tdma.BEACON_PERIOD_MS // tdma.FRAME_MS) == 0:
+            self.downlinks.insert(0, ((frame.CMD_BEACON, frame.BROADCAST_ID, 0, 0, 0, None),
+                                      'lora_tx_beacon'))
+        self.downlink_task(tdma.SLOT_MS - tdma.GUARD_MS)
+
+    def downlink_task(self, left_ms):
+        # Send the queued downlinks one after the other, each once the
+        # previous one is off the air, as long as they fit in left_ms. The
+        # rest wait for the next frame.
+        if not self.downlinks:
+            return
+        message, counter = self.downlinks[0]
+        airtime = frame.airtime_ms(frame.downlink_size(message[5] is not None))
+        if airtime > left_ms:
+            return
+        self.downlinks.pop(0)
+        self.send_downlink(message, counter)
+        self.sched.after(airtime, lambda: self.downlink_task(left_ms - airtime))
+
+    def health_task(self):
+        # a collection at a time of our choosing, and a report of the heap,
+        # the counters and the bikes' signal for the server while connected
+        report = self.heap.report()
+        if log.enabled(log.DEBUG):
+            print('Heap: {}'.format(report))
+        if not (self.connected and self.sock):
+            return
+        metrics = self.metrics
+        metrics.set('tx_queue', len(self.tx_queue))
+        metrics.set('backlog', len(self.backlog))
+        metrics.set('retries_pending', self.retries.pending())
+        metrics.set('riders', len(self.riders))
+        report["Counters"] = metrics.counters
+        report["Gauges"] = metrics.gauges
+        # MicroPython's json.dumps() doesn't quote int keys
+        report["Bikes"] = dict((str(bike_id), signal) for bike_id, signal in self.signal.items())
+        self.send(b'{"Health": ' + json.dumps(report).encode() + b'}\n')
+
+    def process_server(self, data):
+        if log.enabled(log.DEBUG):
+            print(bytes(data))
+        try:
+            # json.loads() takes the bytes without decoding them to a str
+            parsed_json = json.loads(bytes(data))
+        except ValueError:
+            self.metrics.inc('server_corrupt')
+            print('Corrupted server message')
+            return
+        self.metrics.inc('server_messages')
+        if log.enabled(log.DEBUG):
+            print(parsed_json)
+        if 'Protocol' in parsed_json:
+            # the server's answer to wire.HELLO
+            self.binary = BINARY_RECORDS and parsed_json['Protocol'] == 'binary' and \
+                parsed_json.get('Version') == wire.PROTOCOL_VERSION
+            return
+        if parsed_json['RideStatus'] == "started":
+            self.new_rider(parsed_json['RiderName'], parsed_json['Company'], 
+                           parsed_json['BadgeNumber'], parsed_json['BikeID'],parsed_json['EventID'],parsed_json['RideTimestamp'])
+            bike_id = int(parsed_json['BikeID'])
+            if parsed_json.get('Listen'):
+                # another gateway starts the bike, this one only forwards
+                # what it hears of the ride
+                self.listening.add(bike_id)
+                self.slots.release(bike_id)
+                self.retries.ack(bike_id)
+                return
+            self.listening.discard(bike_id)
+            # start the race, telling the bike which slot to transmit in
+            slot = self.slots.assign(bike_id)
+            if slot is None:
+                print('No free uplink slot for bike {}'.format(bike_id))
+                self.send_command(frame.CMD_START, bike_id)
+            else:
+                self.send_command(frame.CMD_START, bike_id, slot, self.slots.slot_count, tdma.SLOT_MS)
+        elif parsed_json['RideStatus'] == "abort" or parsed_json['RideStatus'] == "reset":
+            # a reset without a bike id goes to every bike
+            bike_id = int(parsed_json.get('BikeID', frame.BROADCAST_ID))
+            if parsed_json['RideStatus'] == "abort":
+                self.send_command(frame.CMD_ABORT, bike_id)
+                return
+            # the bike doesn't report back after a reset, so it is sent once
+            if bike_id == frame.BROADCAST_ID:
+                for rider_id in self.riders:
+                    self.slots.release(rider_id)
+                self.retries.clear()
+            else:
+                self.slots.release(bike_id)
+                self.retries.ack(bike_id)
+            self.queue_downlink((frame.CMD_RESET, bike_id, 0, 0, 0, None), 'lora_tx_command')
+
+    def process_lora(self, lora_d, rx_ms):
+        try:
+            bike_id, status, crank, distance, speed, samples, seq, start_age = frame.decode_uplink(lora_d)
+            if log.enabled(log.DEBUG):
+                print((bike_id, status, crank, distance, speed, samples, seq, start_age))
+        except ValueError as e:
+            self.metrics.inc('lora_rx_corrupt')
+            if log.enabled(log.DEBUG):
+                print('Corrupted LoRa packet: {}'.format(e))
+            return
+        metrics = self.metrics
+        metrics.inc('lora_rx_uplink')
+        metrics.inc('lora_rx_bytes', len(lora_d))
+        self.track_signal(bike_id)
+        airtime = frame.airtime_ms(len(lora_d))
+        tx_ms = time.ticks_add(rx_ms, -airtime)
+        if seq is not None:
+            # Acknowledge every copy, the acknowledgement of the first one
+            # may have been lost, but only forward the first. Where
+            # gateways overlap only the one whose frames the bike keeps time
+            # with answers, so that their ACKs don't collide.
+            if self.slots.in_slot(bike_id, tx_ms) or \
+                    (self.slots.slot_of(bike_id) is None and bike_id not in self.listening):
+                self.queue_downlink((frame.CMD_ACK, bike_id, 0, 0, 0, seq), 'lora_tx_ack')
+            if self.dedup.seen(bike_id, seq):
+                metrics.inc('lora_rx_duplicate')
+                if log.enabled(log.DEBUG):
+                    print('Duplicate LoRa packet {} from bike {}'.format(seq, bike_id))
+                return
+        # the bike's answer to a start or abort command
+        pending = self.retries.get(bike_id)
+        if pending and reliable.acknowledges(pending[0], status):
+            self.retries.ack(bike_id)
+        # update the rider info (if the rider already exists)
+        rider = self.riders.get(bike_id)
+        if rider is None:
+            return
+        rider.speed = speed
+        rider.distance = distance
+        rider.crank = crank
+        if status in reliable.RELIABLE_STATUS:
+            rider.status = 'aborted' if status == frame.STATUS_ABORTED else 'finished'
+            # The bike sends this report again in its slot until it hears
+            # the ACK, and after finishing it still sends its idle status.
+            # Keep the slot until those are over so that a bike started in
+            # the meantime doesn't get a slot that is still in use.
+            self.sched.after(SLOT_RELEASE_DELAY_MS, lambda: self.release_slot(bike_id))
+        elif status == frame.STATUS_RUNNING:
+            rider.status = 'counting'
+        else:
+            rider.status = 'started'
+        # Assemble the TCP packet, with one RideInfo entry per crank sample
+        # taken by the bike plus the current counter, and first the start of
+        # the ride in a finish report (see frame.py). Ages count from when
+        # the bike started transmitting. Binary records only ever go
+        # straight to the socket, one that can't be written is sent as a
+        # JSON line instead: the queue and the backlog only hold those, as
+        # they don't depend on the connection.
+        if self.binary and rider.fields and self.can_write():
+            record = self.wire
+            record.reset()
+            define = rider.wire_id not in self.defined
+            if define:
+                record.ride(rider.wire_id, bike_id, rider.fields)
+            record.begin(rider.wire_id, wire.STATUS_INDEX[rider.status])
+            msg = self.end_record(record, tx_ms, crank, samples, start_age, airtime, rx_ms)
+            sent = self.write(msg)
+            if sent:
+                if define:
+                    self.defined.add(rider.wire_id)
+                metrics.inc('records_binary')
+                if sent < len(msg):
+                    # the rest of a partially written record goes out first,
+                    # it is dropped if the connection goes down
+                    self.tx_queue.append(bytes(msg[sent:]))
+                    self.tx_rest = True
+                return
+        record = self.record
+        record.begin(rider.prefix, STATUS_BYTES[rider.status])
+        metrics.inc('records_json')
+        self.send(self.end_record(record, tx_ms, crank, samples, start_age, airtime, rx_ms))
+
+    def end_record(self, record, tx_ms, crank, samples, start_age, airtime, rx_ms):
+        # the RideInfo entries and the trace of a record begun by process_lora()
+        if start_age is not None:
+            # the counters are reset at the start
+            record.add_info(time.ticks_add(tx_ms, -start_age), 0, 0)
+        for age_ms, sample_crank in samples:
+            record.add_info(time.ticks_add(tx_ms, -age_ms), sample_crank,
+                            kinematics.wheel_count(sample_crank))
+        record.add_info(tx_ms, crank, kinematics.wheel_count(crank))
+        trace = None
+        if TRACE_LATENCY:
+            trace = (samples[0][0] if samples else 0, airtime, rx_ms, time.ticks_ms())
+        msg = record.end(trace)
+        if log.enabled(log.DEBUG):
+            print("Outgoing from Gateway: {}".format(bytes(msg)))
+        return msg
+
+    def track_signal(self, bike_id):
+        # RSSI and SNR of the packet just received, on radios that have them
+        try:
+            stats = self.lora.stats()
+        except AttributeError:
+            return
+        signal = self.signal.get(bike_id)
+        if signal is None:
+            if len(self.signal) >= SIGNAL_BIKES_MAX:
+                return
+            signal = self.signal[bike_id] = [0, 0]
+        signal[0] = stats.rssi
+        signal[1] = stats.snr
 
 def main():
     gateway = NanoGateWay()
-    while True:
-        gateway.run()
-        time.sleep_ms(50)
+    gateway.start()
+    gateway.sched.run()
@@ -0,0 +1,72 @@
+import gc
+import time
+
+try:
+    from micropython import const
+except ImportError:
+    def const(x):
+        return x
+
+# Heap health of a MicroPython device. HeapMonitor runs the garbage
+# collector at a time of our choosing (a short pause every period instead of
+# a long one whenever the heap happens to run out) and reports how much of
+# the heap is free and how fragmented it is:
+#
+#   Free, Alloc  : gc.mem_free() and gc.mem_alloc() after the collection
+#   Largest      : the largest block that could be allocated, found by
+#                  trying to allocate blocks of decreasing size. A failed
+#                  allocation runs a collection of its own, so this costs a
+#                  few collections per report.
+#   GCs, GCMs    : collections run by the monitor and the total time they
+#                  took, GCMaxMs the longest of them
+#
+# On CPython (the simulation) the heap figures are None.
+
+PROBE_STEP = const(256)     # resolution of Largest, in bytes
+
+
+def largest_free(limit):
+    """Size of the largest block up to limit bytes that can be allocated,
+    to PROBE_STEP bytes."""
+    low = 0
+    high = limit
+    while high - low > PROBE_STEP:
+        size = (low + high) // 2
+        try:
+            block = bytearray(size)
+            del block
+            low = size
+        except MemoryError:
+            high = size
+    return low
+
+
+class HeapMonitor:
+    def __init__(self, probe=True):
+        self.probe = probe
+        self.collections = 0
+        self.gc_us = 0
+        self.gc_max_us = 0
+        self._has_mem_free = hasattr(gc, 'mem_free')
+
+    def collect(self):
+        start = time.ticks_us()
+        gc.collect()
+        elapsed = time.ticks_diff(time.ticks_us(), start)
+        self.collections += 1
+        self.gc_us += elapsed
+        if elapsed > self.gc_max_us:
+            self.gc_max_us = elapsed
+
+    def report(self):
+        """Collect, then return the heap figures as a dict."""
+        self.collect()
+        free = alloc = largest = None
+        if self._has_mem_free:
+            free = gc.mem_free()
+            alloc = gc.mem_alloc()
+            if self.probe:
+                largest = largest_free(free)
+        return {"Free": free, "Alloc": alloc, "Largest": largest,
+                "GCs": self.collections, "GCMs": self.gc_us // 1000,
+                "GCMaxMs": self.gc_max_us // 1000}
@@ -0,0 +1,62 @@
+import time
+
+try:
+    from micropython import const
+except ImportError:
+    def const(x):
+        return x
+
+# Integer ride maths shared by rider.py and gateway.py. Distances are kept in
+# millimetres and times in milliseconds so that nothing on the bike's hot path
+# needs a float, each of which is a heap object on MicroPython.
+#
+# A crank revolution turns the wheel 2.8 times and the wheel is 2.1362m
+# around. Distances have always been scaled by 2.2237 on the bikes (meters
+# per second to miles per hour), which is kept so that the distance target
+# and the speeds shown on the LCD don't change. Speeds are mm/ms, the same
+# number as the meters per second they replace.
+
+PULSES_PER_REVOLUTION = const(2)
+MM_PER_REVOLUTION = const(13301)    # 2.8 * 2.1362 * 2.2237 * 1000
+# The server gets wheel counts in fifths of a revolution, 1.4 per crank pulse
+WHEEL_COUNT_PER_PULSE = const(7)
+
+
+def distance_mm(pulses):
+    """Distance covered after pulses crank pulses, in whole revolutions."""
+    return (pulses // PULSES_PER_REVOLUTION) * MM_PER_REVOLUTION
+
+
+def pulses_past(mm):
+    """The number of crank pulses after which the distance is more than mm,
+    the inverse of distance_mm()."""
+    return (mm // MM_PER_REVOLUTION + 1) * PULSES_PER_REVOLUTION
+
+
+def metres(mm):
+    """mm in whole meters, rounded towards zero like int() did."""
+    if mm < 0:
+        return -(-mm // 1000)
+    return mm // 1000
+
+
+def elapsed_ms(now, start):
+    return time.ticks_diff(now, start)
+
+
+def speed(distance_mm, elapsed_ms):
+    """Average speed over elapsed_ms, 0 before any time has passed."""
+    if elapsed_ms <= 0:
+        return 0
+    return distance_mm // elapsed_ms
+
+
+def window_speed(pulses, span_ms):
+    """Speed from the pulses counted over the last span_ms."""
+    if span_ms <= 0:
+        return 0
+    return (pulses * MM_PER_REVOLUTION) // (PULSES_PER_REVOLUTION * span_ms)
+
+
+def wheel_count(crank):
+    return crank * WHEEL_COUNT_PER_PULSE
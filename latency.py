@@ -0,0 +1,77 @@
+import collections
+import threading
+
+from publisher import percentile
+
+# Where the time goes between a crank sample on a bike and the record being
+# published to MQTT. Gateways with gateway.TRACE_LATENCY set add a "Trace"
+# object to their records:
+#
+#   "Trace": {"Bike": ..., "Air": ..., "Rx": ..., "Tx": ...}
+#
+# with the age of the oldest sample when the bike transmitted, the time on
+# air of the LoRa packet (both in ms), and the gateway's ticks_ms when it
+# received the packet and when the record was ready for the server socket.
+# The server strips it before publishing and adds its own timestamps,
+# giving these stages:
+#
+#   Bike     oldest sample to LoRa transmit, on the bike
+#   Air      LoRa time on air
+#   Gateway  LoRa receive to the record ready for the socket, on the gateway
+#   TCP      from there to server receive, above the fastest seen on the
+#            connection: the gateway and server clocks aren't synchronized,
+#            so this is the extra delay of the gateway's TX queue and the
+#            network, not the absolute one
+#   Ingest   server receive to the publisher queue
+#   Publish  publisher queue to the MQTT client
+#   Total    the sum of the above
+
+STAGES = ("Bike", "Air", "Gateway", "TCP", "Ingest", "Publish", "Total")
+LATENCY_SAMPLES = 10000
+
+# A jump in the gateway's clock offset larger than this (ticks wrapped
+# around, or the gateway restarted) starts the TCP stage over.
+RESYNC_MS = 3600 * 1000
+
+# the gateways' ticks_ms wrap around
+TICKS_PERIOD = 1 << 30
+
+
+class LatencyTracker:
+    """The last LATENCY_SAMPLES latencies of every stage, in ms."""
+
+    def __init__(self, samples=LATENCY_SAMPLES):
+        self._lock = threading.Lock()
+        self._stages = dict((stage, collections.deque(maxlen=samples)) for stage in STAGES)
+
+    def add(self, stage, ms):
+        # called from the ingest loop and the publisher thread
+        with self._lock:
+            self._stages[stage].append(ms)
+
+    def gateway_delay(self, rx_ticks, tx_ticks):
+        """Gateway stage, both in the gateway's ticks."""
+        return (tx_ticks - rx_ticks) % TICKS_PERIOD
+
+    def tcp_delay(self, state, tx_ticks, received_ms):
+        """TCP stage of a record received at received_ms (server clock)
+        that the gateway had ready at tx_ticks (its clock). state is a one
+        item list kept per gateway connection with the smallest offset seen."""
+        offset = received_ms - tx_ticks
+        if state[0] is None or offset < state[0] or offset - state[0] > RESYNC_MS:
+            state[0] = offset
+        return offset - state[0]
+
+    def stats(self):
+        stats = {}
+        with self._lock:
+            stages = [(stage, list(self._stages[stage])) for stage in STAGES]
+        for stage, samples in stages:
+            if not samples:
+                continue
+            stats[stage] = {"Count": len(samples),
+                            "P50Ms": round(percentile(samples, 50), 3),
+                            "P95Ms": round(percentile(samples, 95), 3),
+                            "P99Ms": round(percentile(samples, 99), 3),
+                            "MaxMs": round(max(samples), 3)}
+        return stats
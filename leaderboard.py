@@ -0,0 +1,204 @@
+import bisect
+import collections
+import json
+import time
+
+import kinematics
+from publisher import rank_index
+
+# Leaderboards of the rides of every event, kept up to date record by
+# record instead of being worked out again from the MQTT records by every
+# consumer. A ride is followed from its first counting record to its
+# finished one:
+#
+#   time      from the start of the ride to the crank pulse that took the
+#             rider past the finish, the first RideInfo entry of the bike's
+#             finish report and the first one with its final CrankCounter
+#             (see frame.py). Both are in the CounterTimestamp ms of the
+#             gateway that forwarded the report, so neither the TDMA slot
+#             the report waits for, nor its retries, nor the delays up to
+#             the server count. Older bikes don't send the start: their
+#             rides are timed from the first RideInfo entry of the ride if
+#             the same gateway forwarded it, and not at all (Untimed) if
+#             another did, the gateways' clocks having nothing in common.
+#   speed     the distance of the crank pulses counted over that time, in
+#             the units of the bikes' LCD (see kinematics.py)
+#
+# The finished rides of an event are kept sorted by time and by speed
+# (bisect), so a new one costs a binary search and the top N and the
+# percentiles are read off directly. Rides in progress are forgotten when
+# they finish or are aborted, or after RIDE_TIMEOUT_S without a record, and
+# at most MAX_RIDES of them are kept.
+#
+# Every period_s the leaderboard of each event that changed is published on
+# its own topic:
+#
+#   {"EventID": ..., "Finished": ..., "Riding": ...,
+#    "Top": [{"Rank": 1, "RiderName": ..., "Company": ..., "BikeID": ...,
+#             "TimeMs": ..., "Speed": ...}, ...],
+#    "TimeMs": {"P50": ..., "P90": ...}, "Speed": {"P50": ..., "P90": ...}}
+
+TOP_N = 10
+PERIOD_S = 5
+RIDE_TIMEOUT_S = 3600
+MAX_RIDES = 1000
+PERCENTILES = (50, 90)
+
+# CounterTimestamps are the gateways' ticks_ms, which wrap around
+TICKS_PERIOD = 1 << 30
+
+
+class Ride:
+    __slots__ = ('event', 'name', 'company', 'bike', 'source', 'first_ms',
+                 'first_crank', 'last_seen')
+
+    def __init__(self, event, name, company, bike, source, first, now):
+        self.event = event
+        self.name = name
+        self.company = company
+        self.bike = bike
+        self.source = source
+        self.first_ms = int(first[0])
+        self.first_crank = first[1]
+        self.last_seen = now
+
+
+class EventBoard:
+    """The finished rides of one event."""
+
+    def __init__(self):
+        self.times = []         # sorted (time ms, seq, ride summary)
+        self.speeds = []        # sorted speeds
+        self.riding = 0
+        self.changed = False
+        self._seq = 0
+
+    def add(self, time_ms, speed, summary):
+        self._seq += 1
+        bisect.insort(self.times, (time_ms, self._seq, summary))
+        bisect.insort(self.speeds, speed)
+        self.changed = True
+
+    def summary(self, event_id, top_n=TOP_N):
+        top = []
+        for rank, (time_ms, seq, ride) in enumerate(self.times[:top_n]):
+            entry = dict(ride)
+            entry["Rank"] = rank + 1
+            top.append(entry)
+        times = {}
+        speeds = {}
+        count = len(self.times)
+        for pct in PERCENTILES:
+            name = "P%d" % pct
+            times[name] = self.times[rank_index(count, pct)][0] if count else None
+            speeds[name] = self.speeds[rank_index(count, pct)] if count else None
+        return {"EventID": event_id, "Finished": count, "Riding": self.riding,
+                "Top": top, "TimeMs": times, "Speed": speeds}
+
+
+class Leaderboard:
+    """Fed with every record published, from the ingest loop."""
+
+    def __init__(self, period_s=PERIOD_S, top_n=TOP_N, max_rides=MAX_RIDES,
+                 clock=time.monotonic):
+        self.period_s = period_s
+        self.top_n = top_n
+        self.max_rides = max_rides
+        self.clock = clock
+        self.events = {}        # EventID -> EventBoard
+        self._rides = collections.OrderedDict()   # (BikeID, RideTimestamp) -> Ride
+        self._next_publish = None
+        # statistics
+        self.finished = 0
+        self.aborted = 0
+        self.evicted = 0
+        self.untimed = 0
+
+    def update(self, source, bike_id, ride_timestamp, status, event_id, name, company,
+               first, last):
+        """A record of a ride, first and last are (CounterTimestamp,
+        CrankCounter) of its first RideInfo entry and of the first one with
+        its final CrankCounter, source the gateway that forwarded it."""
+        now = self.clock()
+        key = (bike_id, ride_timestamp)
+        ride = self._rides.get(key)
+        if ride is None:
+            if status != "counting" or first is None:
+                # the countdown doesn't count, nor a finish without its
+                # ride or repeated after it
+                return
+            ride = Ride(event_id, name, company, bike_id, source, first, now)
+            self._rides[key] = ride
+            board = self._board(event_id)
+            board.riding += 1
+            board.changed = True
+            self._evict(now)
+        else:
+            ride.last_seen = now
+            self._rides.move_to_end(key)
+        if status == "finished" and last is not None:
+            self._finish(key, ride, source, first, last)
+        elif status == "aborted":
+            self.aborted += 1
+            self._forget(key)
+
+    def _finish(self, key, ride, source, first, last):
+        if first[1] == 0:
+            # the start of the ride, the counters are reset then
+            start_ms, start_crank = int(first[0]), 0
+        elif source is ride.source:
+            start_ms, start_crank = ride.first_ms, ride.first_crank
+        else:
+            self.untimed += 1
+            self._forget(key)
+            return
+        time_ms = (int(last[0]) - start_ms) % TICKS_PERIOD
+        distance_mm = kinematics.distance_mm((last[1] - start_crank) & 0xFFFF)
+        speed = round(distance_mm / float(time_ms), 2) if time_ms else 0
+        board = self._board(ride.event)
+        board.add(time_ms, speed, {"RiderName": ride.name, "Company": ride.company,
+                                   "BikeID": ride.bike, "TimeMs": time_ms, "Speed": speed})
+        self.finished += 1
+        self._forget(key)
+
+    def _forget(self, key):
+        ride = self._rides.pop(key)
+        board = self._board(ride.event)
+        board.riding -= 1
+        board.changed = True
+
+    def _evict(self, now):
+        rides = self._rides
+        while rides:
+            key, ride = next(iter(rides.items()))
+            if now - ride.last_seen < RIDE_TIMEOUT_S and len(rides) <= self.max_rides:
+                break
+            self.evicted += 1
+            self._forget(key)
+
+    def _board(self, event_id):
+        board = self.events.get(event_id)
+        if board is None:
+            board = self.events[event_id] = EventBoard()
+        return board
+
+    def due(self):
+        """The leaderboards to publish now, as JSON texts, if it's time."""
+        now = self.clock()
+        if self._next_publish is None:
+            self._next_publish = now + self.period_s
+        if now < self._next_publish:
+            return []
+        self._next_publish = now + self.period_s
+        self._evict(now)
+        out = []
+        for event_id, board in self.events.items():
+            if board.changed:
+                board.changed = False
+                out.append(json.dumps(board.summary(event_id, self.top_n)))
+        return out
+
+    def stats(self):
+        return {"Events": len(self.events), "Riding": len(self._rides),
+                "Finished": self.finished, "Aborted": self.aborted, "Evicted": self.evicted,
+                "Untimed": self.untimed}
@@ -0,0 +1,48 @@
+try:
+    from micropython import const
+except ImportError:
+    def const(x):
+        return x
+
+# Log level gate for the debug output of the bikes and gateways. Messages
+# below level are not printed, hot paths should test enabled() before
+# building the message so that nothing is allocated when it's off:
+#
+#   if log.enabled(log.DEBUG):
+#       print("Crank: " + str(crank.counter))
+
+DEBUG = const(10)
+INFO = const(20)
+WARNING = const(30)
+ERROR = const(40)
+
+level = INFO
+
+
+def set_level(new_level):
+    global level
+    level = new_level
+
+
+def enabled(msg_level):
+    return msg_level >= level
+
+
+def debug(msg):
+    if level <= DEBUG:
+        print(msg)
+
+
+def info(msg):
+    if level <= INFO:
+        print(msg)
+
+
+def warning(msg):
+    if level <= WARNING:
+        print(msg)
+
+
+def error(msg):
+    if level <= ERROR:
+        print(msg)
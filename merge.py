@@ -0,0 +1,140 @@
+import collections
+import time
+
+# Merge of the records forwarded by several gateways. Where the gateways'
+# coverage overlaps the same LoRa packet of a bike is heard and forwarded by
+# more than one of them, and a gateway replaying its backlog forwards
+# records that are older than what another gateway already sent. Before a
+# record is published:
+#
+#   - copies of a record already published are dropped. A record is
+#     identified by (BikeID, RideTimestamp, RideStatus, CrankCounter of
+#     its last RideInfo entry), which is the same whichever gateway heard
+#     it; the first copy to arrive is published. Keys are remembered for
+#     SEEN_WINDOW_S, at most SEEN_MAX of them.
+#   - a record whose RideStatus goes back (counting after finished, say)
+#     is dropped, the ride's status only moves forward. So is one with the
+#     same RideStatus but a CrankCounter that isn't past the last one
+#     published, a counting record that arrives late from a gateway's
+#     backlog say: the published distance never goes back either. Rides
+#     are remembered for RIDE_TTL_S after their last record.
+#
+# It also keeps, per bike, which gateway hears it best: the share of the
+# bike's records each gateway forwarded, averaged over the last few
+# (RECEPTION_WEIGHT). The server sends the bike's commands there.
+
+SEEN_WINDOW_S = 60
+SEEN_MAX = 20000
+RIDE_TTL_S = 3600
+RECEPTION_WEIGHT = 0.1
+
+# finished and aborted both end the ride
+STATUS_RANK = {"started": 0, "counting": 1, "finished": 2, "aborted": 2}
+
+# the bikes' CrankCounter is 16 bits and wraps around
+CRANK_MASK = 0xFFFF
+
+
+class RecordMerger:
+    """Decides which of the records received from the gateways are
+    published, see above. Gateways are any hashable objects."""
+
+    def __init__(self, window_s=SEEN_WINDOW_S, max_seen=SEEN_MAX,
+                 ride_ttl_s=RIDE_TTL_S, clock=time.monotonic):
+        self.window_s = window_s
+        self.max_seen = max_seen
+        self.ride_ttl_s = ride_ttl_s
+        self.clock = clock
+        self._seen = collections.OrderedDict()     # key -> time first seen
+        self._rides = collections.OrderedDict()    # (BikeID, RideTimestamp) -> [rank, crank, time]
+        self._reception = {}                       # BikeID -> {gateway: score}
+        # statistics
+        self.accepted = 0
+        self.duplicates = 0
+        self.regressions = 0
+        self.stale = 0
+
+    def accept(self, gateway, bike_id, ride_timestamp, status, crank):
+        """True if the record is to be published, False if it is a copy of
+        one published already or goes back in status or crank count."""
+        now = self.clock()
+        self._evict(now)
+        key = (bike_id, ride_timestamp, status, crank)
+        if key in self._seen:
+            self.duplicates += 1
+            self._heard(bike_id, gateway, False)
+            return False
+        self._seen[key] = now
+        self._heard(bike_id, gateway, True)
+        ride_key = (bike_id, ride_timestamp)
+        rank = STATUS_RANK.get(status, 0)
+        ride = self._rides.pop(ride_key, None)
+        if ride is None:
+            ride = [rank, crank, now]
+        elif rank < ride[0]:
+            self._rides[ride_key] = ride
+            self.regressions += 1
+            return False
+        elif rank == ride[0] and not _newer(crank, ride[1]):
+            self._rides[ride_key] = ride
+            self.stale += 1
+            return False
+        ride[0] = rank
+        if crank is not None:
+            ride[1] = crank
+        ride[2] = now
+        # most recently updated last, for _evict()
+        self._rides[ride_key] = ride
+        self.accepted += 1
+        return True
+
+    def best_gateway(self, bike_id):
+        """The gateway that forwards most of the bike's records, None if no
+        gateway did."""
+        scores = self._reception.get(bike_id)
+        if not scores:
+            return None
+        return max(scores, key=scores.get)
+
+    def forget_gateway(self, gateway):
+        for scores in self._reception.values():
+            scores.pop(gateway, None)
+
+    def reception(self):
+        """{BikeID: {gateway: share of the bike's records forwarded}}"""
+        return dict((bike_id, dict((str(g), round(score, 3)) for g, score in scores.items()))
+                    for bike_id, scores in self._reception.items())
+
+    def stats(self):
+        return {"Accepted": self.accepted, "Duplicates": self.duplicates,
+                "Regressions": self.regressions, "Stale": self.stale, "Seen": len(self._seen),
+                "Rides": len(self._rides)}
+
+    def _heard(self, bike_id, gateway, first):
+        scores = self._reception.setdefault(bike_id, {})
+        if first:
+            # a new record: every gateway that doesn't forward it loses out
+            for g in scores:
+                scores[g] *= 1 - RECEPTION_WEIGHT
+        scores[gateway] = scores.get(gateway, 0.0) + RECEPTION_WEIGHT
+
+    def _evict(self, now):
+        seen = self._seen
+        while seen:
+            key, first_seen = next(iter(seen.items()))
+            if now - first_seen < self.window_s and len(seen) < self.max_seen:
+                break
+            del seen[key]
+        rides = self._rides
+        while rides:
+            key, ride = next(iter(rides.items()))
+            if now - ride[2] < self.ride_ttl_s:
+                break
+            del rides[key]
+
+
+def _newer(crank, last):
+    # records without a RideInfo entry have no crank to go by
+    if crank is None or last is None:
+        return True
+    return 0 < (crank - last) & CRANK_MASK <= CRANK_MASK // 2
@@ -0,0 +1,83 @@
+# Counters and gauges of the gateway and the server, cheap enough for the
+# hot paths: a counter is a dict entry holding a small int, so counting
+# doesn't allocate on MicroPython. The gateway sends its counters and
+# gauges with its health records (see gateway.py), the server adds them to
+# its own and serves them all as text (see server.py).
+#
+#   metrics.inc('lora_rx_uplink')
+#   metrics.set('tx_queue', len(self.tx_queue))
+#
+# Names end with their unit where they have one (_bytes, _ms), the other
+# counters count events. Counters only go up, until the device restarts.
+
+
+class Registry:
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+
+    def inc(self, name, n=1):
+        counters = self.counters
+        counters[name] = counters.get(name, 0) + n
+
+    def set(self, name, value):
+        self.gauges[name] = value
+
+
+class Rates:
+    """Per second rates of counters, from successive snapshots of them."""
+
+    def __init__(self):
+        self._last = None
+        self._last_s = 0
+        self.rates = {}
+
+    def update(self, counters, now_s):
+        last = self._last
+        if last is not None and now_s > self._last_s:
+            elapsed = now_s - self._last_s
+            rates = {}
+            for name, value in counters.items():
+                # a counter that went down was reset by a restart
+                if isinstance(value, int) and value >= last.get(name, 0):
+                    rates[name] = round((value - last.get(name, 0)) / elapsed, 3)
+            self.rates = rates
+        self._last = dict(counters)
+        self._last_s = now_s
+        return self.rates
+
+
+def snake(name):
+    """HighWater -> high_water, LatencyP50Ms -> latency_p50_ms"""
+    out = []
+    for i, c in enumerate(name):
+        if c.isupper() and i and (name[i - 1].islower() or name[i - 1].isdigit()):
+            out.append('_')
+        out.append(c.lower())
+    return ''.join(out)
+
+
+def prefixed(prefix, values, suffix=''):
+    """values with their names made metric names, the statistics dicts of
+    the server's modules use CamelCase."""
+    return dict((prefix + snake(name) + suffix, value) for name, value in values.items())
+
+
+def text(sections):
+    """Metrics in the Prometheus text format. sections is a list of
+    (labels, values): labels a dict, values a dict of name -> number.
+    Values that aren't numbers are left out, the lines of a name are kept
+    together."""
+    lines = []
+    for labels, values in sections:
+        label = ''
+        if labels:
+            label = '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                   for k, v in sorted(labels.items())) + '}'
+        for name, value in values.items():
+            if isinstance(value, bool):
+                value = int(value)
+            if isinstance(value, (int, float)):
+                lines.append((name, len(lines), '{}{} {}'.format(name, label, value)))
+    lines.sort()
+    return ''.join(line + '\n' for name, n, line in lines)
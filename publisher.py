@@ -0,0 +1,162 @@
+import collections
+import threading
+import time
+
+# Decouples the TCP ingest loop in server.py from the MQTT broker: records
+# are put in a bounded queue and published from a worker thread, so a slow
+# broker round trip no longer holds up reading from the gateways.
+
+QUEUE_SIZE = 10000
+BATCH_SIZE = 100
+LATENCY_SAMPLES = 10000
+
+
+def rank_index(count, pct):
+    """Index of the nearest rank pct percentile in a sorted list of count
+    items: the first item with at least pct% of the items up to it."""
+    return max(int(-(-pct * count // 100)) - 1, 0)
+
+
+def percentile(samples, pct):
+    """Nearest rank percentile of a list of numbers, None if it is empty."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[rank_index(len(ordered), pct)]
+
+
+class Publisher:
+    """Bounded producer/consumer queue in front of an MQTT client.
+
+    client is anything with a paho style publish(topic, payload, qos=...)
+    method. Records published to one of coalesce_topics are coalesced: of
+    the records waiting in the queue with the same (topic, key) only the
+    latest is published. When the queue is full the oldest record is
+    dropped, or publish() blocks for up to block_timeout seconds if set.
+    Traced records (see latency.py) add their Publish and Total latencies
+    to tracker.
+    """
+
+    def __init__(self, client, maxsize=QUEUE_SIZE, batch_size=BATCH_SIZE,
+                 coalesce_topics=(), block_timeout=None, tracker=None):
+        self.client = client
+        self.tracker = tracker
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.coalesce_topics = set(coalesce_topics)
+        self.block_timeout = block_timeout
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+        # statistics
+        self.enqueued = 0
+        self.published = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.batches = 0
+        self.high_water = 0
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+
+    def publish(self, topic, payload, qos=0, key=None, trace=None):
+        """Queue a record for publishing, returns False if it was dropped.
+        trace is (time.monotonic() the record was received, ms it took to
+        get there) for traced records."""
+        with self._cond:
+            if len(self._queue) >= self.maxsize and self.block_timeout:
+                self._cond.wait_for(lambda: len(self._queue) < self.maxsize, self.block_timeout)
+            dropped = len(self._queue) >= self.maxsize
+            if dropped:
+                self._queue.popleft()
+                self.dropped += 1
+            self._queue.append((topic, payload, qos, key, time.monotonic(), trace))
+            self.enqueued += 1
+            if len(self._queue) > self.high_water:
+                self.high_water = len(self._queue)
+            self._cond.notify_all()
+        return not dropped
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="mqtt-publisher", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Publish what is left in the queue and stop the worker."""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def depth(self):
+        return len(self._queue)
+
+    def _take_batch(self):
+        with self._cond:
+            while self._running and not self._queue:
+                self._cond.wait()
+            batch = []
+            while self._queue and len(batch) < self.batch_size:
+                batch.append(self._queue.popleft())
+            # wake up producers blocked on a full queue
+            self._cond.notify_all()
+        return batch
+
+    def _coalesce(self, batch):
+        latest = {}
+        for i, (topic, payload, qos, key, queued_at, trace) in enumerate(batch):
+            if topic in self.coalesce_topics:
+                latest[(topic, key)] = i
+        if not latest:
+            return batch
+        out = []
+        for i, item in enumerate(batch):
+            topic, key = item[0], item[3]
+            if topic in self.coalesce_topics and latest[(topic, key)] != i:
+                self.coalesced += 1
+                continue
+            out.append(item)
+        return out
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                if not self._running:
+                    return
+                continue
+            self._publish(batch)
+
+    def flush(self):
+        """Publish everything queued from the calling thread, for use
+        without the worker (benchmarks, the simulation)."""
+        while self._queue:
+            self._publish(self._take_batch())
+
+    def _publish(self, batch):
+        latencies = []
+        for topic, payload, qos, key, queued_at, trace in self._coalesce(batch):
+            self.client.publish(topic, payload, qos=qos)
+            now = time.monotonic()
+            latencies.append(now - queued_at)
+            if trace and self.tracker:
+                received_at, before_ms = trace
+                self.tracker.add("Publish", (now - queued_at) * 1000)
+                self.tracker.add("Total", before_ms + (now - received_at) * 1000)
+        with self._cond:
+            self.published += len(latencies)
+            self.latencies.extend(latencies)
+            self.batches += 1
+
+    def stats(self):
+        with self._cond:
+            latencies = list(self.latencies)
+        p50 = percentile(latencies, 50)
+        p99 = percentile(latencies, 99)
+        return {"Depth": len(self._queue), "HighWater": self.high_water,
+                "Enqueued": self.enqueued, "Published": self.published,
+                "Dropped": self.dropped, "Coalesced": self.coalesced,
+                "Batches": self.batches,
+                "LatencyP50Ms": None if p50 is None else round(p50 * 1000, 3),
+                "LatencyP99Ms": None if p99 is None else round(p99 * 1000, 3)}
@@ -0,0 +1,93 @@
+import json
+
+try:
+    from micropython import const
+except ImportError:
+    def const(x):
+        return x
+
+# Ride records forwarded by the gateway to the server, one JSON object per
+# line:
+#
+#   {"RiderName": ..., "Company": ..., "BadgeNumber": ..., "EventID": ...,
+#    "RideTimestamp": "...", "BikeID": ..., "RideStatus": "...",
+#    "RideInfo": [{"CounterTimestamp": ..., "CrankCounter": ...,
+#                  "WheelCounter": ...}, ...]}
+#
+# Everything up to RideStatus is the same for every record of a ride and is
+# serialized once when the ride starts (record_prefix()). RecordWriter adds
+# the status and a RideInfo entry per sample, formatted from a template,
+# into a buffer it reuses for every record. This replaces building a dict
+# and running json.dumps() for every LoRa packet. Records may end with the
+# latency trace described in latency.py.
+
+RECORD_SIZE = const(2048)
+
+# RideStatus values, ready to be written out
+STATUS_BYTES = {'started': b'started', 'counting': b'counting',
+                'finished': b'finished', 'aborted': b'aborted'}
+
+_STATUS_START = b', "RideStatus": "'
+_INFO_START = b'", "RideInfo": ['
+_ENTRY = b'{"CounterTimestamp": %d.0, "CrankCounter": %d, "WheelCounter": %d}'
+_ENTRY_SEP = b', '
+_RECORD_END = b']}\n'
+_TRACE_END = b'], "Trace": {"Bike": %d, "Air": %d, "Rx": %d, "Tx": %d}}\n'
+
+
+def timestamp_text(ride_timestamp):
+    # the server sends it as a string, which is passed on as is: single
+    # precision floats (the LoPy's) can't hold it to the second
+    if isinstance(ride_timestamp, str):
+        return ride_timestamp
+    return '{:f}'.format(ride_timestamp)
+
+
+def record_prefix(name, company, badge, event_id, ride_timestamp, bike_id):
+    """The constant part of the records of a ride, as bytes."""
+    return ('{"RiderName": ' + json.dumps(name) +
+            ', "Company": ' + json.dumps(company) +
+            ', "BadgeNumber": ' + json.dumps(badge) +
+            ', "EventID": ' + json.dumps(event_id) +
+            ', "RideTimestamp": "' + timestamp_text(ride_timestamp) +
+            '", "BikeID": ' + json.dumps(bike_id)).encode() + _STATUS_START
+
+
+class RecordWriter:
+    def __init__(self, size=RECORD_SIZE):
+        self.buf = bytearray(size)
+        self._mv = memoryview(self.buf)
+        self.n = 0
+        self._entries = 0
+
+    def begin(self, prefix, status):
+        """Start a record from the prefix of the ride, status as bytes."""
+        self.n = 0
+        self._entries = 0
+        self._put(prefix)
+        self._put(status)
+        self._put(_INFO_START)
+
+    def add_info(self, timestamp_ms, crank, wheel):
+        if self._entries:
+            self._put(_ENTRY_SEP)
+        self._entries += 1
+        self._put(_ENTRY % (timestamp_ms, crank, wheel))
+
+    def end(self, trace=None):
+        """Finish the record, returns it as a view valid until the next begin().
+        trace is (bike ms, air ms, rx ticks, tx ticks) for latency.py, if set."""
+        self._put(_RECORD_END if trace is None else _TRACE_END % trace)
+        return self._mv[:self.n]
+
+    def _reserve(self, length):
+        if self.n + length > len(self.buf):
+            # more RideInfo entries than the buffer was sized for
+            self.buf = self.buf[:self.n] + bytearray(max(len(self.buf), length))
+            self._mv = memoryview(self.buf)
+
+    def _put(self, data):
+        length = len(data)
+        self._reserve(length)
+        self.buf[self.n:self.n + length] = data
+        self.n += length
@@ -0,0 +1,146 @@
+import time
+import machine
+
+try:
+    from micropython import const
+except ImportError:
+    def const(x):
+        return x
+
+import frame
+
+# Acknowledged delivery of the few LoRa frames that matter, shared by
+# rider.py and gateway.py. Routine telemetry is still sent once, a lost one
+# is made up for by the next. The start and abort commands from the gateway
+# and the finished, idle and aborted reports from the bikes carry a sequence
+# number (see frame.py) and are sent again until they are acknowledged:
+#
+#   - the bikes acknowledge CMD_START with their started or running report,
+#     and CMD_ABORT with their aborted, finished or idle report,
+#   - the gateway acknowledges the reports with CMD_ACK, and only forwards
+#     the first copy of each (bike, sequence number).
+#
+# Retransmissions back off exponentially and never come sooner than the
+# LoRa duty cycle allows after the previous one, so that a bike out of range
+# doesn't flood the channel with repeats. A random part of up to half the
+# backoff is added, so that devices retrying at the same time (gateways
+# with overlapping coverage sending the same start command) drift apart
+# instead of colliding again and again.
+
+RETRY_BASE_MS = const(2500)     # one TDMA frame
+RETRY_MAX_MS = const(30000)
+MAX_ATTEMPTS = const(5)         # transmissions, the first one included
+# 1% duty cycle, a transmission is followed by 99 times its airtime off air
+DUTY_CYCLE_OFF = const(99)
+
+# bike reports that are sent reliably
+RELIABLE_STATUS = (frame.STATUS_FINISHED, frame.STATUS_IDLE, frame.STATUS_ABORTED)
+
+# sequence numbers remembered per bike to drop retransmitted copies
+DEDUP_DEPTH = const(8)
+
+
+def acknowledges(cmd, status):
+    """True if a bike sending status shows that it got command cmd."""
+    if cmd == frame.CMD_START:
+        return status == frame.STATUS_STARTED or status == frame.STATUS_RUNNING
+    if cmd == frame.CMD_ABORT:
+        return status in RELIABLE_STATUS
+    return False
+
+
+class Retransmitter:
+    """Messages waiting for an acknowledgement, by key. The messages are
+    opaque, callers re-encode them when they are due so that timestamps and
+    phases are up to date.
+    """
+
+    def __init__(self, base_ms=RETRY_BASE_MS, max_ms=RETRY_MAX_MS, max_attempts=MAX_ATTEMPTS):
+        self.base_ms = base_ms
+        self.max_ms = max_ms
+        self.max_attempts = max_attempts
+        # key -> [message, attempts, due ticks, backoff ms]
+        self._pending = {}
+        self.retries = 0
+        self.acked = 0
+        self.failed = 0     # given up on after max_attempts
+
+    def sent(self, key, message, now, airtime_ms):
+        """Track message, just sent for the first time."""
+        backoff = self.base_ms
+        self._pending[key] = [message, 1, self._due(now, backoff, airtime_ms), backoff]
+
+    def resent(self, key, now, airtime_ms):
+        entry = self._pending[key]
+        entry[1] += 1
+        entry[3] = min(entry[3] * 2, self.max_ms)
+        entry[2] = self._due(now, entry[3], airtime_ms)
+        self.retries += 1
+
+    def _due(self, now, backoff, airtime_ms):
+        backoff += machine.rng() % (backoff // 2 + 1)
+        return time.ticks_add(now, max(backoff, airtime_ms * DUTY_CYCLE_OFF))
+
+    def ack(self, key):
+        """Returns the message acknowledged, None if it wasn't pending."""
+        entry = self._pending.pop(key, None)
+        if entry is None:
+            return None
+        self.acked += 1
+        return entry[0]
+
+    def get(self, key):
+        entry = self._pending.get(key)
+        return entry[0] if entry else None
+
+    def due(self, now):
+        """Returns (key, message) of a message to send again now, or None.
+        Messages sent max_attempts times are dropped and counted in failed.
+        """
+        for key, entry in self._pending.items():
+            if time.ticks_diff(now, entry[2]) < 0:
+                continue
+            if entry[1] >= self.max_attempts:
+                del self._pending[key]
+                self.failed += 1
+                print('No acknowledgement for {}, giving up'.format(key))
+                # the dict changed, look again next time
+                return None
+            return key, entry[0]
+        return None
+
+    def pending(self):
+        return len(self._pending)
+
+    def clear(self):
+        self._pending = {}
+
+
+class Deduplicator:
+    """Remembers the last DEDUP_DEPTH sequence numbers of every bike."""
+
+    def __init__(self, depth=DEDUP_DEPTH):
+        self.depth = depth
+        self._seen = {}     # bike id -> [bytearray of seqs, count, next index]
+        self.duplicates = 0
+
+    def seen(self, bike_id, seq):
+        """True if (bike_id, seq) was seen before, records it otherwise."""
+        entry = self._seen.get(bike_id)
+        if entry is None:
+            entry = [bytearray(self.depth), 0, 0]
+            self._seen[bike_id] = entry
+        seqs = entry[0]
+        for i in range(entry[1]):
+            if seqs[i] == seq:
+                self.duplicates += 1
+                return True
+        seqs[entry[2]] = seq
+        entry[2] = (entry[2] + 1) % self.depth
+        if entry[1] < self.depth:
+            entry[1] += 1
+        return False
+
+    def forget(self, bike_id):
+        """Drop what is known of bike_id, when it may have restarted."""
+        self._seen.pop(bike_id, None)
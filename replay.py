@@ -0,0 +1,303 @@
+import argparse
+import contextlib
+import json
+import os
+import socket
+import time
+
+import server
+import wire
+from capture import CaptureReader, OPEN, DATA, CLOSE, COMMAND
+from framing import LineFramer
+from publisher import Publisher, percentile
+from sim.mqtt import NullClient
+
+# Replays a capture recorded by server.py (CAPTURE_PATH, see capture.py)
+# to size the server before an event: every gateway connection of the
+# capture is opened again and sent what it sent then, all of them over
+# their own sockets at the same time, and the dashboard's commands are
+# handed to server.on_message() as the MQTT thread would.
+#
+# By default the records go through an IngestServer running in this
+# process, publishing to a client that only counts them. It is polled
+# between the records, and its merge, coalescing and leaderboard windows
+# run on the capture's time rather than the wall clock, so that it
+# publishes the same records whatever the speed. --server sends the
+# streams to a server running elsewhere instead, without the commands.
+#
+#   $ python3 replay.py event.cap                # as fast as it was recorded
+#   $ python3 replay.py event.cap --speed 10     # ten times as fast
+#   $ python3 replay.py event.cap --speed 0      # as fast as possible
+#   $ python3 replay.py event.cap --start 600 --duration 60
+#
+# --start seeks through the capture's index. The binary records of a
+# gateway refer to rides it defined once on its connection (see wire.py),
+# so the ride definitions sent before the start are sent first, without
+# being timed or counted.
+#
+# It reports the throughput and how far the replay fell behind the
+# capture's timing (lag), and for the server in this process what it
+# published and how long it took to catch up after the last record.
+
+POLL_S = 0.05
+DRAIN_TIMEOUT_S = 60
+
+
+class ReplayClock:
+    """The capture's time in seconds, for the clocks of the IngestServer."""
+
+    def __init__(self, ms=0):
+        self.ms = ms
+
+    def __call__(self):
+        return self.ms / 1000.0
+
+
+class Message:
+    """What server.on_message() needs of a paho message."""
+
+    def __init__(self, payload):
+        self.topic = server.TOPIC
+        self.payload = payload
+
+
+class Replayer:
+    def __init__(self, reader, address, speed=1.0, ingest=None):
+        self.reader = reader
+        self.address = address
+        self.speed = speed
+        self.ingest = ingest
+        self.clock = ReplayClock()
+        if ingest:
+            ingest.merger.clock = ingest.coalescer.clock = self.clock
+            ingest.leaderboard.clock = ingest.clock = self.clock
+        self.socks = {}         # stream -> socket
+        self.closing = []       # sockets the server is still reading
+        self.lags = []
+        self.chunks = 0
+        self.bytes = 0
+        self.sent = 0           # bytes, the ride definitions of prime() too
+        self.commands = 0
+        self.streams = 0
+
+    def run(self, start_ms=0, end_ms=None):
+        """Replay from start_ms to end_ms of the capture, returns the wall
+        time it took."""
+        self.clock.ms = start_ms
+        if start_ms:
+            self.prime(start_ms)
+        first = None
+        started = time.monotonic()
+        for ms, stream, kind, data in self.reader.records(start_ms):
+            if end_ms is not None and ms > end_ms:
+                break
+            if first is None:
+                first = ms
+            if self.speed:
+                due = started + (ms - first) / 1000.0 / self.speed
+                self.wait(due, first, started)
+            self.clock.ms = ms
+            if kind == DATA:
+                sock = self.socks.get(stream) or self.connect(stream)
+                self.send(sock, data)
+                self.chunks += 1
+                self.bytes += len(data)
+                self.serve()
+            elif kind == OPEN:
+                self.connect(stream)
+            elif kind == CLOSE:
+                self.disconnect(stream)
+            elif kind == COMMAND and self.ingest:
+                server.on_message(None, self.ingest, Message(bytes(data)))
+                self.ingest.poll(0)
+                self.commands += 1
+            del data
+            if self.speed:
+                self.lags.append((time.monotonic() - due) * 1000)
+            self.drain()
+        return time.monotonic() - started
+
+    def prime(self, start_ms):
+        """Open the connections open at start_ms and send the rides they
+        defined before it."""
+        framers = {}
+        rides = {}      # stream -> {ride id: REC_RIDE}
+        for ms, stream, kind, data in self.reader.records():
+            if ms >= start_ms:
+                break
+            if kind == OPEN:
+                framers[stream] = LineFramer(server.RX_BUFFER_SIZE, binary=True)
+                rides[stream] = {}
+            elif kind == CLOSE:
+                framers.pop(stream, None)
+                rides.pop(stream, None)
+            elif kind == DATA and stream in framers:
+                framer = framers[stream]
+                while len(data):
+                    n = framer.feed(data)
+                    data = data[n:]
+                    for record in framer.records():
+                        if record[0] == wire.REC_RIDE:
+                            rides[stream][record[wire.HEADER_SIZE]] = bytes(record)
+            del data
+        for stream, defined in rides.items():
+            sock = self.connect(stream)
+            for record in defined.values():
+                self.send(sock, record)
+        self.serve()
+
+    def send(self, sock, data):
+        sock.sendall(data)
+        self.sent += len(data)
+
+    def wait(self, due, first, started):
+        """Sleep until due, the server in this process keeps running."""
+        while True:
+            wait = due - time.monotonic()
+            if wait <= 0:
+                return
+            if not self.ingest:
+                time.sleep(wait)
+                return
+            self.clock.ms = first + int((time.monotonic() - started) * 1000 * self.speed)
+            self.ingest.poll(min(wait, POLL_S))
+
+    def serve(self, timeout=DRAIN_TIMEOUT_S):
+        """Run the server in this process until it has read and processed
+        everything sent so far, at the time of the record just sent."""
+        if not self.ingest:
+            return
+        counters = self.ingest.metrics.counters
+        deadline = time.monotonic() + timeout
+        while counters.get("rx_bytes", 0) < self.sent and time.monotonic() < deadline:
+            self.ingest.poll(POLL_S)
+
+    def connect(self, stream):
+        # a stream cut by --start is opened on its first data
+        self.disconnect(stream)
+        sock = socket.create_connection(self.address)
+        self.socks[stream] = sock
+        self.streams += 1
+        return sock
+
+    def disconnect(self, stream):
+        # only the sending side is shut down: a server writing to a closed
+        # socket gets a broken pipe and drops what it hasn't read yet
+        sock = self.socks.pop(stream, None)
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_WR)
+                self.closing.append(sock)
+            except socket.error:
+                sock.close()
+
+    def drain(self):
+        # the server's commands to the gateways are read and thrown away
+        for stream, sock in list(self.socks.items()):
+            if not self.read_all(sock):
+                self.disconnect(stream)
+        for sock in self.closing[:]:
+            if not self.read_all(sock):
+                self.closing.remove(sock)
+                sock.close()
+
+    def read_all(self, sock):
+        """False once the server has closed the connection."""
+        try:
+            while True:
+                data = sock.recv(4096, socket.MSG_DONTWAIT)
+                if not data:
+                    return False
+        except (BlockingIOError, InterruptedError):
+            return True
+        except socket.error:
+            return False
+
+    def shutdown(self):
+        """Stop sending on every connection, the server reads them to the end."""
+        for stream in list(self.socks):
+            self.disconnect(stream)
+
+    def close(self):
+        self.shutdown()
+        for sock in self.closing:
+            sock.close()
+        self.closing = []
+
+
+def wait_idle(ingest, replayer, timeout=DRAIN_TIMEOUT_S):
+    """Run the server until it has read every connection to the end and
+    published what it read, returns how long it took. A connection is read
+    to the end once the server has closed it. The capture's time goes on
+    from the last record at the wall clock's pace, for the records the
+    coalescer still holds."""
+    start = time.monotonic()
+    last_ms = replayer.clock.ms
+    while time.monotonic() - start < timeout:
+        replayer.drain()
+        if (not replayer.closing and not ingest.gateways and
+                not ingest.coalescer.stats()["Held"] and not ingest.publisher.depth()):
+            break
+        replayer.clock.ms = last_ms + int((time.monotonic() - start) * 1000)
+        ingest.poll(0.01)
+    return time.monotonic() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a capture of server.py.')
+    parser.add_argument('capture')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='times as fast as recorded, 0 for as fast as possible')
+    parser.add_argument('--start', type=float, default=0, help='seconds into the capture')
+    parser.add_argument('--duration', type=float, help='seconds to replay')
+    parser.add_argument('--server', help='host:port of a running server.py')
+    parser.add_argument('--log', help='file for what the server prints, discarded by default')
+    args = parser.parse_args()
+
+    reader = CaptureReader(args.capture)
+    start_ms = int(args.start * 1000)
+    end_ms = None if args.duration is None else start_ms + int(args.duration * 1000)
+
+    log = open(args.log or os.devnull, 'w')
+    ingest = None
+    if args.server:
+        host, port = args.server.rsplit(':', 1)
+        address = (host, int(port))
+    else:
+        ingest = server.IngestServer(0)
+        ingest.publisher = Publisher(NullClient(), tracker=ingest.latency)
+        ingest.publisher.start()
+        address = ('127.0.0.1', ingest.listener.getsockname()[1])
+
+    replayer = Replayer(reader, address, args.speed, ingest)
+    with contextlib.redirect_stdout(log):
+        elapsed = replayer.run(start_ms, end_ms)
+        replayer.shutdown()
+        catch_up = None
+        if ingest:
+            catch_up = wait_idle(ingest, replayer)
+            ingest.coalescer.drain()
+            ingest.publisher.stop(5)
+    replayer.close()
+    log.close()
+    reader.close()
+
+    p50 = percentile(replayer.lags, 50)
+    p99 = percentile(replayer.lags, 99)
+    print('Replayed {} streams, {} chunks, {} bytes, {} commands in {:.2f} s'.format(
+        replayer.streams, replayer.chunks, replayer.bytes, replayer.commands, elapsed))
+    print('Throughput: {:.0f} chunks/s, {:.1f} kB/s'.format(
+        replayer.chunks / elapsed, replayer.bytes / elapsed / 1000.0))
+    if p50 is not None:
+        print('Lag: p50 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms'.format(p50, p99, max(replayer.lags)))
+    if ingest:
+        published = ingest.publisher.stats()
+        print('Server: {} records published, {:.0f}/s, caught up {:.2f} s after the last record'.format(
+            published["Published"], published["Published"] / (elapsed + catch_up), catch_up))
+        print('Publisher: ' + json.dumps(published))
+        print('Merge: ' + json.dumps(ingest.merger.stats()))
+        print('Coalescer: ' + json.dumps(ingest.coalescer.stats()))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,88 +1,236 @@
 import time
 import machine
-import json
 import config
+import frame
+import tdma
+import kinematics
+import log
+import reliable
+from array import array
+from scheduler import Scheduler
 from machine import Pin
 from network import LoRa
 import Adafruit_LCD as LCD
 
 LORA_SEND_PERIOD_MS = const(2500)
+# The crank counter is sampled this often and the samples taken since the
+# last uplink are sent along with the next one
+SAMPLE_PERIOD_MS = const(500)
+MAX_SAMPLES = const(8)
+# Time on air of the shortest uplink, without samples or sequence number
+MIN_AIRTIME_MS = frame.airtime_ms(frame.UPLINK_SIZE)
+# and of the shortest finish report, with the pulse that finished the ride
+FINISH_AIRTIME_MS = frame.airtime_ms(frame.uplink_size(1, True, True))
 
 # Bike Constants (note that DISTANCE_TARGET is in meters)
 COUNTDOWN_LENGTH = 3
 RIDE_COMPLETE_DELAY = 5
 BIKE_NAME = "1"
 DISTANCE_TARGET = 500
-DISTANCE_PER_REVOLUTION = 2.1362 
+DISTANCE_TARGET_MM = DISTANCE_TARGET * 1000
+# Number of crank pulse timestamps kept by PulseCounter (must be a power of two)
+PULSE_RING_SIZE = const(32)
+# Window for the live speed shown on the LCD, and the time without pulses
+# after which the rider is considered to have stopped pedalling
+SPEED_WINDOW_MS = const(5000)
+PEDAL_STOP_MS = const(3000)
+
+# Scheduler periods. The radio is polled for downlinks in every state, so
+# commands from the gateway are acted upon within LORA_POLL_MS.
+LORA_POLL_MS = const(20)
+TX_POLL_MS = const(10)
+LCD_SERVICE_MS = const(10)
+RIDE_TICK_MS = const(1000)
+
+
+class CrankSampler:
+    def __init__(self, size=MAX_SAMPLES):
+        # ticks and crank counter of every sample, oldest at self._head
+        self._ticks = array('I', [0] * size)
+        self._counts = array('H', [0] * size)
+        self._size = size
+        self._head = 0
+        self.count = 0
+        self._next_ms = time.ticks_ms()
+
+    def reset(self, now):
+        self._head = 0
+        self.count = 0
+        self._next_ms = time.ticks_add(now, SAMPLE_PERIOD_MS)
+
+    def poll(self, now, counter):
+        if time.ticks_diff(now, self._next_ms) < 0:
+            return
+        self._add(now, counter)
+        self._next_ms = time.ticks_add(self._next_ms, SAMPLE_PERIOD_MS)
+        if time.ticks_diff(now, self._next_ms) >= 0:
+            self._next_ms = time.ticks_add(now, SAMPLE_PERIOD_MS)
+
+    def end(self, ticks, counter):
+        # the ride finished at ticks: the samples taken since are dropped and
+        # the finish is the last sample
+        while self.count and time.ticks_diff(
+                self._ticks[(self._head + self.count - 1) % self._size], ticks) >= 0:
+            self.count -= 1
+        self._add(ticks, counter)
+
+    def _add(self, ticks, counter):
+        index = (self._head + self.count) % self._size
+        if self.count == self._size:
+            # full, overwrite the oldest sample
+            self._head = (self._head + 1) % self._size
+        else:
+            self.count += 1
+        self._ticks[index] = ticks
+        self._counts[index] = counter & 0xFFFF
+
+    def ms_until_next(self, now):
+        return max(0, time.ticks_diff(self._next_ms, now))
+
+    def take(self, now, limit=MAX_SAMPLES):
+        # (age, counter) of the samples since the last call, oldest first.
+        # Only the newest limit of them are returned, the others dropped.
+        samples = []
+        for i in range(max(0, self.count - limit), self.count):
+            index = (self._head + i) % self._size
+            samples.append((time.ticks_diff(now, self._ticks[index]), self._counts[index]))
+        self._head = 0
+        self.count = 0
+        return samples
+
 
 class PulseCounter:
-    def __init__(self, pin, pull, trigger, debounce_ms):
+    def __init__(self, pin, pull, trigger, debounce_ms, ring_size=PULSE_RING_SIZE):
         self._pin = Pin(pin, mode=Pin.IN, pull=pull)
         self._debounce_ms = debounce_ms
         self._last_count_ms = time.ticks_ms()
-        self._irq = self._pin.irq(trigger=trigger, handler=self._handler)
+        # ticks of the last ring_size pulses, pulse n is at n & self._mask.
+        # Everything the handler touches is allocated here, as the heap
+        # can't be used from an interrupt.
+        self._ring = array('I', [0] * ring_size)
+        self._mask = ring_size - 1
         self.counter = 0
+        self.bounced = 0    # edges rejected by the debounce
+        self.missed = 0     # pulses overwritten before poll() got to them
+        self._read = 0
+        self._irq = self._pin.irq(trigger=trigger, handler=self._handler)
 
     def _handler(self, pin):
         time_ms = time.ticks_ms()
-        if (time_ms - self._last_count_ms > self._debounce_ms):
+        if time.ticks_diff(time_ms, self._last_count_ms) > self._debounce_ms:
+            self._ring[self.counter & self._mask] = time_ms
             self.counter += 1
             self._last_count_ms = time_ms
+        else:
+            self.bounced += 1
+
+    def reset(self):
+        self.counter = 0
+        self._read = 0
+
+    def poll(self):
+        """Returns the number of pulses since the last poll(). Pulses whose
+        timestamp was overwritten before they were polled are counted in missed.
+        """
+        counter = self.counter
+        new = counter - self._read
+        # the slot at counter may be written by the handler as we go
+        if new > self._mask:
+            self.missed += new - self._mask
+        self._read = counter
+        return new
+
+    def pulse_ms(self, n):
+        """Ticks of the nth pulse since reset(), None if the ring doesn't
+        hold it (any more)."""
+        counter = self.counter
+        if n < 1 or n > counter or counter - n >= self._mask:
+            return None
+        return self._ring[(n - 1) & self._mask]
+
+    def pulses_in(self, now, window_ms):
+        """Returns (pulses, span_ms): the number of pulses in the last
+        window_ms, and the time they span. The span is shorter than the window
+        when the ring doesn't reach back far enough at high cadence.
+        """
+        counter = self.counter
+        pulses = 0
+        for n in range(counter - 1, max(counter - self._mask, 0) - 1, -1):
+            age = time.ticks_diff(now, self._ring[n & self._mask])
+            if age >= window_ms:
+                return pulses, window_ms
+            pulses += 1
+        if pulses == self._mask:
+            return pulses, time.ticks_diff(now, self._ring[(counter - pulses) & self._mask])
+        return pulses, window_ms
+
+    def cadence_rpm(self, now):
+        """Crank revolutions per minute over the last full revolution."""
+        counter = self.counter
+        if counter <= kinematics.PULSES_PER_REVOLUTION:
+            return 0
+        last = self._ring[(counter - 1) & self._mask]
+        if time.ticks_diff(now, last) > PEDAL_STOP_MS:
+            return 0
+        first = self._ring[(counter - 1 - kinematics.PULSES_PER_REVOLUTION) & self._mask]
+        interval = time.ticks_diff(last, first)
+        return 60000 // interval if interval > 0 else 0
 
 
 class Rider:
     def __init__(self, lcd):
         global DISTANCE_TARGET
+        # distance_travelled is in mm, distance_remaining in meters
         self.distance_travelled = 0
         self.last_distance = 0
         self.speed = 0
+        self.live_speed = 0
+        self.cadence = 0
         self.distance_remaining = DISTANCE_TARGET
         self.starttime = 0
         self.lcd = lcd
 
-    def countdown(self):
-        global COUNTDOWN_LENGTH
+    def ready(self):
+        print("Ready for first rider.")
+        self.lcd.update("Ready fo\nr first rider.")
+
+    def countdown(self, count_down):
+        print("Ready in " + str(count_down))
+        self.lcd.update("Ready in\n {:2d}".format(count_down))
+
+    def start(self):
         global DISTANCE_TARGET
-        count_down = COUNTDOWN_LENGTH
-        self.lcd.clear()
-        while(count_down > 0):
-            print("Ready in " + str(count_down))
-            self.lcd.home()
-            self.lcd.message("Ready in\n {:2d}".format(count_down))
-            count_down -= 1
-            time.sleep_ms(1000)
         print("GO! GO! GO!")
         self.distance_remaining = DISTANCE_TARGET
-        self.lcd.clear()
-        self.lcd.message("GO! GO! \nGO!")
-        self.starttime = time.ticks_ms() / 1000
+        self.lcd.update("GO! GO! \nGO!")
+        self.starttime = time.ticks_ms()
         self.last_distance = 0
         self.speed = 0
+        self.live_speed = 0
+        self.cadence = 0
         self.distance_travelled = 0
 
     def ride(self, crank):
-        global DISTANCE_TARGET
-        if self.distance_travelled <= DISTANCE_TARGET:
-            # Pull the crank values and calculate the wheel rotations 
-            crank_counter_local = str(crank.counter // 2)
-            wheel_counter_local_calc = (crank.counter // 2) * 2.8 
-            wheel_counter_local = str(wheel_counter_local_calc)
-                
-            # Workout distance travelled from previous loop
-            last_distance_travelled = self.distance_travelled
-            calc_current_timestamp = time.ticks_ms() / 1000
-            current_timestamp = str(time.ticks_ms() / 1000)
-
-            # Workout the Distance Travelled and covert from meters per second to miles per hour
-            self.distance_travelled = (wheel_counter_local_calc * DISTANCE_PER_REVOLUTION) * 2.2237
-            distance_loop = self.distance_travelled - last_distance_travelled
-            self.speed = (self.distance_travelled / (calc_current_timestamp - self.starttime)) 
-            self.distance_remaining = DISTANCE_TARGET - self.distance_travelled
-            print("Wheel Counter: " + str(wheel_counter_local_calc) + " | Average Speed (miles per hour): " + str(self.speed) + " | Distance Remaining (meters): " + str(self.distance_remaining)) 
-
-            # Write out speed and distance left to LCD display 
-            self.lcd.clear()
-            self.lcd.message("AMPH:" + str(int(self.speed)) + "\nMtrs:" + str(int(self.distance_remaining)))
+        if self.distance_travelled <= DISTANCE_TARGET_MM:
+            # Work out the distance travelled from the crank pulses, and the
+            # average speed since the start. All integers, see kinematics.py
+            now = time.ticks_ms()
+            crank_counter = crank.counter
+            self.distance_travelled = kinematics.distance_mm(crank_counter)
+            self.distance_remaining = kinematics.metres(DISTANCE_TARGET_MM - self.distance_travelled)
+            self.speed = kinematics.speed(self.distance_travelled,
+                                          kinematics.elapsed_ms(now, self.starttime))
+
+            # Live speed over the last few seconds, same units as the average
+            crank.poll()
+            pulses, span_ms = crank.pulses_in(now, SPEED_WINDOW_MS)
+            self.live_speed = kinematics.window_speed(pulses, span_ms)
+            self.cadence = crank.cadence_rpm(now)
+            if log.enabled(log.DEBUG):
+                print("Crank Counter: " + str(crank_counter) + " | Average Speed (miles per hour): " + str(self.speed) + " | Speed (miles per hour): " + str(self.live_speed) + " | Cadence (rpm): " + str(self.cadence) + " | Distance Remaining (meters): " + str(self.distance_remaining))
+
+            # Write out speed and distance left to LCD display (only the changed digits are redrawn)
+            self.lcd.update("MPH:" + str(self.live_speed) + "\nMtrs:" + str(self.distance_remaining))
 
             # this is sent by the gateway
             #json_str = '{"RiderName":"'+rider_name+'","Company":"'+company+'","BadgeNumber":'+badge_number+',"EventID":"'+event_id+'","RideTimestamp":'+start_timestamp+',"BikeID":'+bike_id+',"RideStatus":"'
@@ -102,22 +250,255 @@ class Rider:
         return self.speed
 
     def finish(self):
-        global RIDE_COMPLETE_DELAY
-        count_down = RIDE_COMPLETE_DELAY
         print("Ride Complete!")
-        self.lcd.clear()
-        self.lcd.message("Ride Com\nplete!")
-        while(count_down > 0):
-          count_down -= 1
-          time.sleep_ms(1000)
+        self.lcd.update("Ride Com\nplete!")
 
+    def abort(self):
+        print("Ride aborted!")
+        self.lcd.update("Ride abo\nrted!")
 
-def main():
-    start_delay_ms = 0
-    time_ms = time.ticks_ms()
-    last_sent_ms = time_ms
-    state = 'IDLE'   # States are: 'IDLE', 'RUNNING', 'FINISHED'
 
+class Bike:
+    """The bike's IDLE / COUNTDOWN / RUNNING / FINISHED state machine, run as
+    tasks on a Scheduler. Nothing here blocks: the countdown and the finish
+    screen are timers, uplinks wait for the bike's slot in a queue and the
+    radio is polled for downlinks in every state.
+    """
+
+    def __init__(self, bike_id, lora, lcd, crank, sched=None):
+        self.bike_id = bike_id
+        self.lora = lora
+        self.lcd = lcd
+        self.crank = crank
+        self.sched = sched or Scheduler()
+        self.rider = Rider(lcd)
+        self.slot = tdma.SlotClock()
+        self.sampler = CrankSampler()
+        self.state = 'IDLE'
+        # (status, crank counter, with samples) waiting for our slot
+        self._uplinks = []
+        # reports waiting for the gateway's acknowledgement, by sequence number
+        self.retries = reliable.Retransmitter()
+        self.seq = machine.rng() & 0xFF
+        self.start_seq = None       # of the gateway's last start command
+        self._release_slot = False  # once the end of the ride is acknowledged
+        # timers of the current ride, cancelled if it is aborted
+        self._timers = []
+        self.start_delay_ms = time.ticks_ms()
+        self.last_sent_ms = self.start_delay_ms
+
+    def start(self):
+        self.sched.every(LORA_POLL_MS, self.lora_rx_task)
+        self.sched.every(TX_POLL_MS, self.tx_task)
+        self.sched.every(LCD_SERVICE_MS, self.lcd_task)
+        self.rider.ready()
+
+    def _later(self, delay_ms, callback):
+        self._timers.append(self.sched.after(delay_ms, callback))
+
+    def _cancel_timers(self):
+        for timer in self._timers:
+            self.sched.cancel(timer)
+        self._timers = []
+
+    def lcd_task(self):
+        self.lcd.service()
+
+    def lora_rx_task(self):
+        packet_rx = self.lora.recv()
+        if not packet_rx:
+            return
+        rx_ms = time.ticks_ms()
+        log.debug(packet_rx)
+        try:
+            cmd, id, phase_ms, slot_index, slot_count, slot_ms, seq = frame.decode_downlink(packet_rx)
+        except ValueError:
+            print('Corrupted LoRa packet')
+            return
+        if id != self.bike_id and id != frame.BROADCAST_ID:
+            return
+        if cmd == frame.CMD_ACK:
+            if self.retries.ack(seq) is not None:
+                log.debug('Uplink {} acknowledged'.format(seq))
+        elif cmd == frame.CMD_START:
+            if seq is not None and seq == self.start_seq:
+                # the gateway hasn't heard our started report yet
+                started = (frame.STATUS_STARTED, 0, False)
+                if self.state == 'COUNTDOWN' and started not in self._uplinks:
+                    self._uplinks.append(started)
+            elif self.state == 'IDLE' and id == self.bike_id:
+                self.start_seq = seq
+                self.slot.assign(slot_index, slot_count, slot_ms)
+                self.slot.sync(phase_ms, rx_ms)
+                self.begin()
+        elif cmd == frame.CMD_BEACON:
+            # the gateway's beacons keep our slot aligned with its frames
+            self.slot.sync(phase_ms, rx_ms)
+        elif cmd == frame.CMD_ABORT:
+            if self.state == 'COUNTDOWN' or self.state == 'RUNNING':
+                self.abort()
+        elif cmd == frame.CMD_RESET:
+            self.reset()
+
+    def tx_task(self):
+        now = time.ticks_ms()
+        if self.state == 'RUNNING':
+            self.sampler.poll(now, self.crank.counter)
+        if self._release_slot and not self._uplinks and not self.retries.pending():
+            self._release_slot = False
+            self.slot.release()
+        if self.slot.ms_until_slot(now, MIN_AIRTIME_MS):
+            return
+        retry = self.retries.due(now)
+        if retry:
+            seq, message = retry
+            size = frame.uplink_size(len(message[4]), True, message[7] is not None)
+            if self.slot.ms_until_slot(now, frame.airtime_ms(size)):
+                return
+            packet_tx = self.send(now, message)
+            self.retries.resent(seq, now, frame.airtime_ms(len(packet_tx)))
+        elif self._uplinks:
+            status = self._uplinks[0][0]
+            if status in reliable.RELIABLE_STATUS and self.retries.pending():
+                # the reports arrive in order: the finish before the idle
+                # status sent after it, say
+                return
+            if status == frame.STATUS_FINISHED and self.slot.ms_until_slot(now, FINISH_AIRTIME_MS):
+                return
+            status, crank_count, samples = self._uplinks.pop(0)
+            message = self._message(now, status, crank_count, samples)
+            packet_tx = self.send(now, message)
+            seq = message[6]
+            if seq is not None:
+                self.retries.sent(seq, message, now, frame.airtime_ms(len(packet_tx)))
+        elif self.state == 'RUNNING':
+            # without a slot, spread the uplinks of the bikes randomly
+            if self.slot.active() or (time.ticks_diff(now, self.start_delay_ms) >= 0 and
+                                      time.ticks_diff(now, self.last_sent_ms) > LORA_SEND_PERIOD_MS):
+                self.send(now, self._message(now, frame.STATUS_RUNNING, self.crank.counter, True))
+
+    def _message(self, now, status, crank_count, samples):
+        # everything needed to encode the report again if it has to be resent
+        seq = None
+        if status in reliable.RELIABLE_STATUS:
+            self.seq = (self.seq + 1) & 0xFF
+            seq = self.seq
+        # the finish report times the ride, see frame.py
+        start_age = None
+        if status == frame.STATUS_FINISHED:
+            start_age = time.ticks_diff(now, self.rider.starttime)
+        if samples:
+            count = self._samples_that_fit(now, seq is not None, start_age is not None)
+            samples = self.sampler.take(now, count)
+        return (status, crank_count, self.rider.distance(), self.rider.avg_speed(),
+                samples or (), now, seq, start_age)
+
+    def _samples_that_fit(self, now, trailer, timed):
+        # as many of the newest samples as there is time left in the slot for
+        count = min(self.sampler.count, MAX_SAMPLES)
+        while count and self.slot.ms_until_slot(
+                now, frame.airtime_ms(frame.uplink_size(count, trailer, timed))):
+            count -= 1
+        return count
+
+    def send(self, now, message):
+        status, crank_count, distance, speed, samples, taken_ms, seq, start_age = message
+        # the sample ages count up to the time the frame is sent
+        late_ms = time.ticks_diff(now, taken_ms)
+        if late_ms:
+            samples = [(age_ms + late_ms, sample_crank) for age_ms, sample_crank in samples]
+            if start_age is not None:
+                start_age += late_ms
+        packet_tx = frame.encode_uplink(self.bike_id, status, crank_count, distance, speed,
+                                        samples, seq, start_age)
+        self.lora.send(packet_tx, True)
+        self.slot.sent(now)
+        self.last_sent_ms = now
+        if log.enabled(log.DEBUG):
+            print('{} {}'.format(packet_tx, now))
+        return packet_tx
+
+    def ride_task(self):
+        if self.state == 'RUNNING' and self.rider.ride(self.crank):
+            self.finish()
+
+    def begin(self):
+        print('Going to running state')
+        self._uplinks = []
+        self.retries.clear()
+        self._release_slot = False
+        self.start_delay_ms = time.ticks_add(time.ticks_ms(), (machine.rng() % 30) * 100)
+        # send 's' (started) state over LoRa
+        self._uplinks.append((frame.STATUS_STARTED, 0, False))
+        self.state = 'COUNTDOWN'
+        self._countdown(COUNTDOWN_LENGTH)
+
+    def _countdown(self, count_down):
+        if count_down > 0:
+            self.rider.countdown(count_down)
+            self._later(1000, lambda: self._countdown(count_down - 1))
+        else:
+            self.go()
+
+    def go(self):
+        self.rider.start()
+        self.crank.reset()
+        self.sampler.reset(time.ticks_ms())
+        # change to the running state and notify the gateway
+        self.state = 'RUNNING'
+        self._uplinks.append((frame.STATUS_RUNNING, 0, False))
+        self._timers.append(self.sched.every(RIDE_TICK_MS, self.ride_task))
+
+    def finish(self):
+        print('Going to finished state')
+        self._cancel_timers()
+        self.state = 'FINISHED'
+        # ride_task() only notices the finish a while after the pulse that
+        # took the rider past it, which is what the finish report is about
+        pulses = kinematics.pulses_past(DISTANCE_TARGET_MM)
+        finish_ms = self.crank.pulse_ms(pulses)
+        if finish_ms is None:
+            pulses = self.crank.counter
+            finish_ms = time.ticks_ms()
+        self.sampler.end(finish_ms, pulses)
+        self._uplinks.append((frame.STATUS_FINISHED, pulses, True))
+        self.rider.finish()
+        self._later(RIDE_COMPLETE_DELAY * 1000, self.finished)
+
+    def finished(self):
+        self._uplinks.append((frame.STATUS_IDLE, self.crank.counter, False))
+        self._release_slot = True
+        self.idle()
+
+    def abort(self):
+        print('Ride aborted by the gateway')
+        self._cancel_timers()
+        self.state = 'FINISHED'
+        self._uplinks.append((frame.STATUS_ABORTED, self.crank.counter, True))
+        self._release_slot = True
+        self.rider.abort()
+        self._later(RIDE_COMPLETE_DELAY * 1000, self.idle)
+
+    def reset(self):
+        print('Reset by the gateway')
+        self._cancel_timers()
+        self._uplinks = []
+        self.retries.clear()
+        self._release_slot = False
+        self.slot.release()
+        self.idle()
+        self.rider.ready()
+
+    def idle(self):
+        self.state = 'IDLE'
+        print('Crank pulses bounced: {} missed: {}'.format(self.crank.bounced, self.crank.missed))
+        print('Reports resent: {} unacknowledged: {}'.format(self.retries.retries, self.retries.failed))
+        self.crank.reset()
+
+
+def make_bike(bike_id=None, sched=None):
+    """Sets up the pins, radio and LCD, returns the Bike (bike_id defaults
+    to config.id)."""
     Pin('G4', mode=Pin.IN, pull=Pin.PULL_DOWN)
     crank = PulseCounter('G5', Pin.PULL_DOWN, Pin.IRQ_RISING, 250)
 
@@ -137,70 +518,12 @@ def main():
 
     lcd = LCD.CharLCD(lcd_rs, lcd_en, lcd_d4, lcd_d5, lcd_d6, lcd_d7, lcd_columns, lcd_rows)
 
-    rider = Rider(lcd)
-
-    print("Ready for first rider.")
-    lcd.clear()
-    lcd.message("Ready fo\nr first rider.")
-
-    while True:
-        if state == 'IDLE':
-            packet_rx = lora.recv()
-            if packet_rx:
-                try:
-                    parsed_json = json.loads(packet_rx.decode('ascii'))
-                    cmd = parsed_json['cm']
-                    id = parsed_json['id']
-                    if cmd == 's' and id == config.id:
-                        print('Going to running state')
-                        start_delay_ms = ((machine.rng() % 30) * 100) + time.ticks_ms()
-                        # send 's' (started) state over LoRa
-                        packet_tx = json.dumps({'id': config.id, 'cr':0, 'ds':int(rider.distance()), 'sp':int(rider.avg_speed()), 'st':'s'})
-                        lora.send(packet_tx, True)
-                        rider.countdown()
-                        crank.counter = 0
-                        # change to the running state and notify the gateway
-                        state = 'RUNNING'
-                        packet_tx = json.dumps({'id': config.id, 'cr':0, 'ds':int(rider.distance()), 'sp':int(rider.avg_speed()), 'st':'r'})
-                        lora.send(packet_tx, True)
-                except Exception:
-                    print('Corrupted LoRa packet')
-            else:
-                time.sleep_ms(50)
-
-        elif state == 'RUNNING':
-            if rider.ride(crank):
-                print('Going to finished state')
-                state = 'FINISHED'
-                packet_tx = json.dumps({'id': config.id, 'cr':crank.counter, 'ds':int(rider.distance()), 'sp':int(rider.avg_speed()), 'st':'f'})
-                lora.send(packet_tx, True)
-            time_ms = time.ticks_ms()
-            if time_ms < start_delay_ms:
-                pass
-            elif time_ms > last_sent_ms + LORA_SEND_PERIOD_MS:
-                last_sent_ms = time_ms
-                packet_tx = json.dumps({'id':config.id, 'cr':crank.counter, 'ds':int(rider.distance()), 'sp':int(rider.avg_speed()), 'st':'r'})
-                print(packet_tx + ' {}'.format(last_sent_ms))
-                lora.send(packet_tx, True)
-            else:
-                print('attempt to receive lora')
-                packet_rx = lora.recv()
-                if packet_rx:
-                    print(packet_rx)
-                    try: # I've seen this failing sometimes
-                        parsed_json = json.loads(packet_rx.decode('ascii'))
-                        # check the packet received and process the commands
-                    except Exception:
-                        print('Corrupted LoRa packet')
-
-            time.sleep(1.0 - (((time.ticks_ms() / 1000) - rider.starttime) % 1.0))
+    if bike_id is None:
+        bike_id = int(config.id)
+    return Bike(bike_id, lora, lcd, crank, sched)
 
-        else:
-            print('finishing ride')
-            rider.finish()
-            # change to the running state and notify the gateway
-            state = 'IDLE'
-            packet_tx = json.dumps({'id': config.id, 'cr':crank.counter, 'ds':int(rider.distance()), 'sp':int(rider.avg_speed()), 'st':'i'})
-            lora.send(packet_tx, True)
-            crank.counter = 0
 
+def main():
+    bike = make_bike()
+    bike.start()
+    bike.sched.run()
@@ -0,0 +1,225 @@
+try:
+    import uos as os
+except ImportError:
+    import os
+
+try:
+    from micropython import const
+except ImportError:
+    def const(x):
+        return x
+
+# Bounded FIFO of byte records in a single preallocated buffer. Each record
+# is stored with a 2 byte big endian length prefix and may wrap around the
+# end of the buffer. Used by the gateway to hold on to the records it can't
+# forward while the server is unreachable.
+#
+# The spill log outlives the ring: records left in it by a previous run
+# (the gateway rebooted before it could replay them) are counted on init and
+# replayed first. A record cut short by the reboot is dropped.
+
+OVERFLOW_DROP_OLDEST = const(0)
+OVERFLOW_DROP_NEWEST = const(1)
+
+_HEADER_SIZE = const(2)
+
+
+class RecordRing:
+    def __init__(self, size, overflow=OVERFLOW_DROP_OLDEST, spill_path=None, spill_max=0):
+        self._buf = bytearray(size)
+        self._mv = memoryview(self._buf)
+        self._size = size
+        self._head = 0      # next byte to read
+        self._used = 0      # bytes in use, headers included
+        self.count = 0      # records in the ring
+        self.overflow = overflow
+        # optional append log on flash taking the records that don't fit
+        self.spill_path = spill_path
+        self.spill_max = spill_max
+        self._spill_size = 0
+        self._spill_read = 0
+        self._spill_count = 0
+        # statistics
+        self.queued = 0
+        self.dropped = 0
+        self.flushed = 0
+        self.spilled = 0
+        if spill_path:
+            self._spill_recover()
+
+    def __len__(self):
+        return self.count + self._spill_count
+
+    def put(self, record):
+        """Queue a record, returns False if it had to be dropped."""
+        needed = len(record) + _HEADER_SIZE
+        if needed > self._size or needed > 0xFFFF:
+            self.dropped += 1
+            return False
+        while self._size - self._used < needed:
+            # make room moving the oldest record to the spill log, if there is
+            # one, otherwise apply the overflow policy
+            if self._spill_oldest():
+                continue
+            self.dropped += 1
+            if self.overflow == OVERFLOW_DROP_NEWEST:
+                return False
+            self._discard()
+        tail = (self._head + self._used) % self._size
+        self._write(tail, len(record) >> 8)
+        self._write(tail + 1, len(record) & 0xFF)
+        self._copy_in((tail + _HEADER_SIZE) % self._size, record)
+        self._used += needed
+        self.count += 1
+        self.queued += 1
+        return True
+
+    def batch(self, out, max_records=0):
+        """Copy as many of the oldest records as fit into out (a bytearray
+        or memoryview) without removing them. Returns (nbytes, nrecords),
+        the records are only removed by a later call to drop(nrecords).
+        """
+        if self._spill_count:
+            return self._spill_batch(out, max_records)
+        nbytes = 0
+        nrecords = 0
+        pos = self._head
+        for _ in range(self.count):
+            length = (self._buf[pos] << 8) | self._buf[(pos + 1) % self._size]
+            if nbytes + length > len(out) or (max_records and nrecords >= max_records):
+                break
+            self._copy_out((pos + _HEADER_SIZE) % self._size, out, nbytes, length)
+            nbytes += length
+            nrecords += 1
+            pos = (pos + _HEADER_SIZE + length) % self._size
+        return nbytes, nrecords
+
+    def drop(self, nrecords):
+        """Remove the nrecords oldest records, once they have been sent."""
+        if self._spill_count:
+            self._spill_drop(nrecords)
+        else:
+            for _ in range(nrecords):
+                self._discard()
+        self.flushed += nrecords
+
+    def _spill_oldest(self):
+        if not self.spill_path or (self.spill_max and self._spill_size >= self.spill_max):
+            return False
+        length = (self._buf[self._head] << 8) | self._buf[(self._head + 1) % self._size]
+        record = bytearray(length + _HEADER_SIZE)
+        self._copy_out(self._head, record, 0, length + _HEADER_SIZE)
+        try:
+            with open(self.spill_path, 'ab') as f:
+                f.write(record)
+        except OSError:
+            return False
+        self._spill_size += len(record)
+        self._spill_count += 1
+        self.spilled += 1
+        self._discard()
+        return True
+
+    def _spill_recover(self):
+        size = 0
+        count = 0
+        try:
+            with open(self.spill_path, 'rb') as f:
+                while True:
+                    header = f.read(_HEADER_SIZE)
+                    if len(header) < _HEADER_SIZE:
+                        break
+                    length = (header[0] << 8) | header[1]
+                    if len(f.read(length)) < length:
+                        break
+                    size += _HEADER_SIZE + length
+                    count += 1
+                partial = len(header) > 0
+        except OSError:
+            return      # no log
+        if partial and not self._spill_cut(size):
+            self.dropped += count
+            size = count = 0
+        if not count:
+            self._spill_remove()
+        self._spill_size = size
+        self._spill_count = count
+        self.spilled = count
+
+    def _spill_cut(self, size):
+        # appending after a torn record would make the rest unreadable, and
+        # uos has no truncate(): copy the whole records to a new log
+        tmp = self.spill_path + '.tmp'
+        chunk = memoryview(bytearray(256))
+        try:
+            with open(self.spill_path, 'rb') as src, open(tmp, 'wb') as dst:
+                left = size
+                while left:
+                    n = src.readinto(chunk[:min(left, len(chunk))])
+                    if not n:
+                        return False
+                    dst.write(chunk[:n])
+                    left -= n
+            os.remove(self.spill_path)
+            os.rename(tmp, self.spill_path)
+        except OSError:
+            return False
+        return True
+
+    def _spill_remove(self):
+        try:
+            os.remove(self.spill_path)
+        except OSError:
+            pass
+
+    def _discard(self):
+        length = (self._buf[self._head] << 8) | self._buf[(self._head + 1) % self._size]
+        self._head = (self._head + _HEADER_SIZE + length) % self._size
+        self._used -= _HEADER_SIZE + length
+        self.count -= 1
+
+    def _spill_batch(self, out, max_records):
+        nbytes = 0
+        nrecords = 0
+        with open(self.spill_path, 'rb') as f:
+            f.seek(self._spill_read)
+            while nrecords < self._spill_count and (not max_records or nrecords < max_records):
+                header = f.read(_HEADER_SIZE)
+                length = (header[0] << 8) | header[1]
+                if nbytes + length > len(out):
+                    break
+                out[nbytes:nbytes + length] = f.read(length)
+                nbytes += length
+                nrecords += 1
+        return nbytes, nrecords
+
+    def _spill_drop(self, nrecords):
+        with open(self.spill_path, 'rb') as f:
+            f.seek(self._spill_read)
+            for _ in range(nrecords):
+                header = f.read(_HEADER_SIZE)
+                length = (header[0] << 8) | header[1]
+                f.read(length)
+                self._spill_read += _HEADER_SIZE + length
+        self._spill_count -= nrecords
+        if not self._spill_count:
+            # everything in the log has been sent, start again from scratch
+            self._spill_remove()
+            self._spill_size = 0
+            self._spill_read = 0
+
+    def _write(self, pos, value):
+        self._buf[pos % self._size] = value
+
+    def _copy_in(self, pos, data):
+        data = memoryview(data)
+        first = min(len(data), self._size - pos)
+        self._buf[pos:pos + first] = data[:first]
+        if first < len(data):
+            self._buf[0:len(data) - first] = data[first:]
+
+    def _copy_out(self, pos, out, offset, length):
+        first = min(length, self._size - pos)
+        out[offset:offset + first] = self._mv[pos:pos + first]
+        if first < length:
+            out[offset + first:offset + length] = self._mv[0:length - first]
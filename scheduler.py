@@ -0,0 +1,132 @@
+try:
+    import uselect as select
+except ImportError:
+    import select
+import time
+
+# Small cooperative scheduler shared by the gateway and the bikes. Tasks
+# are plain callbacks, either run from timers or when a socket becomes
+# readable or writable. Callbacks must return quickly, anything that would block has to
+# be split in steps driven by timers.
+
+# Longest time run_once() sleeps when there is nothing to do.
+MAX_WAIT_MS = 1000
+
+
+class Timer:
+    def __init__(self, due_ms, period_ms, callback):
+        self.due_ms = due_ms
+        self.period_ms = period_ms
+        self.callback = callback
+        self.active = True
+
+
+class Scheduler:
+    def __init__(self):
+        self._timers = []
+        self._readers = {}
+        self._writers = {}
+        self._poll = select.poll()
+
+    def every(self, period_ms, callback, delay_ms=0):
+        """Call callback() every period_ms, the first call after delay_ms."""
+        timer = Timer(time.ticks_add(time.ticks_ms(), delay_ms), period_ms, callback)
+        self._timers.append(timer)
+        return timer
+
+    def after(self, delay_ms, callback):
+        """Call callback() once, delay_ms from now."""
+        timer = Timer(time.ticks_add(time.ticks_ms(), delay_ms), 0, callback)
+        self._timers.append(timer)
+        return timer
+
+    def cancel(self, timer):
+        if timer and timer.active:
+            timer.active = False
+            self._timers.remove(timer)
+
+    def add_reader(self, sock, callback):
+        """Call callback() whenever sock has data to read (or is closed)."""
+        self._readers[self._key(sock)] = callback
+        self._register(sock)
+
+    def remove_reader(self, sock):
+        if self._readers.pop(self._key(sock), None):
+            self._register(sock)
+
+    def add_writer(self, sock, callback):
+        """Call callback() whenever sock can be written to, e.g. once a
+        non-blocking connect() is over, or has failed."""
+        self._writers[self._key(sock)] = callback
+        self._register(sock)
+
+    def remove_writer(self, sock):
+        if self._writers.pop(self._key(sock), None):
+            self._register(sock)
+
+    def _register(self, sock):
+        # registering again changes the events polled for
+        key = self._key(sock)
+        mask = 0
+        if key in self._readers:
+            mask |= select.POLLIN
+        if key in self._writers:
+            mask |= select.POLLOUT
+        try:
+            if mask:
+                self._poll.register(sock, mask)
+            else:
+                self._poll.unregister(sock)
+        except Exception:
+            pass
+
+    def _key(self, sock):
+        # CPython's poll() reports file descriptors, MicroPython the objects
+        try:
+            return sock.fileno()
+        except AttributeError:
+            return sock
+
+    def _next_wait_ms(self, now):
+        wait_ms = MAX_WAIT_MS
+        for timer in self._timers:
+            delta = time.ticks_diff(timer.due_ms, now)
+            if delta < wait_ms:
+                wait_ms = delta
+        return wait_ms if wait_ms > 0 else 0
+
+    def run_once(self):
+        """Wait for the next timer or socket event and run the callbacks."""
+        wait_ms = self._next_wait_ms(time.ticks_ms())
+        if self._readers or self._writers:
+            for key, event in self._poll.poll(wait_ms):
+                if not isinstance(key, int):
+                    key = self._key(key)
+                # errors and hangups go to both, they end a connect() too
+                if event != select.POLLIN:
+                    callback = self._writers.get(key)
+                    if callback:
+                        callback()
+                if event != select.POLLOUT:
+                    callback = self._readers.get(key)
+                    if callback:
+                        callback()
+        elif wait_ms:
+            time.sleep_ms(wait_ms)
+
+        now = time.ticks_ms()
+        # callbacks may add or cancel timers, walk over a copy
+        for timer in self._timers[:]:
+            if timer.active and time.ticks_diff(timer.due_ms, now) <= 0:
+                if timer.period_ms:
+                    timer.due_ms = time.ticks_add(timer.due_ms, timer.period_ms)
+                    # don't try to catch up after a long stall
+                    if time.ticks_diff(timer.due_ms, now) <= 0:
+                        timer.due_ms = time.ticks_add(now, timer.period_ms)
+                else:
+                    self.cancel(timer)
+                timer.callback()
+
+    def run(self):
+        while True:
+            self.run_once()
@@ -3,9 +3,28 @@ import json
 import paho.mqtt.client as paho
 import ssl
 import errno, time
+import selectors
+import collections
+import struct
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import log
+import metrics
+import wire
+from framing import LineFramer
+from publisher import Publisher
+from latency import LatencyTracker
+from merge import RecordMerger
+from coalesce import Coalescer, COALESCE_WINDOW_S
+from capture import CaptureWriter
+from leaderboard import Leaderboard
 
 QOS = 0
 TOPIC = "my/topic"
+# Publish the ride records of each bike on TOPIC/<BikeID> instead of TOPIC
+PER_BIKE_TOPICS = False
+# Where the leaderboards of leaderboard.py are published
+LEADERBOARD_TOPIC = TOPIC + "/leaderboard"
 
 awshost = "A8USY1DJY36IC.iot.eu-west-1.amazonaws.com"
 awsport = 8883
@@ -13,14 +32,480 @@ caPath = "aws-iot-rootCA.crt"
 certPath = "ap.crt"
 keyPath = "ap.key"
 
+TCP_PORT = 50140
+STATS_PERIOD_S = 60
+# Record the gateways' TCP streams and the dashboard's commands to this file
+# for replay.py, None to not record
+CAPTURE_PATH = None
+RX_BUFFER_SIZE = 65536
+# Commands waiting for a gateway's socket to take them, beyond this the
+# gateway isn't reading and is disconnected
+TX_BUFFER_MAX = 65536
+# Serve the metrics of the server and of the gateways' health records as
+# text on http://localhost:METRICS_PORT/metrics, None to not serve them.
+# The page is rendered every METRICS_PERIOD_S on the ingest loop.
+METRICS_PORT = 9120
+METRICS_PERIOD_S = 5
+
 connflag = False
 
-sock = socket.socket()
-sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-sock.bind(('', 50140))
-sock.listen(0)
-sc, addr = sock.accept()
-sc.setblocking(0)
+
+class GatewayConnection:
+    """State and statistics of one connected gateway."""
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.bikes = set()          # bikes this gateway has forwarded records for
+        self.connected_at = time.time()
+        self.last_seen = self.connected_at
+        self.records = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.errors = 0
+        self.duplicates = 0         # records another gateway forwarded first
+        self.rx = LineFramer(RX_BUFFER_SIZE, binary=True)
+        self.tx = bytearray()       # not yet taken by the socket, see IngestServer.send()
+        self.trace_offset = [None]  # see LatencyTracker.tcp_delay()
+        self.binary = False         # asked for binary records, see wire.py
+        self.rides = {}             # wire ride id -> (BikeID, RideTimestamp, record prefix, fields)
+        self.health = None          # last health record of the gateway, see heap.py and metrics.py
+        self.rates = metrics.Rates()    # of the counters of its health records
+        self.stream = None          # stream number in the capture, if recording
+
+    def __str__(self):
+        return "{}:{}".format(*self.addr)
+
+
+class IngestServer:
+    """Accepts any number of gateway connections and publishes their records
+    to MQTT. Start commands are routed back to the gateway that last forwarded
+    records for the bike, or to every gateway if the bike hasn't been heard of.
+    Records forwarded by more than one gateway are published once, see
+    merge.py, and the bike's commands go to the gateway that hears it best.
+    A bike's counting records are published at most once every
+    coalesce_window_s, see coalesce.py. Every record published also goes
+    to the leaderboards, see leaderboard.py. Its counters and those the
+    gateways report are rendered as text in metrics_page, see metrics.py.
+    """
+
+    def __init__(self, port=TCP_PORT, publisher=None, coalesce_window_s=COALESCE_WINDOW_S,
+                 capture=None, clock=time.monotonic):
+        self.clock = clock          # of the metrics' rates
+        self.publisher = publisher
+        self.capture = capture      # CaptureWriter recording what is received
+        self.coalescer = Coalescer(self.publish, coalesce_window_s)
+        self.sel = selectors.DefaultSelector()
+        self.gateways = {}          # socket -> GatewayConnection
+        self.bike_owner = {}        # BikeID -> GatewayConnection
+        self.latency = LatencyTracker()
+        self.merger = RecordMerger()
+        self.leaderboard = Leaderboard()
+        self.metrics = metrics.Registry()
+        self.rates = metrics.Rates()
+        self.metrics_page = ''      # read by the metrics HTTP thread
+        self._next_metrics = 0
+        # commands queued from the MQTT thread, the socket pair wakes up select()
+        self.commands = collections.deque()
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.sel.register(self.wakeup_r, selectors.EVENT_READ, self.run_commands)
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('', port))
+        self.listener.listen(socket.SOMAXCONN)
+        self.listener.setblocking(False)
+        self.sel.register(self.listener, selectors.EVENT_READ, self.accept)
+
+    def accept(self, listener):
+        sc, addr = listener.accept()
+        sc.setblocking(False)
+        # commands are single small lines, don't let Nagle hold them back
+        sc.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        gateway = GatewayConnection(sc, addr)
+        self.gateways[sc] = gateway
+        self.sel.register(sc, selectors.EVENT_READ, self.read)
+        if self.capture:
+            gateway.stream = self.capture.open(addr)
+        self.metrics.inc("gateway_connects")
+        print("Gateway connected: " + str(gateway))
+
+    def close(self, gateway):
+        if gateway.sock is None:
+            # already closed, e.g. by a failed send while reading
+            return
+        print("Gateway disconnected: " + str(gateway))
+        self.metrics.inc("gateway_disconnects")
+        if self.capture:
+            self.capture.close(gateway.stream)
+        sock = gateway.sock
+        gateway.sock = None
+        self.sel.unregister(sock)
+        sock.close()
+        del self.gateways[sock]
+        self.merger.forget_gateway(gateway)
+        for bike_id in gateway.bikes:
+            if self.bike_owner.get(bike_id) is gateway:
+                best = self.merger.best_gateway(bike_id)
+                if best is None:
+                    del self.bike_owner[bike_id]
+                else:
+                    self.bike_owner[bike_id] = best
+
+    def read(self, sc):
+        gateway = self.gateways.get(sc)
+        if not gateway:
+            # closed earlier in the same select() round
+            return
+        try:
+            n = gateway.rx.recv_into(sc)
+        except socket.error as e:
+            if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return
+            print(e)
+            self.close(gateway)
+            return
+        if not n:
+            self.close(gateway)
+            return
+        gateway.bytes_in += n
+        self.metrics.inc("rx_bytes", n)
+        if self.capture:
+            self.capture.data(gateway.stream, gateway.rx.received(n))
+        gateway.last_seen = time.time()
+        received = time.monotonic()
+        # records split over several reads stay in the framer until complete
+        for record in gateway.rx.records():
+            if record[0] & 0x80:
+                self.process_frame(gateway, record, received)
+            else:
+                self.process_record(gateway, bytes(record), received)
+            if gateway.sock is None:
+                # closed while processing, the rest goes with the connection
+                break
+
+    def send(self, gateway, data):
+        """Write data to the gateway without blocking, what its socket
+        doesn't take now is buffered and flushed once it's writable.
+        Returns False if the gateway was disconnected."""
+        if gateway.sock is None:
+            return False
+        sent = 0
+        if not gateway.tx:
+            try:
+                sent = gateway.sock.send(data)
+            except (BlockingIOError, InterruptedError):
+                pass
+            except socket.error as e:
+                print(e)
+                self.close(gateway)
+                return False
+        gateway.bytes_out += sent
+        self.metrics.inc("tx_bytes", sent)
+        if sent < len(data):
+            if len(gateway.tx) + len(data) - sent > TX_BUFFER_MAX:
+                print("Gateway not reading: " + str(gateway))
+                self.close(gateway)
+                return False
+            if not gateway.tx:
+                self.sel.modify(gateway.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, self.read)
+            gateway.tx += memoryview(data)[sent:]
+        return True
+
+    def flush(self, sc):
+        gateway = self.gateways.get(sc)
+        if not gateway or not gateway.tx:
+            return
+        try:
+            sent = sc.send(gateway.tx)
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error as e:
+            print(e)
+            self.close(gateway)
+            return
+        del gateway.tx[:sent]
+        gateway.bytes_out += sent
+        self.metrics.inc("tx_bytes", sent)
+        if not gateway.tx:
+            self.sel.modify(sc, selectors.EVENT_READ, self.read)
+
+    def process_record(self, gateway, line, received):
+        try:
+            jsonReading = json.loads(line)
+            if "Protocol" in jsonReading:
+                self.hello(gateway, jsonReading)
+                return
+            if "Health" in jsonReading:
+                self.health(gateway, jsonReading["Health"])
+                return
+            # Workaround to avoid exponential values
+            jsonReading["RideTimestamp"] = float(jsonReading["RideTimestamp"])
+            info = jsonReading.get("RideInfo")
+            first = last = crank = None
+            if info:
+                first = (info[0]["CounterTimestamp"], info[0]["CrankCounter"])
+                # when the counter got to its final count, see leaderboard.py
+                i = len(info) - 1
+                crank = info[i]["CrankCounter"]
+                while i and info[i - 1]["CrankCounter"] == crank:
+                    i -= 1
+                last = (info[i]["CounterTimestamp"], crank)
+        except (ValueError, KeyError, AttributeError, TypeError) as e:
+            self.bad_record(gateway, "Bad record from " + str(gateway) + ": " + str(e))
+            return
+        self.metrics.inc("records_json")
+        bike_id = str(jsonReading.get("BikeID"))
+        if not self.merge(gateway, bike_id, jsonReading["RideTimestamp"],
+                          jsonReading.get("RideStatus"), crank):
+            return
+        status = jsonReading.get("RideStatus")
+        self.leaderboard.update(gateway, bike_id, jsonReading["RideTimestamp"], status,
+                                jsonReading.get("EventID"), jsonReading.get("RiderName"),
+                                jsonReading.get("Company"), first, last)
+        if log.enabled(log.DEBUG):
+            print("Publishing: " + line.decode("ascii", "replace"))
+        trace = jsonReading.pop("Trace", None)
+        if trace is not None:
+            try:
+                trace = self.trace(gateway, trace["Bike"], trace["Air"], trace["Rx"], trace["Tx"],
+                                   received)
+            except (TypeError, KeyError):
+                trace = None
+        self.publish_record(gateway, bike_id, status, json.dumps(jsonReading), trace)
+
+    def hello(self, gateway, request):
+        # a gateway asking for binary records, answered with the same line
+        if request["Protocol"] == "binary" and request.get("Version") == wire.PROTOCOL_VERSION:
+            gateway.binary = True
+            print("Binary records from " + str(gateway))
+            self.send(gateway, wire.HELLO)
+
+    def process_frame(self, gateway, data, received):
+        """A binary record of wire.py, published as the JSON the gateway
+        would have sent otherwise."""
+        try:
+            if data[0] == wire.REC_RIDE:
+                ride_id, bike_id, fields = wire.decode_ride(data)
+                name, company, badge, event_id, timestamp = fields
+                reading = collections.OrderedDict((
+                    ("RiderName", json.loads(name)), ("Company", json.loads(company)),
+                    ("BadgeNumber", json.loads(badge)), ("EventID", json.loads(event_id)),
+                    ("RideTimestamp", float(timestamp)), ("BikeID", bike_id)))
+                gateway.rides[ride_id] = (str(bike_id), reading["RideTimestamp"],
+                                          json.dumps(reading)[:-1] + ', "RideStatus": "', reading)
+                self.metrics.inc("ride_definitions")
+                return
+            ride_id, status, count, trace = wire.decode_info(data)
+        except (ValueError, IndexError, struct.error) as e:
+            self.bad_record(gateway, "Bad record from " + str(gateway) + ": " + str(e))
+            return
+        ride = gateway.rides.get(ride_id)
+        if ride is None:
+            self.bad_record(gateway, "Record of unknown ride {} from {}".format(ride_id, gateway))
+            return
+        self.metrics.inc("records_binary")
+        bike_id, ride_timestamp, prefix, reading = ride
+        first = last = crank = None
+        if count:
+            first = wire.entry(data, 0)[:2]
+            i = count - 1
+            crank = wire.entry(data, i)[1]
+            while i and wire.entry(data, i - 1)[1] == crank:
+                i -= 1
+            last = wire.entry(data, i)[:2]
+        status = wire.STATUSES[status]
+        if not self.merge(gateway, bike_id, ride_timestamp, status, crank):
+            return
+        self.leaderboard.update(gateway, bike_id, ride_timestamp, status, reading["EventID"],
+                                reading["RiderName"], reading["Company"], first, last)
+        info = []
+        for i in range(count):
+            info.append('{"CounterTimestamp": %d.0, "CrankCounter": %d, "WheelCounter": %d}' %
+                        wire.entry(data, i))
+        record = prefix + status + '", "RideInfo": [' + ', '.join(info) + ']}'
+        if log.enabled(log.DEBUG):
+            print("Publishing: " + record)
+        if trace is not None:
+            trace = self.trace(gateway, trace[0], trace[1], trace[2], trace[3], received)
+        self.publish_record(gateway, bike_id, status, record, trace)
+
+    def merge(self, gateway, bike_id, ride_timestamp, status, crank):
+        """False if the record isn't to be published, see merge.py."""
+        gateway.bikes.add(bike_id)
+        if self.merger.accept(gateway, bike_id, ride_timestamp, status, crank):
+            return True
+        gateway.duplicates += 1
+        self.metrics.inc("records_duplicate")
+        return False
+
+    def bad_record(self, gateway, message):
+        gateway.errors += 1
+        self.metrics.inc("records_bad")
+        print(message)
+
+    def health(self, gateway, health):
+        """A gateway's health record, see NanoGateWay.health_task()."""
+        gateway.health = health
+        self.metrics.inc("health_records")
+        counters = health.get("Counters") if isinstance(health, dict) else None
+        if isinstance(counters, dict):
+            gateway.rates.update(counters, self.clock())
+        if log.enabled(log.DEBUG):
+            print("Health of " + str(gateway) + ": " + json.dumps(health))
+
+    def publish_record(self, gateway, bike_id, status, record, trace):
+        gateway.records += 1
+        self.bike_owner[bike_id] = self.merger.best_gateway(bike_id) or gateway
+        topic = record_topic(bike_id)
+        if status == "counting":
+            self.coalescer.update(bike_id, topic, record, QOS, trace)
+            return
+        # status changes go out straight away
+        self.coalescer.bypass(bike_id, topic, record, QOS, trace)
+        if status != "started":
+            self.coalescer.forget(bike_id)
+
+    def publish(self, topic, record, qos, trace):
+        self.metrics.inc("records_published")
+        self.publisher.publish(topic, record, qos = qos, trace = trace)
+
+    def trace(self, gateway, bike_ms, air_ms, rx_ticks, tx_ticks, received):
+        """Adds the stages up to the publisher of a traced record, returns
+        the trace for Publisher.publish()."""
+        latency = self.latency
+        gateway_ms = latency.gateway_delay(rx_ticks, tx_ticks)
+        tcp_ms = latency.tcp_delay(gateway.trace_offset, tx_ticks, received * 1000)
+        ingest_ms = (time.monotonic() - received) * 1000
+        latency.add("Bike", bike_ms)
+        latency.add("Air", air_ms)
+        latency.add("Gateway", gateway_ms)
+        latency.add("TCP", tcp_ms)
+        latency.add("Ingest", ingest_ms)
+        return received, bike_ms + air_ms + gateway_ms + tcp_ms
+
+    def send_command(self, bike_id, data):
+        """Send data to the gateway that owns bike_id, or to all of them."""
+        owner = self.bike_owner.get(str(bike_id))
+        targets = [owner] if owner else list(self.gateways.values())
+        for gateway in targets:
+            self.send(gateway, data)
+        return len(targets)
+
+    def send_start(self, bike_id, data):
+        """Send the start of a ride to every gateway, so that all of them
+        forward the bike's records. Only the gateway that owns bike_id starts
+        the bike, the others are told to listen."""
+        owner = self.bike_owner.get(str(bike_id))
+        listen = None
+        gateways = list(self.gateways.values())
+        for gateway in gateways:
+            if owner is None or gateway is owner:
+                self.send(gateway, data)
+                continue
+            if listen is None:
+                reading = json.loads(data)
+                reading["Listen"] = True
+                listen = bytes(json.dumps(reading) + "\n", 'ascii')
+            self.send(gateway, listen)
+        return len(gateways)
+
+    def capture_command(self, payload):
+        # called from the MQTT thread
+        if self.capture:
+            self.capture.command(payload)
+
+    def queue_command(self, bike_id, data, start=False):
+        """Thread safe version of send_command(), or of send_start(), run
+        from the ingest loop."""
+        self.commands.append((bike_id, data, start))
+        self.wakeup_w.send(b'\0')
+
+    def run_commands(self, sock):
+        try:
+            sock.recv(4096)
+        except socket.error:
+            pass
+        while self.commands:
+            bike_id, data, start = self.commands.popleft()
+            self.metrics.inc("commands")
+            send = self.send_start if start else self.send_command
+            if not send(bike_id, data):
+                print("No gateway connected for bike " + str(bike_id))
+
+    def poll(self, timeout):
+        for key, events in self.sel.select(self.coalescer.wait(timeout)):
+            # only gateways with commands buffered wait for EVENT_WRITE
+            if events & selectors.EVENT_WRITE:
+                self.flush(key.fileobj)
+            if events & selectors.EVENT_READ:
+                key.data(key.fileobj)
+        self.coalescer.due()
+        for board in self.leaderboard.due():
+            self.metrics.inc("leaderboards_published")
+            self.publisher.publish(LEADERBOARD_TOPIC, board, qos = QOS)
+        now = self.clock()
+        if now >= self._next_metrics:
+            self._next_metrics = now + METRICS_PERIOD_S
+            self.metrics_page = self.metrics_text(now)
+
+    def metrics_text(self, now):
+        """The server's counters and statistics, and the last health record
+        of every gateway, in the Prometheus text format."""
+        counters = self.metrics.counters
+        rates = self.rates.update(counters, now)
+        server = metrics.prefixed("server_", counters)
+        server.update(metrics.prefixed("server_", rates, "_per_s"))
+        server["server_gateways"] = len(self.gateways)
+        sections = [({}, server)]
+        for prefix, stats in (("publisher_", self.publisher.stats() if self.publisher else {}),
+                              ("merge_", self.merger.stats()),
+                              ("coalescer_", self.coalescer.stats()),
+                              ("leaderboard_", self.leaderboard.stats()),
+                              ("capture_", self.capture.stats() if self.capture else {})):
+            sections.append(({}, metrics.prefixed(prefix, stats)))
+        for stage, stats in self.latency.stats().items():
+            sections.append(({"stage": stage}, metrics.prefixed("latency_", stats)))
+        for g in self.gateways.values():
+            labels = {"gateway": str(g)}
+            sections.append((labels, {
+                "connection_records": g.records, "connection_duplicates": g.duplicates,
+                "connection_errors": g.errors, "connection_rx_bytes": g.bytes_in,
+                "connection_tx_bytes": g.bytes_out, "connection_bikes": len(g.bikes),
+                "connection_binary": g.binary,
+                "connection_uptime_s": int(time.time() - g.connected_at)}))
+            # what the gateway reported in its last health record
+            health = g.health if isinstance(g.health, dict) else {}
+            sections.append((labels, metrics.prefixed("gateway_heap_", health)))
+            for name in ("Counters", "Gauges"):
+                if isinstance(health.get(name), dict):
+                    sections.append((labels, metrics.prefixed("gateway_", health[name])))
+            sections.append((labels, metrics.prefixed("gateway_", g.rates.rates, "_per_s")))
+            signal = health.get("Bikes")
+            if isinstance(signal, dict):
+                for bike_id, rssi_snr in signal.items():
+                    if isinstance(rssi_snr, list) and len(rssi_snr) == 2:
+                        sections.append(({"gateway": str(g), "bike": bike_id},
+                                         {"bike_rssi": rssi_snr[0], "bike_snr": rssi_snr[1]}))
+        for bike_id, shares in self.merger.reception().items():
+            for gateway, share in shares.items():
+                sections.append(({"gateway": gateway, "bike": bike_id}, {"bike_reception": share}))
+        return metrics.text(sections)
+
+    def stats(self):
+        return [{"Gateway": str(g), "Bikes": sorted(g.bikes), "Records": g.records,
+                 "Binary": g.binary, "Health": g.health,
+                 "Duplicates": g.duplicates,
+                 "BytesIn": g.bytes_in, "BytesOut": g.bytes_out, "Errors": g.errors,
+                 "Uptime": int(time.time() - g.connected_at)}
+                for g in self.gateways.values()]
+
+
+def record_topic(bike_id):
+    if PER_BIKE_TOPICS:
+        return TOPIC + "/" + str(bike_id)
+    return TOPIC
+
 
 def on_connect(client, userdata, flags, rc):
     global connflag
@@ -30,7 +515,8 @@ def on_connect(client, userdata, flags, rc):
     client.subscribe(TOPIC, 1)
 
 def on_message(client, userdata, msg):
-    print(str(msg.payload))
+    if log.enabled(log.DEBUG):
+        print(str(msg.payload))
 
     decoded_payload = msg.payload.decode("ascii")
 
@@ -38,6 +524,7 @@ def on_message(client, userdata, msg):
 
     # Only process messages meant for this bike (as defined by BIKE_NAME constant above
     if parsed_json['RideStatus'] == "initalised":
+        userdata.capture_command(msg.payload)
 
         starttime=time.time()
 
@@ -56,52 +543,97 @@ def on_message(client, userdata, msg):
         jsonReading = json.loads(json_str)
 
         print("Initialised: " + str(json_str))
-        mqttc.publish(TOPIC, json.dumps(jsonReading) , qos = QOS)
+        # userdata is the IngestServer, see main(). This runs on the MQTT
+        # network thread, so everything is handed over through queues.
+        userdata.publisher.publish(record_topic(bike_id), json.dumps(jsonReading) , qos = QOS)
 
         json_d = json.dumps(jsonReading)
-        sc.send(bytes(json_d,'ascii'))
+        userdata.queue_command(bike_id, bytes(json_d + "\n",'ascii'), start=True)
 
-# Establish mqtt conncetion
-mqttc = paho.Client()
+    elif parsed_json['RideStatus'] == "abort" or parsed_json['RideStatus'] == "reset":
+        # Forwarded to the bike's gateway, which reports the aborted ride.
+        # A reset without a BikeID goes to every gateway and bike.
+        userdata.capture_command(msg.payload)
+        bike_id = parsed_json.get('BikeID')
+        command = {"RideStatus": parsed_json['RideStatus']}
+        if bike_id is not None:
+            command["BikeID"] = int(bike_id)
+        print("Forwarding: " + json.dumps(command))
+        userdata.queue_command(bike_id, bytes(json.dumps(command) + "\n",'ascii'))
 
-mqttc.on_connect = on_connect
-mqttc.on_message = on_message
 
-mqttc.tls_set(caPath, certfile=certPath, keyfile=keyPath, cert_reqs=ssl.CERT_REQUIRED, tls_version=ssl.PROTOCOL_TLSv1_2, ciphers=None)
+class MetricsHandler(BaseHTTPRequestHandler):
+    # self.server.ingest is the IngestServer, see serve_metrics()
 
-print("Connecting... awshost: "+awshost+" awsport: "+str(awsport)+" topic: "+TOPIC)
-rc = -1
-rc = mqttc.connect(awshost, awsport, keepalive=60)
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.ingest.metrics_page.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
-print ("mqttc connect return code = "+str(rc))
+    def log_message(self, format, *args):
+        # every scrape isn't worth a line
+        pass
 
-while True:
 
-    rc = mqttc.loop()
+def serve_metrics(ingest, port=METRICS_PORT):
+    """Serve ingest.metrics_page on its own thread, returns the HTTP server."""
+    httpd = ThreadingHTTPServer(("localhost", port), MetricsHandler)
+    httpd.daemon_threads = True
+    httpd.ingest = ingest
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
 
-    try:
-       data = sc.recv(1024)
-       if not data:
-          print("connection closed")
-          sc.close()
-          break
-       else:
-          decoded_payload = data.decode("ascii")
-          mydata = decoded_payload.splitlines()
 
-          i=0
-          while (i<len(mydata)):
-            print("Publishing: " + mydata[i])
-            jsonReading = json.loads(mydata[i])
-            # Workaround to avoid exponential values
-            jsonReading["RideTimestamp"] = float(jsonReading["RideTimestamp"])
-            mqttc.publish(TOPIC, json.dumps(jsonReading), qos = QOS)
-            i=i+1
-
-    except socket.error as e:
-        if e.args[0] == errno.EWOULDBLOCK:
-            print ('EWOULDBLOCK')
-            time.sleep(0.1)           # short delay, no tight loops
-        else:
-            print (e)
-            break
+def main():
+    capture = None
+    if CAPTURE_PATH:
+        capture = CaptureWriter(CAPTURE_PATH)
+        print("Recording to " + CAPTURE_PATH)
+    ingest = IngestServer(TCP_PORT, capture=capture)
+    if METRICS_PORT:
+        serve_metrics(ingest)
+        print("Metrics on http://localhost:{}/metrics".format(METRICS_PORT))
+
+    # Establish mqtt conncetion
+    mqttc = paho.Client(userdata=ingest)
+
+    mqttc.on_connect = on_connect
+    mqttc.on_message = on_message
+
+    mqttc.tls_set(caPath, certfile=certPath, keyfile=keyPath, cert_reqs=ssl.CERT_REQUIRED, tls_version=ssl.PROTOCOL_TLSv1_2, ciphers=None)
+
+    print("Connecting... awshost: "+awshost+" awsport: "+str(awsport)+" topic: "+TOPIC)
+    rc = -1
+    rc = mqttc.connect(awshost, awsport, keepalive=60)
+
+    print ("mqttc connect return code = "+str(rc))
+    # MQTT networking runs on its own thread, publishing on the publisher's
+    ingest.publisher = Publisher(mqttc, tracker=ingest.latency)
+    ingest.publisher.start()
+    mqttc.loop_start()
+
+    last_stats = time.time()
+    while True:
+        ingest.poll(1.0)
+        if time.time() - last_stats > STATS_PERIOD_S:
+            last_stats = time.time()
+            print("Gateways: " + json.dumps(ingest.stats()))
+            print("Publisher: " + json.dumps(ingest.publisher.stats()))
+            print("Latency: " + json.dumps(ingest.latency.stats()))
+            print("Merge: " + json.dumps(ingest.merger.stats()))
+            print("Coalescer: " + json.dumps(ingest.coalescer.stats()))
+            print("Leaderboard: " + json.dumps(ingest.leaderboard.stats()))
+            if capture:
+                capture.flush()
+                print("Capture: " + json.dumps(capture.stats()))
+            print("Reception: " + json.dumps(ingest.merger.reception()))
+
+
+if __name__ == '__main__':
+    main()
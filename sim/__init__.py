@@ -0,0 +1,50 @@
+# Host side simulation of the bikes, gateways and server. install() puts
+# stand-ins for the MicroPython and Pycom modules (machine, network,
+# micropython, uselect, the ticks functions of time) and for paho in place,
+# after which rider.py, gateway.py and server.py run unchanged on CPython,
+# on a virtual clock. See run.py for a whole event.
+#
+# Nothing here is copied to the devices.
+
+import builtins
+import sys
+import time
+import types
+
+from sim.clock import VirtualClock
+
+
+def install(seed=None, start_ms=0):
+    """Install the stand-ins, returns the VirtualClock. Must be called
+    before any of the device modules are imported."""
+    from sim import machine, network, uselect, mqtt
+
+    clock = VirtualClock(start_ms)
+    clock.install(time)
+    uselect.clock = clock
+    machine.seed(seed)
+
+    micropython = types.ModuleType('micropython')
+    micropython.const = _const
+    # rider.py and gateway.py use const() without importing it
+    builtins.const = _const
+
+    paho = types.ModuleType('paho')
+    paho_mqtt = types.ModuleType('paho.mqtt')
+    paho.mqtt = paho_mqtt
+    paho_mqtt.client = mqtt
+
+    sys.modules.update({
+        'machine': machine,
+        'network': network,
+        'micropython': micropython,
+        'uselect': uselect,
+        'paho': paho,
+        'paho.mqtt': paho_mqtt,
+        'paho.mqtt.client': mqtt,
+    })
+    return clock
+
+
+def _const(x):
+    return x
@@ -0,0 +1,52 @@
+# Virtual clock standing in for MicroPython's time.ticks_*() and sleep_*()
+# functions. Time only moves when something sleeps, so a whole fleet of
+# bikes and gateways can share one scheduler and run faster than real time.
+# Ticks wrap around like they do on the LoPy, which makes the code that
+# isn't careful with ticks_diff() show up.
+
+TICKS_PERIOD = 1 << 30
+_TICKS_MAX = TICKS_PERIOD - 1
+_TICKS_HALF = TICKS_PERIOD // 2
+
+# Reading the clock costs this much, so that code busy waiting on
+# ticks_us() (Adafruit_LCD.write8()) gets there eventually.
+READ_COST_US = 1
+
+
+class VirtualClock:
+    def __init__(self, start_ms=0):
+        self.now_us = start_ms * 1000
+        self.read_cost_us = READ_COST_US
+
+    def ms(self):
+        """Time since the start of the simulation, without wraparound."""
+        return self.now_us // 1000
+
+    def advance_us(self, us):
+        if us > 0:
+            self.now_us += us
+
+    # MicroPython's time module
+
+    def ticks_ms(self):
+        return (self.now_us // 1000) & _TICKS_MAX
+
+    def ticks_us(self):
+        self.now_us += self.read_cost_us
+        return self.now_us & _TICKS_MAX
+
+    def ticks_add(self, ticks, delta):
+        return (ticks + delta) & _TICKS_MAX
+
+    def ticks_diff(self, ticks1, ticks2):
+        return ((ticks1 - ticks2 + _TICKS_HALF) & _TICKS_MAX) - _TICKS_HALF
+
+    def sleep_ms(self, ms):
+        self.advance_us(int(ms * 1000))
+
+    def sleep_us(self, us):
+        self.advance_us(int(us))
+
+    def install(self, time_module):
+        for name in ('ticks_ms', 'ticks_us', 'ticks_add', 'ticks_diff', 'sleep_ms', 'sleep_us'):
+            setattr(time_module, name, getattr(self, name))
@@ -0,0 +1,58 @@
+# A rider pedalling a simulated bike: pulses the crank sensor pin twice per
+# revolution (see kinematics.PULSES_PER_REVOLUTION), with some jitter and
+# optionally a contact bounce after each pulse for the debounce to reject.
+
+import random
+import time
+
+import kinematics
+
+
+class CrankGenerator:
+    def __init__(self, sched, pin, rpm=80, jitter=0.05, bounce_ms=0, seed=None):
+        """rpm is a number, or a function of the ms since start() returning
+        one. 0 rpm stops the pedals."""
+        self.sched = sched
+        self.pin = pin
+        self.rpm = rpm
+        self.jitter = jitter
+        self.bounce_ms = bounce_ms
+        self.pulses = 0
+        self.bounces = 0
+        self._rnd = random.Random(seed)
+        self._start_ms = None
+        self._timer = None
+
+    def start(self):
+        self._start_ms = time.ticks_ms()
+        self._schedule()
+
+    def stop(self):
+        self.sched.cancel(self._timer)
+        self._timer = None
+
+    def current_rpm(self):
+        if callable(self.rpm):
+            return self.rpm(time.ticks_diff(time.ticks_ms(), self._start_ms))
+        return self.rpm
+
+    def _schedule(self):
+        rpm = self.current_rpm()
+        if rpm <= 0:
+            # look again later
+            self._timer = self.sched.after(100, self._schedule)
+            return
+        interval = 60000.0 / (rpm * kinematics.PULSES_PER_REVOLUTION)
+        interval *= 1 + self._rnd.uniform(-self.jitter, self.jitter)
+        self._timer = self.sched.after(max(1, int(interval)), self._pulse)
+
+    def _pulse(self):
+        self.pulses += 1
+        self.pin.pulse()
+        if self.bounce_ms:
+            self.sched.after(self._rnd.randint(1, self.bounce_ms), self._bounce)
+        self._schedule()
+
+    def _bounce(self):
+        self.bounces += 1
+        self.pin.pulse()
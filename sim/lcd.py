@@ -0,0 +1,94 @@
+# HD44780 character display on the pins of a simulated board. Decodes what
+# Adafruit_LCD.CharLCD writes to them, in 4 bit mode, so the simulation can
+# show what the rider would see. The bikes' 16x1 displays are addressed as
+# two lines of 8 characters side by side, lines=1 shows them that way.
+
+# DDRAM addresses of the two lines in 2 line mode
+_LINE_START = (0x00, 0x40)
+
+
+class VirtualLCD:
+    def __init__(self, board, rs, en, d4, d5, d6, d7, cols=16, lines=2):
+        self.cols = cols
+        self.lines = lines
+        self.ddram = bytearray(b' ' * 0x80)
+        self.address = 0
+        self.increment = 1
+        self.display_on = False
+        self.commands = 0
+        self.chars = 0
+        # the controller starts in 8 bit mode, the host switches it to 4 bits
+        self._four_bit = False
+        self._high = None
+        self._enabled = 0
+        self._pins = {}
+        for name, pin in (('rs', rs), ('d4', d4), ('d5', d5), ('d6', d6), ('d7', d7)):
+            board.watch(pin, self._data_pin(name))
+        board.watch(en, self._enable)
+
+    def _data_pin(self, name):
+        def watcher(pin):
+            self._pins[name] = pin
+        return watcher
+
+    def _bit(self, name):
+        pin = self._pins.get(name)
+        return pin.value() if pin else 0
+
+    def _enable(self, pin):
+        value = pin.value()
+        falling = self._enabled and not value
+        self._enabled = value
+        if not falling:
+            return
+        # data is latched on the falling edge of enable
+        nibble = (self._bit('d4') | self._bit('d5') << 1 |
+                  self._bit('d6') << 2 | self._bit('d7') << 3)
+        if not self._four_bit:
+            # D0-D3 aren't wired up, they read as 0
+            self._write(nibble << 4, False)
+        elif self._high is None:
+            self._high = nibble
+        else:
+            self._write(self._high << 4 | nibble, self._bit('rs'))
+            self._high = None
+
+    def _write(self, value, char_mode):
+        if char_mode:
+            self.chars += 1
+            self.ddram[self.address] = value
+            self.address = (self.address + self.increment) & 0x7F
+            return
+        self.commands += 1
+        if value & 0x80:
+            self.address = value & 0x7F
+        elif value & 0x40:
+            pass    # CGRAM address, custom characters aren't shown
+        elif value & 0x20:
+            self._four_bit = not value & 0x10
+        elif value & 0x10:
+            pass    # cursor or display shift
+        elif value & 0x08:
+            self.display_on = bool(value & 0x04)
+        elif value & 0x04:
+            self.increment = 1 if value & 0x02 else -1
+        elif value & 0x02:
+            self.address = 0
+        elif value & 0x01:
+            self.ddram[:] = b' ' * len(self.ddram)
+            self.address = 0
+
+    def rows(self):
+        """The text on the display, one string per line."""
+        if self.lines == 1:
+            half = self.cols // 2
+            row = self.ddram[0:half] + self.ddram[_LINE_START[1]:_LINE_START[1] + half]
+            return [bytes(row).decode('ascii', 'replace')]
+        rows = []
+        for line in range(min(self.lines, len(_LINE_START))):
+            start = _LINE_START[line]
+            rows.append(bytes(self.ddram[start:start + self.cols]).decode('ascii', 'replace'))
+        return rows
+
+    def text(self):
+        return '\n'.join(self.rows())
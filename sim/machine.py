@@ -0,0 +1,91 @@
+# Stand-in for the Pycom machine module. Pins belong to the board that is
+# current when they are created, so several simulated devices can use the
+# same pin names.
+
+import random
+
+_rng = random.Random()
+
+
+class Board:
+    """The pins of one simulated device."""
+
+    def __init__(self, name):
+        self.name = name
+        self.pins = {}
+        self._watchers = {}     # pin name -> callbacks for pins not created yet
+
+    def pin(self, name):
+        return self.pins.get(name)
+
+    def watch(self, name, callback):
+        """Call callback(pin) on every write to pin name, which may be
+        created later (devices set their pins up in their constructors)."""
+        pin = self.pins.get(name)
+        if pin:
+            pin.watchers.append(callback)
+        else:
+            self._watchers.setdefault(name, []).append(callback)
+
+
+current_board = Board('default')
+
+
+def use_board(board):
+    global current_board
+    current_board = board
+    return board
+
+
+def seed(value):
+    _rng.seed(value)
+
+
+def rng():
+    # 24 bit hardware random number
+    return _rng.getrandbits(24)
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_FALLING = 1
+    IRQ_RISING = 2
+    IRQ_LOW_LEVEL = 4
+    IRQ_HIGH_LEVEL = 8
+
+    def __init__(self, id, mode=IN, pull=None, value=None, alt=None):
+        self.id = id
+        self.mode = mode
+        self.pull = pull
+        self._value = 0 if value is None else int(bool(value))
+        self._handler = None
+        self._trigger = 0
+        # called with the pin on every write, see sim.lcd
+        self.watchers = current_board._watchers.pop(id, [])
+        self.board = current_board
+        current_board.pins[id] = self
+
+    def __call__(self, value=None):
+        if value is None:
+            return self._value
+        self.value(value)
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        self._value = int(bool(value))
+        for watcher in self.watchers:
+            watcher(self)
+
+    def irq(self, trigger=IRQ_FALLING, handler=None):
+        self._trigger = trigger
+        self._handler = handler
+
+    def pulse(self):
+        """An external edge on the pin, runs the IRQ handler if there is one."""
+        if self._handler:
+            self._handler(self)
@@ -0,0 +1,125 @@
+# Stand-in for paho.mqtt.client, installed by sim.install(). Clients talk to
+# an in-process Broker which delivers every message to the matching
+# subscribers synchronously, from the thread that published it. NullClient
+# is the client behind a Publisher that nobody listens to, for replay.py
+# and the benchmarks.
+
+import threading
+import time
+
+STALL_S = 0.05
+
+
+class MQTTMessage:
+    def __init__(self, topic, payload, qos=0, retain=False):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+
+
+class MQTTMessageInfo:
+    rc = 0
+    mid = 0
+
+    def wait_for_publish(self, timeout=None):
+        pass
+
+    def is_published(self):
+        return True
+
+
+def topic_matches(pattern, topic):
+    """MQTT topic filter matching, with the + and # wildcards."""
+    parts = topic.split('/')
+    for i, level in enumerate(pattern.split('/')):
+        if level == '#':
+            return True
+        if i >= len(parts) or (level != '+' and level != parts[i]):
+            return False
+    return len(parts) == len(pattern.split('/'))
+
+
+class Broker:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._subscriptions = []    # (topic filter, client)
+        self.messages = []          # (topic, payload) of everything published
+
+    def subscribe(self, client, topic):
+        with self._lock:
+            self._subscriptions.append((topic, client))
+
+    def publish(self, topic, payload):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        with self._lock:
+            self.messages.append((topic, payload))
+            targets = [client for pattern, client in self._subscriptions
+                       if topic_matches(pattern, topic)]
+        for client in targets:
+            client._deliver(MQTTMessage(topic, payload))
+
+
+broker = Broker()
+
+
+class Client:
+    def __init__(self, client_id='', clean_session=None, userdata=None, broker=None, **kwargs):
+        self.client_id = client_id
+        self._userdata = userdata
+        self.broker = broker or globals()['broker']
+        self.on_connect = None
+        self.on_message = None
+        self.published = 0
+
+    def user_data_set(self, userdata):
+        self._userdata = userdata
+
+    def tls_set(self, *args, **kwargs):
+        pass
+
+    def connect(self, host='localhost', port=1883, keepalive=60, **kwargs):
+        if self.on_connect:
+            self.on_connect(self, self._userdata, {}, 0)
+        return 0
+
+    def disconnect(self):
+        return 0
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def subscribe(self, topic, qos=0):
+        self.broker.subscribe(self, topic)
+        return 0, 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published += 1
+        self.broker.publish(topic, payload)
+        return MQTTMessageInfo()
+
+    def _deliver(self, message):
+        if self.on_message:
+            self.on_message(self, self._userdata, message)
+
+
+class NullClient:
+    """Counts what is published and drops it. Every publish() takes
+    broker_ms, as the round trip to a broker would, and every stall_every-th
+    one stalls for STALL_S."""
+
+    def __init__(self, broker_ms=0, stall_every=0):
+        self.delay = broker_ms / 1000.0
+        self.stall_every = stall_every
+        self.published = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published += 1
+        if self.stall_every and self.published % self.stall_every == 0:
+            time.sleep(STALL_S)
+        elif self.delay:
+            time.sleep(self.delay)
@@ -0,0 +1,68 @@
+# Stand-in for the Pycom network module. LoRa radios are attached to the
+# current medium (see sim.radio), WLAN is always connected: the simulated
+# gateways reach the server over real sockets on localhost.
+
+import collections
+
+medium = None
+
+# the fields of the Pycom LoRa.stats() tuple the gateway reads
+LoRaStats = collections.namedtuple('LoRaStats', ('rssi', 'snr'))
+
+
+def use_medium(m):
+    global medium
+    medium = m
+    return m
+
+
+class LoRa:
+    LORA = 0
+    EU868 = 5
+
+    def __init__(self, mode=LORA, region=EU868, tx_iq=False, rx_iq=False, **kwargs):
+        self.tx_iq = tx_iq
+        self.rx_iq = rx_iq
+        self.rx = collections.deque()
+        self.tx_end_ms = None   # set by the medium
+        self.rssi = 0
+        self.snr = 0
+        self.medium = medium
+        if medium is not None:
+            medium.attach(self)
+
+    def send(self, data, block=True):
+        if self.medium is not None:
+            self.medium.transmit(self, data)
+
+    def recv(self):
+        if not self.rx:
+            return None
+        data, self.rssi, self.snr = self.rx.popleft()
+        return data
+
+    def recv_into(self, buf):
+        if not self.rx:
+            return 0
+        data, self.rssi, self.snr = self.rx.popleft()
+        buf[:len(data)] = data
+        return len(data)
+
+    def stats(self):
+        # of the last packet received, the fields the gateway uses
+        return LoRaStats(self.rssi, self.snr)
+
+
+class WLAN:
+    STA = 0
+    AP = 1
+    WPA2 = 3
+
+    def __init__(self, mode=STA, ssid=None, auth=None, **kwargs):
+        self.mode = mode
+
+    def connect(self, ssid=None, auth=None, timeout=None, **kwargs):
+        pass
+
+    def isconnected(self):
+        return True
@@ -0,0 +1,91 @@
+# The LoRa channel shared by the simulated bikes and gateways. A packet is
+# on air for frame.airtime_ms() and is delivered when that is over, to
+# every radio listening with the matching IQ setting (the gateway transmits
+# with tx_iq, the bikes receive with rx_iq, so bikes never hear each other).
+# A packet is lost if another one with the same IQ setting overlaps it on
+# air, if the receiver is transmitting itself (the radios are half duplex)
+# or at random with probability loss. Every sender and receiver pair gets
+# a fixed RSSI and SNR, as if the bikes stood still, that the receiver's
+# LoRa.stats() reports for the packets it hears.
+
+import random
+import time
+
+import frame
+
+
+class Transmission:
+    __slots__ = ('sender', 'data', 'start_ms', 'end_ms', 'collided')
+
+    def __init__(self, sender, data, start_ms, end_ms):
+        self.sender = sender
+        self.data = data
+        self.start_ms = start_ms
+        self.end_ms = end_ms
+        self.collided = False
+
+
+class Medium:
+    def __init__(self, sched, loss=0.0, collisions=True, seed=None):
+        self.sched = sched
+        self.loss = loss
+        self.collisions = collisions
+        self.radios = []
+        self._on_air = []
+        self._links = {}    # (sender, receiver) -> (rssi, snr)
+        self._rnd = random.Random(seed)
+        # statistics, per packet sent and per copy delivered or lost
+        self.sent = 0
+        self.airtime_ms = 0
+        self.delivered = 0
+        self.collided = 0
+        self.lost = 0
+        self.deaf = 0       # receiver was transmitting
+
+    def attach(self, radio):
+        self.radios.append(radio)
+
+    def transmit(self, sender, data):
+        now = time.ticks_ms()
+        airtime = frame.airtime_ms(len(data))
+        tx = Transmission(sender, bytes(data), now, time.ticks_add(now, airtime))
+        if self.collisions:
+            for other in self._on_air:
+                if (other.sender.tx_iq == sender.tx_iq and
+                        time.ticks_diff(other.end_ms, now) > 0):
+                    other.collided = True
+                    tx.collided = True
+        self._on_air.append(tx)
+        sender.tx_end_ms = tx.end_ms
+        self.sent += 1
+        self.airtime_ms += airtime
+        self.sched.after(airtime, lambda: self._deliver(tx))
+
+    def _deliver(self, tx):
+        self._on_air.remove(tx)
+        for radio in self.radios:
+            if radio is tx.sender or radio.rx_iq != tx.sender.tx_iq:
+                continue
+            if tx.collided:
+                self.collided += 1
+            elif radio.tx_end_ms is not None and time.ticks_diff(radio.tx_end_ms, tx.start_ms) > 0:
+                # its last transmission overlaps this one, the earlier ones can't
+                self.deaf += 1
+            elif self._rnd.random() < self.loss:
+                self.lost += 1
+            else:
+                self.delivered += 1
+                radio.rx.append((tx.data,) + self.link(tx.sender, radio))
+
+    def link(self, sender, receiver):
+        key = (id(sender), id(receiver))
+        link = self._links.get(key)
+        if link is None:
+            link = self._links[key] = (self._rnd.randint(-120, -60),
+                                       round(self._rnd.uniform(-10.0, 10.0), 1))
+        return link
+
+    def stats(self):
+        return {'sent': self.sent, 'airtime_ms': self.airtime_ms,
+                'delivered': self.delivered, 'collided': self.collided,
+                'lost': self.lost, 'deaf': self.deaf}
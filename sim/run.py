@@ -0,0 +1,230 @@
+# Simulates an event: N bikes, G gateways sharing one LoRa channel, the
+# ingest server and a dashboard starting a ride on every bike over MQTT.
+# Everything runs in this process on one Scheduler and a virtual clock,
+# so a few minutes of riding take seconds. The gateways talk to the ingest
+# server over real sockets on localhost.
+#
+#   $ python3 -m sim.run [--bikes N] [--gateways G] [--duration S] [--loss P]
+#                        [--seed S] [--rpm R] [--bounce-ms MS] [--trace]
+#                        [--metrics] [--log FILE]
+#
+# Prints what the server published for every bike, the radio statistics
+# and what the LCDs show at the end, with --metrics the server's metrics
+# page too.
+
+import argparse
+import collections
+import contextlib
+import json
+import os
+import sys
+
+import sim
+
+# a bike's pins, as wired up in rider.make_bike()
+CRANK_PIN = 'G5'
+LCD_PINS = ('G11', 'G12', 'G15', 'G16', 'G13', 'G28')
+
+FIRST_START_MS = 3000   # give the gateways time to connect
+# gateways are powered up this far apart, their frames and polls don't line up
+GATEWAY_STAGGER_MS = 1237
+
+
+class Event:
+    def __init__(self, bikes=4, gateways=1, loss=0.0, seed=1, rpm=80,
+                 bounce_ms=0, trace=False, start_gap_ms=2000, start_ms=0,
+                 coalesce_s=None, capture_path=None):
+        self.clock = sim.install(seed, start_ms)
+        self.start_ms = self.clock.ms()
+        # the device modules can only be imported once the stand-ins are in
+        from sim import machine, network, mqtt
+        from sim.crank import CrankGenerator
+        from sim.lcd import VirtualLCD
+        from sim.radio import Medium
+        from scheduler import Scheduler
+        from publisher import Publisher
+        import gateway
+        import rider
+        import server
+
+        self.sched = Scheduler()
+        self.medium = network.use_medium(Medium(self.sched, loss, seed=seed))
+        self.broker = mqtt.broker
+
+        # server: ingest socket on any free port, records published to the broker
+        self.capture = None
+        if capture_path:
+            from capture import CaptureWriter
+            self.capture = CaptureWriter(capture_path, clock=self.seconds)
+        self.ingest = server.IngestServer(0, capture=self.capture)
+        # the merge and coalescing windows are in simulated time
+        self.ingest.merger.clock = self.ingest.coalescer.clock = self.seconds
+        self.ingest.leaderboard.clock = self.ingest.clock = self.seconds
+        if coalesce_s is not None:
+            self.ingest.coalescer.window_s = coalesce_s
+        port = self.ingest.listener.getsockname()[1]
+        client = mqtt.Client(userdata=self.ingest)
+        client.on_connect = server.on_connect
+        client.on_message = server.on_message
+        client.connect(server.awshost, server.awsport)
+        self.ingest.publisher = Publisher(client, tracker=self.ingest.latency)
+        self.ingest.publisher.start()
+        self.sched.every(5, lambda: self.ingest.poll(0))
+
+        gateway.TCP_IP = '127.0.0.1'
+        gateway.TCP_PORT = port
+        gateway.BACKLOG_SPILL_PATH = None
+        gateway.TRACE_LATENCY = trace
+        self.gateways = []
+        for i in range(gateways):
+            if i:
+                self.clock.sleep_ms(GATEWAY_STAGGER_MS)
+            machine.use_board(machine.Board('gateway{}'.format(i)))
+            g = gateway.NanoGateWay(self.sched)
+            g.start()
+            self.gateways.append(g)
+
+        self.bikes = []
+        self.lcds = []
+        self.cranks = []
+        for i in range(bikes):
+            bike_id = i + 1
+            board = machine.use_board(machine.Board('bike{}'.format(bike_id)))
+            lcd = VirtualLCD(board, *LCD_PINS, cols=16, lines=1)
+            bike = rider.make_bike(bike_id, self.sched)
+            bike.start()
+            crank = CrankGenerator(self.sched, board.pin(CRANK_PIN), rpm,
+                                   bounce_ms=bounce_ms, seed=seed * 1000 + bike_id)
+            crank.start()
+            self.bikes.append(bike)
+            self.lcds.append(lcd)
+            self.cranks.append(crank)
+            self.sched.after(FIRST_START_MS + i * start_gap_ms,
+                             lambda bike_id=bike_id: self.initialise(bike_id))
+
+        # what the dashboard sees
+        self.records = collections.defaultdict(list)
+        dashboard = mqtt.Client()
+        dashboard.on_message = self.on_message
+        # the records may be on per bike subtopics, see server.PER_BIKE_TOPICS
+        dashboard.subscribe(server.TOPIC + '/#')
+        self.dashboard = dashboard
+        self.topic = server.TOPIC
+        self.leaderboard_topic = server.LEADERBOARD_TOPIC
+
+    def seconds(self):
+        return self.clock.ms() / 1000.0
+
+    def initialise(self, bike_id):
+        self.dashboard.publish(self.topic, json.dumps(
+            {"RideStatus": "initalised", "RiderName": "Rider {}".format(bike_id),
+             "Company": "Sim", "BadgeNumber": 1000 + bike_id, "EventID": "sim",
+             "BikeID": bike_id}))
+
+    def on_message(self, client, userdata, msg):
+        record = json.loads(msg.payload.decode('ascii'))
+        if "RideInfo" in record or record.get("RideStatus") == "started":
+            self.records[int(record["BikeID"])].append(record)
+
+    def run(self, duration_ms):
+        end = self.clock.ms() + duration_ms
+        while self.clock.ms() < end:
+            self.sched.run_once()
+        self.ingest.coalescer.drain()
+        self.ingest.publisher.stop(5)
+        if self.capture:
+            self.capture.close_file()
+
+    def report(self, out=sys.stdout, metrics=False):
+        def p(*args, **kwargs):
+            print(*args, file=out, **kwargs)
+
+        p('{} bikes, {} gateways, {:.0f} s simulated'.format(
+            len(self.bikes), len(self.gateways), (self.clock.ms() - self.start_ms) / 1000.0))
+        p()
+        p('{:>4} {:>9} {:>8} {:>9} {:>8}  {}'.format(
+            'bike', 'state', 'records', 'ridden', 'pulses', 'statuses'))
+        import kinematics
+
+        for bike, lcd, crank in zip(self.bikes, self.lcds, self.cranks):
+            records = self.records.get(bike.bike_id, [])
+            statuses = []
+            for record in records:
+                status = record["RideStatus"]
+                if statuses and statuses[-1][0] == status:
+                    statuses[-1][1] += 1
+                else:
+                    statuses.append([status, 1])
+            p('{:>4} {:>9} {:>8} {:>8}m {:>8}  {}'.format(
+                bike.bike_id, bike.state, len(records), kinematics.metres(bike.rider.distance_travelled), crank.pulses,
+                ' '.join('{}x{}'.format(s, n) if n > 1 else s for s, n in statuses)))
+        p()
+        p('LoRa: ' + json.dumps(self.medium.stats()))
+        for i, g in enumerate(self.gateways):
+            p('Gateway {}: {}'.format(i, json.dumps(
+                {'retries': g.retries.retries, 'failed': g.retries.failed,
+                 'duplicates': g.dedup.duplicates, 'slots': g.slots.active(),
+                 'backlog': len(g.backlog)})))
+            p('Gateway {} counters: {}'.format(i, json.dumps(g.metrics.counters, sort_keys=True)))
+        for bike in self.bikes:
+            p('Bike {}: {}'.format(bike.bike_id, json.dumps(
+                {'retries': bike.retries.retries, 'failed': bike.retries.failed,
+                 'bounced': bike.crank.bounced, 'missed': bike.crank.missed})))
+        p('Server: ' + json.dumps(self.ingest.stats()))
+        p('Publisher: ' + json.dumps(self.ingest.publisher.stats()))
+        p('Merge: ' + json.dumps(self.ingest.merger.stats()))
+        p('Coalescer: ' + json.dumps(self.ingest.coalescer.stats()))
+        p('Rides: ' + json.dumps(self.ingest.leaderboard.stats()))
+        board = None
+        for topic, payload in self.broker.messages:
+            if topic == self.leaderboard_topic:
+                board = payload
+        if board:
+            p('Leaderboard: ' + board.decode('ascii'))
+        # the virtual clock runs ahead of the server's, which keeps the
+        # TCP stage at 0 here
+        for stage, stats in self.ingest.latency.stats().items():
+            p('Latency {:<8} {}'.format(stage, json.dumps(stats)))
+        p()
+        for bike, lcd in zip(self.bikes, self.lcds):
+            p('LCD {}: {}'.format(bike.bike_id, ' | '.join(lcd.rows())))
+        if metrics:
+            p()
+            p(self.ingest.metrics_text(self.seconds()), end='')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate bikes, gateways and the server.')
+    parser.add_argument('--bikes', type=int, default=4)
+    parser.add_argument('--gateways', type=int, default=1)
+    parser.add_argument('--duration', type=float, default=90, help='seconds')
+    parser.add_argument('--loss', type=float, default=0.0, help='LoRa packet loss ratio')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--rpm', type=float, default=80)
+    parser.add_argument('--bounce-ms', type=int, default=0,
+                        help='crank sensor contact bounce after each pulse')
+    parser.add_argument('--trace', action='store_true',
+                        help='trace the latency of every record, see latency.py')
+    parser.add_argument('--start-ms', type=int, default=0,
+                        help='initial ticks, close to 2**30 to test wraparound')
+    parser.add_argument('--coalesce', type=float,
+                        help='seconds between the records published per bike, see coalesce.py')
+    parser.add_argument('--capture', help='record what the server receives, for replay.py')
+    parser.add_argument('--metrics', action='store_true',
+                        help="print the server's metrics page, see metrics.py")
+    parser.add_argument('--log', help='file for what the devices print, discarded by default')
+    args = parser.parse_args()
+
+    stdout = sys.stdout
+    log = open(args.log or os.devnull, 'w')
+    with contextlib.redirect_stdout(log):
+        event = Event(args.bikes, args.gateways, args.loss, args.seed, args.rpm,
+                      args.bounce_ms, args.trace, start_ms=args.start_ms,
+                      coalesce_s=args.coalesce, capture_path=args.capture)
+        event.run(int(args.duration * 1000))
+    log.close()
+    event.report(stdout, args.metrics)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+# Stand-in for uselect, used by scheduler.py. Sockets are real, time is
+# not: poll() only ever looks at the sockets without waiting, and when
+# nothing is ready it moves the virtual clock on by the timeout instead.
+
+import select as _select
+
+POLLIN = _select.POLLIN
+POLLOUT = _select.POLLOUT
+POLLERR = _select.POLLERR
+POLLHUP = _select.POLLHUP
+
+clock = None    # set by sim.install()
+
+
+class _Poll:
+    def __init__(self):
+        self._poll = _select.poll()
+
+    def register(self, obj, eventmask=POLLIN | POLLOUT):
+        self._poll.register(obj, eventmask)
+
+    def unregister(self, obj):
+        self._poll.unregister(obj)
+
+    def modify(self, obj, eventmask):
+        self._poll.modify(obj, eventmask)
+
+    def poll(self, timeout=-1):
+        events = self._poll.poll(0)
+        if not events and timeout and timeout > 0:
+            clock.sleep_ms(timeout)
+        return events
+
+
+def poll():
+    return _Poll()
@@ -0,0 +1,131 @@
+import time
+
+try:
+    from micropython import const
+except ImportError:
+    def const(x):
+        return x
+
+# Time slotted uplink shared by rider.py and gateway.py. The gateway splits
+# time in frames of SLOT_COUNT slots. Slot 0 is kept for the gateway's own
+# transmissions, its beacons and the commands and ACKs queued since the last
+# frame. Every riding bike gets one of the other slots with the start
+# command and only transmits in it. Every downlink carries the phase of the
+# gateway's frame at the time it was sent, which the bikes use to keep their
+# idea of the frame start in sync.
+
+SLOT_MS = const(100)
+SLOT_COUNT = const(25)
+FRAME_MS = const(2500)      # SLOT_MS * SLOT_COUNT, one uplink per bike per frame
+BEACON_SLOT = const(0)
+BEACON_PERIOD_MS = const(10000)
+
+# Transmit this far into the slot, to absorb the clock drift between beacons.
+GUARD_MS = const(15)
+# Time on air of a downlink frame at SF7 / 125kHz, the bikes receive it this
+# long after the gateway timestamped it.
+DOWNLINK_AIRTIME_MS = const(41)
+
+
+class SlotAllocator:
+    """Gateway side, hands out slots to the bikes that are riding."""
+
+    def __init__(self, slot_count=SLOT_COUNT):
+        self.slot_count = slot_count
+        self._owner = [None] * slot_count
+        self._owner[BEACON_SLOT] = -1
+        self._slot = {}     # bike id -> slot
+        self.epoch = time.ticks_ms()
+
+    def assign(self, bike_id):
+        """Returns the slot of bike_id, or None if they are all taken."""
+        if bike_id in self._slot:
+            return self._slot[bike_id]
+        for slot in range(self.slot_count):
+            if self._owner[slot] is None:
+                self._owner[slot] = bike_id
+                self._slot[bike_id] = slot
+                return slot
+        return None
+
+    def release(self, bike_id):
+        slot = self._slot.pop(bike_id, None)
+        if slot is not None:
+            self._owner[slot] = None
+
+    def active(self):
+        return len(self._slot)
+
+    def slot_of(self, bike_id):
+        return self._slot.get(bike_id)
+
+    def phase(self, ticks=None):
+        """Time into the frame at ticks, now by default. The current phase
+        is sent along with every downlink."""
+        if ticks is None:
+            ticks = time.ticks_ms()
+        return time.ticks_diff(ticks, self.epoch) % (SLOT_MS * self.slot_count)
+
+    def in_slot(self, bike_id, tx_ms):
+        """True if bike_id started transmitting at tx_ms (ticks) in the slot
+        it has here, i.e. it keeps time with this gateway's frames. False
+        for a bike without a slot here."""
+        slot = self._slot.get(bike_id)
+        return slot is not None and self.phase(tx_ms) // SLOT_MS == slot
+
+
+class SlotClock:
+    """Bike side, tracks the gateway's frames and the bike's slot in them."""
+
+    def __init__(self):
+        self.slot = None
+        self.slot_ms = SLOT_MS
+        self.frame_ms = FRAME_MS
+        self.frame_start = 0
+        self.last_tx = None
+
+    def assign(self, slot, slot_count, slot_ms):
+        if slot_count:
+            self.slot = slot
+            self.slot_ms = slot_ms
+            self.frame_ms = slot_ms * slot_count
+        else:
+            # the gateway ran out of slots, fall back to unscheduled uplinks
+            self.slot = None
+        self.last_tx = None
+
+    def release(self):
+        self.slot = None
+
+    def active(self):
+        return self.slot is not None
+
+    def sync(self, phase_ms, rx_ms):
+        """Align the frames with a downlink received at rx_ms (ticks)."""
+        self.frame_start = time.ticks_add(rx_ms, -(phase_ms + DOWNLINK_AIRTIME_MS))
+
+    def ms_until_slot(self, now, airtime_ms=0):
+        """Time until the bike may transmit a frame of airtime_ms next, 0 if
+        it may do so now. The frame has to be off the air GUARD_MS before
+        the slot ends, one that doesn't fit in the rest of the slot waits for
+        the next frame."""
+        if self.slot is None:
+            return 0
+        tx_at = time.ticks_add(self.frame_start, self.slot * self.slot_ms + GUARD_MS)
+        offset = time.ticks_diff(now, tx_at) % self.frame_ms
+        # tx_at is already GUARD_MS into the slot
+        if offset + airtime_ms <= self.slot_ms - 2 * GUARD_MS and not self._sent_in_slot(now):
+            return 0
+        return self.frame_ms - offset
+
+    def sent(self, now):
+        self.last_tx = now
+
+    def _sent_in_slot(self, now):
+        return self.last_tx is not None and time.ticks_diff(now, self.last_tx) < self.slot_ms
+
+    def wait(self, airtime_ms=0):
+        """Sleep until the bike's slot comes up."""
+        delay = self.ms_until_slot(time.ticks_ms(), airtime_ms)
+        if delay:
+            time.sleep_ms(delay)
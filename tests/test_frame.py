@@ -0,0 +1,57 @@
+import pytest
+
+import frame
+
+SAMPLES = [(2000, 1226), (1500, 1228), (1000, 1230), (500, 1232)]
+
+
+def test_uplink_round_trip():
+    packet = frame.encode_uplink(7, frame.STATUS_RUNNING, 1234, 312, 17, SAMPLES)
+    assert len(packet) == frame.uplink_size(len(SAMPLES))
+    assert frame.decode_uplink(packet) == (7, frame.STATUS_RUNNING, 1234, 312, 17, SAMPLES, None, None)
+
+
+def test_uplink_round_trip_with_seq():
+    packet = frame.encode_uplink(7, frame.STATUS_FINISHED, 0xFFFF, 500, 300, (), seq=0x1A5)
+    assert len(packet) == frame.uplink_size(0, trailer=True)
+    # speed saturates at 255, seq is a byte
+    assert frame.decode_uplink(packet) == (7, frame.STATUS_FINISHED, 0xFFFF, 500, 255, [], 0xA5, None)
+
+
+def test_timed_uplink_round_trip():
+    # the finish report, with the start of the ride
+    packet = frame.encode_uplink(7, frame.STATUS_FINISHED, 1234, -3, 17, SAMPLES[-1:], seq=4,
+                                 start_age=95000)
+    assert len(packet) == frame.uplink_size(1, trailer=True, timed=True)
+    assert frame.decode_uplink(packet) == (7, frame.STATUS_FINISHED, 1234, -3, 17, SAMPLES[-1:], 4, 95000)
+    packet = frame.encode_uplink(7, frame.STATUS_FINISHED, 1234, -3, 17, start_age=70000)
+    assert frame.decode_uplink(packet)[5:] == ([], None, 70000)
+
+
+def test_uplink_bad_crc():
+    packet = frame.encode_uplink(7, frame.STATUS_RUNNING, 1234, 312, 17, SAMPLES)
+    packet[3] ^= 0x01
+    with pytest.raises(ValueError):
+        frame.decode_uplink(packet)
+
+
+def test_uplink_bad_trailer_crc_drops_seq():
+    # the frame itself is intact, only its sequence number can't be trusted
+    packet = frame.encode_uplink(7, frame.STATUS_IDLE, 1234, 312, 17, seq=9)
+    packet[-1] ^= 0xFF
+    assert frame.decode_uplink(packet)[6] is None
+
+
+def test_downlink_round_trip_with_seq():
+    packet = frame.encode_downlink(frame.CMD_START, 7, 1234, 3, 25, 100, seq=42)
+    assert len(packet) == frame.downlink_size(trailer=True)
+    assert frame.decode_downlink(packet) == (frame.CMD_START, 7, 1234, 3, 25, 100, 42)
+    beacon = frame.encode_downlink(frame.CMD_BEACON, frame.BROADCAST_ID, 99)
+    assert frame.decode_downlink(beacon) == (frame.CMD_BEACON, 0, 99, 0, 0, 0, None)
+
+
+def test_downlink_bad_crc():
+    packet = frame.encode_downlink(frame.CMD_ABORT, 7, 1234, seq=1)
+    packet[1] ^= 0x80
+    with pytest.raises(ValueError):
+        frame.decode_downlink(packet)
@@ -0,0 +1,47 @@
+import wire
+from framing import LineFramer
+
+
+def binary_records():
+    writer = wire.FrameWriter()
+    writer.ride(5, 7, wire.ride_fields("Rider 7", "ACME", 12345, "event-1", "1500000000.5"))
+    writer.begin(5, wire.STATUS_INDEX['counting'])
+    writer.add_info(100000, 1234, 5678)
+    writer.add_info(100500, 1236, 5682)
+    return bytes(writer.end())
+
+
+def frame_all(framer, data, chunk):
+    # fed a few bytes at a time, as the reads of a socket may cut it
+    records = []
+    for i in range(0, len(data), chunk):
+        part = data[i:i + chunk]
+        while part:
+            n = framer.feed(part)
+            part = part[n:]
+            records.extend(bytes(record) for record in framer.records())
+    return records
+
+
+def test_mixed_json_and_binary():
+    binary = binary_records()
+    ride_length = wire.HEADER_SIZE + (binary[1] << 8 | binary[2])
+    ride, info = binary[:ride_length], binary[ride_length:]
+    data = b'{"Protocol": "binary", "Version": 2}\n' + ride + b'{"Health": {}}\r\n' + info + b'{"a": 1}\n'
+    expected = [b'{"Protocol": "binary", "Version": 2}', ride, b'{"Health": {}}', info, b'{"a": 1}']
+    for chunk in (1, 3, 7, len(data)):
+        assert frame_all(LineFramer(64, binary=True), data, chunk) == expected
+
+
+def test_text_only_framer_splits_lines():
+    data = b'{"a": 1}\n\n{"b": 2}\r\n{"c"'
+    framer = LineFramer(64)
+    assert frame_all(framer, data, 5) == [b'{"a": 1}', b'{"b": 2}']
+    assert framer.pending() == 4
+
+
+def test_oversized_record_is_dropped():
+    framer = LineFramer(16)
+    data = b'{"long": "' + b'x' * 40 + b'"}\n{"ok": 1}\n'
+    assert frame_all(framer, data, 8) == [b'{"ok": 1}']
+    assert framer.overflows == 1
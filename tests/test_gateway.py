@@ -0,0 +1,109 @@
+import errno
+import json
+
+import sim
+
+sim.install(seed=1)
+
+import frame  # noqa: E402
+import gateway  # noqa: E402
+
+UPLINK = (7, frame.STATUS_RUNNING, 1234, 312, 17, [(1000, 1230), (500, 1232)])
+
+
+class BusySocket:
+    """Takes the first accept bytes of whatever is sent, then is busy."""
+
+    def __init__(self, accept=0):
+        self.accept = accept
+        self.data = bytearray()
+
+    def send(self, data):
+        n = min(self.accept, len(data))
+        if not n:
+            raise OSError(errno.EAGAIN, 'EAGAIN')
+        self.accept -= n
+        self.data += data[:n]
+        return n
+
+    def fileno(self):
+        return -1
+
+    def close(self):
+        pass
+
+
+def connected_gateway(sock):
+    gateway.BACKLOG_SPILL_PATH = None
+    g = gateway.NanoGateWay()
+    g.new_rider("Rider 7", "ACME", 12345, 7, "event-1", "1500000000.5")
+    g.sock = sock
+    g.connected = True
+    g.binary = True
+    return g
+
+
+def backlog_lines(g):
+    buf = bytearray(gateway.BACKLOG_BATCH_SIZE)
+    lines = []
+    while len(g.backlog):
+        n, records = g.backlog.batch(buf)
+        lines.extend(bytes(buf[:n]).splitlines(True))
+        g.backlog.drop(records)
+    return lines
+
+
+def process(g, count):
+    packet = bytes(frame.encode_uplink(*UPLINK))
+    for _ in range(count):
+        g.process_lora(packet, 100000)
+
+
+def test_backlog_only_holds_json_lines():
+    # the socket is busy, binary records fall back to JSON lines
+    g = connected_gateway(BusySocket())
+    process(g, 3)
+    g.disconnect()
+    lines = backlog_lines(g)
+    assert len(lines) == 3
+    assert all(line.startswith(b'{') and line.endswith(b'\n') for line in lines)
+    assert g.metrics.counters.get('records_binary') is None
+
+
+def test_partial_binary_record_is_dropped_on_disconnect():
+    g = connected_gateway(BusySocket(accept=10))
+    process(g, 3)
+    assert g.sock.data[0] == 0x81   # the ride definition, cut short
+    assert g.tx_rest
+    g.disconnect()
+    lines = backlog_lines(g)
+    # the two records after the one cut short
+    assert len(lines) == 2
+    assert all(line.startswith(b'{') for line in lines)
+
+
+def test_listening_gateway_forwards_but_does_not_answer():
+    g = connected_gateway(BusySocket())
+    g.process_server(b'{"RideStatus": "started", "Listen": true, "RiderName": "Rider 8", '
+                     b'"Company": "ACME", "BadgeNumber": 1, "EventID": "event-1", '
+                     b'"RideTimestamp": "1500000001.5", "BikeID": 8}')
+    assert 8 in g.riders and g.slots.slot_of(8) is None
+    assert not g.downlinks
+    packet = bytes(frame.encode_uplink(8, frame.STATUS_FINISHED, 1300, 500, 17, seq=3))
+    g.process_lora(packet, 100000)
+    # the gateway that started the bike sends the ACK
+    assert not g.downlinks
+    assert g.riders[8].status == 'finished'
+    assert len(g.tx_queue) == 1
+
+
+def test_finish_report_starts_with_the_start_of_the_ride():
+    g = connected_gateway(BusySocket())
+    packet = frame.encode_uplink(7, frame.STATUS_FINISHED, 80, -5, 17, [(1500, 76)], seq=3,
+                                 start_age=30000)
+    g.process_lora(bytes(packet), 100000)
+    record = json.loads(bytes(g.tx_queue[0]))
+    tx_ms = 100000 - frame.airtime_ms(len(packet))
+    assert record["RideStatus"] == "finished"
+    assert [(e["CounterTimestamp"], e["CrankCounter"]) for e in record["RideInfo"]] == \
+        [(tx_ms - 30000, 0), (tx_ms - 1500, 76), (tx_ms, 80)]
@@ -0,0 +1,98 @@
+import json
+
+from leaderboard import Leaderboard, TICKS_PERIOD
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def ride(board, gateway, bike_id, time_ms, pulses, start_ms=100000, finisher=None):
+    # a counting record, then the finish report: the start of the ride and
+    # the pulse that finished it time_ms later, sent a while after that
+    board.update(gateway, bike_id, 1000 + bike_id, "counting", "event-1", "Rider %d" % bike_id,
+                 "ACME", (start_ms + 500, 2), (start_ms + 500, 2))
+    end_ms = (start_ms + time_ms) % TICKS_PERIOD
+    board.update(finisher or gateway, bike_id, 1000 + bike_id, "finished", "event-1",
+                 "Rider %d" % bike_id, "ACME", (start_ms, 0), (end_ms, pulses))
+
+
+def published(board, clock):
+    # the first call only starts the period
+    board.due()
+    clock.now += board.period_s
+    return [json.loads(text) for text in board.due()]
+
+
+def test_ranked_by_time():
+    clock = Clock()
+    board = Leaderboard(top_n=3, clock=clock)
+    assert board.due() == []
+    for bike_id, time_ms in ((1, 30000), (2, 20000), (3, 40000), (4, 10000)):
+        ride(board, "gw1", bike_id, time_ms, 200)
+    summary, = published(board, clock)
+    assert summary["Finished"] == 4 and summary["Riding"] == 0
+    assert [(e["Rank"], e["BikeID"], e["TimeMs"]) for e in summary["Top"]] == \
+        [(1, 4, 10000), (2, 2, 20000), (3, 1, 30000)]
+    # the same distance, the fastest is the shortest time
+    assert summary["Top"][0]["Speed"] > summary["Top"][1]["Speed"]
+    assert summary["TimeMs"] == {"P50": 20000, "P90": 40000}
+    # nothing changed since
+    assert published(board, clock) == []
+
+
+def test_time_across_ticks_wrap():
+    clock = Clock()
+    board = Leaderboard(clock=clock)
+    ride(board, "gw1", 1, 15000, 200, start_ms=TICKS_PERIOD - 5000)
+    summary, = published(board, clock)
+    assert summary["Top"][0]["TimeMs"] == 15000
+
+
+def test_finish_from_another_gateway():
+    clock = Clock()
+    board = Leaderboard(clock=clock)
+    # the gateways' clocks have nothing in common
+    ride(board, "gw1", 1, 30000, 200, finisher="gw2")
+    board.update("gw1", 2, 1002, "counting", "event-1", "Rider 2", "ACME",
+                 (100500, 2), (100500, 2))
+    clock.now = 40.0
+    board.update("gw2", 2, 1002, "finished", "event-1", "Rider 2", "ACME",
+                 (7000000, 0), (7025000, 200))
+    summary, = published(board, clock)
+    assert [(e["BikeID"], e["TimeMs"]) for e in summary["Top"]] == [(2, 25000), (1, 30000)]
+
+
+def test_finish_of_older_bikes():
+    # without the start of the ride in the finish report
+    clock = Clock()
+    board = Leaderboard(clock=clock)
+    for bike_id, finisher in ((1, "gw1"), (2, "gw2")):
+        board.update("gw1", bike_id, 1000 + bike_id, "counting", "event-1", "Rider", "ACME",
+                     (100000, 2), (100500, 4))
+        board.update(finisher, bike_id, 1000 + bike_id, "finished", "event-1", "Rider", "ACME",
+                     (127500, 150), (128000, 152))
+    summary, = published(board, clock)
+    assert [(e["BikeID"], e["TimeMs"]) for e in summary["Top"]] == [(1, 28000)]
+    assert summary["Riding"] == 0
+    assert board.untimed == 1
+
+
+def test_aborted_and_unstarted_rides_are_not_ranked():
+    clock = Clock()
+    board = Leaderboard(clock=clock)
+    board.update("gw1", 1, 1001, "counting", "event-1", "Rider 1", "ACME",
+                 (100000, 0), (100000, 0))
+    board.update("gw1", 1, 1001, "aborted", "event-1", "Rider 1", "ACME",
+                 (105000, 40), (105000, 40))
+    # a finish without its ride
+    board.update("gw1", 2, 1002, "finished", "event-1", "Rider 2", "ACME",
+                 (105000, 40), (105000, 40))
+    summary, = published(board, clock)
+    assert summary["Finished"] == 0 and summary["Riding"] == 0
+    assert summary["Top"] == [] and summary["TimeMs"] == {"P50": None, "P90": None}
+    assert (board.aborted, board.finished) == (1, 0)
@@ -0,0 +1,76 @@
+from merge import RecordMerger
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_copies_from_other_gateways_are_dropped():
+    merger = RecordMerger(clock=Clock())
+    assert merger.accept("gw1", 7, 1234, "counting", 100)
+    assert not merger.accept("gw2", 7, 1234, "counting", 100)
+    assert not merger.accept("gw1", 7, 1234, "counting", 100)
+    # the next record of the ride, and the same record of another bike
+    assert merger.accept("gw2", 7, 1234, "counting", 104)
+    assert merger.accept("gw2", 8, 1234, "counting", 100)
+    stats = merger.stats()
+    assert (stats["Accepted"], stats["Duplicates"], stats["Rides"]) == (3, 2, 2)
+
+
+def test_status_only_moves_forward():
+    merger = RecordMerger(clock=Clock())
+    assert merger.accept("gw1", 7, 1234, "counting", 100)
+    assert merger.accept("gw1", 7, 1234, "finished", 300)
+    # a gateway replaying its backlog
+    assert not merger.accept("gw2", 7, 1234, "counting", 200)
+    assert not merger.accept("gw2", 7, 1234, "started", 0)
+    # a new ride of the same bike starts over
+    assert merger.accept("gw2", 7, 5678, "started", 0)
+    assert merger.regressions == 2
+
+
+def test_seen_keys_expire():
+    clock = Clock()
+    merger = RecordMerger(window_s=60, max_seen=3, clock=clock)
+    assert merger.accept("gw1", 7, 1234, "counting", 100)
+    clock.now = 59
+    assert not merger.accept("gw2", 7, 1234, "counting", 100)
+    clock.now = 60
+    # forgotten, only the ride's crank count stops it now
+    assert not merger.accept("gw2", 7, 1234, "counting", 100)
+    assert (merger.duplicates, merger.stale) == (1, 1)
+    # at most max_seen keys, the oldest go first
+    for crank in (101, 102, 103, 104):
+        merger.accept("gw1", 7, 1234, "counting", crank)
+    assert merger.stats()["Seen"] == 3
+
+
+def test_best_gateway():
+    merger = RecordMerger(clock=Clock())
+    assert merger.best_gateway(7) is None
+    for crank in range(10):
+        merger.accept("gw1", 7, 1234, "counting", crank)
+        if crank % 3 == 0:
+            merger.accept("gw2", 7, 1234, "counting", crank)
+    assert merger.best_gateway(7) == "gw1"
+    merger.forget_gateway("gw1")
+    assert merger.best_gateway(7) == "gw2"
+
+
+def test_late_backlog_replay_is_dropped():
+    merger = RecordMerger(clock=Clock())
+    for crank in (100, 104, 108):
+        assert merger.accept("gw1", 7, 1234, "counting", crank)
+    # gw2 reconnects and replays what it heard while it was cut off
+    for crank in (102, 106):
+        assert not merger.accept("gw2", 7, 1234, "counting", crank)
+    assert merger.accept("gw2", 7, 1234, "counting", 110)
+    assert merger.stale == 2
+    # the 16 bit CrankCounter wraps around
+    assert merger.accept("gw1", 7, 5678, "counting", 0xFFFE)
+    assert merger.accept("gw1", 7, 5678, "counting", 3)
+    assert not merger.accept("gw2", 7, 5678, "counting", 0xFFFF)
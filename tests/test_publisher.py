@@ -0,0 +1,20 @@
+from publisher import percentile, rank_index
+
+
+def test_percentile_nearest_rank():
+    samples = list(range(1, 9))
+    assert percentile(samples, 50) == 4
+    assert percentile(samples, 100) == 8
+    assert percentile(samples, 0) == 1
+    assert percentile(list(range(1, 101)), 99) == 99
+    assert percentile(list(range(1, 21)), 95) == 19
+
+
+def test_percentile_unsorted_and_empty():
+    assert percentile([3, 1, 2], 50) == 2
+    assert percentile([], 50) is None
+
+
+def test_rank_index_single():
+    assert rank_index(1, 50) == 0
+    assert rank_index(1, 99) == 0
@@ -0,0 +1,95 @@
+import os
+
+from ringbuf import RecordRing, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST
+
+
+def records(n):
+    return [b'{"r": %d}\n' % i for i in range(n)]
+
+
+def drain(ring, batch_size=32):
+    # the way the gateway replays its backlog, a batch at a time
+    out = bytearray(batch_size)
+    drained = []
+    while len(ring):
+        nbytes, nrecords = ring.batch(out)
+        assert nrecords
+        drained.append(bytes(out[:nbytes]))
+        ring.drop(nrecords)
+    return b''.join(drained)
+
+
+def test_records_wrap_around_the_end():
+    ring = RecordRing(40)
+    out = bytearray(16)
+    queued = []
+    for record in records(20):
+        assert ring.put(record)
+        queued.append(record)
+        if len(queued) == 3:
+            # keep the ring about full, the records move around it and
+            # some are split over its end
+            nbytes, nrecords = ring.batch(out, 1)
+            assert bytes(out[:nbytes]) == queued.pop(0)
+            ring.drop(nrecords)
+    assert drain(ring) == b''.join(queued)
+
+
+def test_overflow_policies():
+    oldest = RecordRing(40, OVERFLOW_DROP_OLDEST)
+    newest = RecordRing(40, OVERFLOW_DROP_NEWEST)
+    for record in records(6):
+        oldest.put(record)
+        newest.put(record)
+    assert drain(oldest) == b''.join(records(6)[-3:])
+    assert drain(newest) == b''.join(records(3))
+    assert oldest.dropped == newest.dropped == 3
+
+
+def test_spill_keeps_the_order(tmp_path):
+    path = str(tmp_path / 'spill.log')
+    ring = RecordRing(40, spill_path=path)
+    for record in records(5):
+        ring.put(record)
+    assert ring.spilled == 2 and len(ring) == 5
+    # part of the log goes out, then more records push others into it
+    out = bytearray(32)
+    nbytes, nrecords = ring.batch(out, 1)
+    assert bytes(out[:nbytes]) == records(1)[0]
+    ring.drop(nrecords)
+    for record in records(9)[5:]:
+        ring.put(record)
+    assert drain(ring, 16) == b''.join(records(9)[1:])
+    assert not os.path.exists(path)
+    assert ring.dropped == 0
+
+
+def test_spill_log_survives_a_restart(tmp_path):
+    path = str(tmp_path / 'spill.log')
+    ring = RecordRing(40, spill_path=path)
+    for record in records(5):
+        ring.put(record)
+    assert ring.spilled == 2
+    # the gateway reboots, what was in RAM is gone, the log is replayed first
+    ring = RecordRing(40, spill_path=path)
+    assert len(ring) == ring.spilled == 2
+    for record in records(9)[5:]:
+        ring.put(record)
+    assert len(ring) == 6
+    assert drain(ring, 16) == b''.join(records(2) + records(9)[5:])
+    assert not os.path.exists(path)
+
+
+def test_spill_log_cut_short_by_a_restart(tmp_path):
+    path = str(tmp_path / 'spill.log')
+    ring = RecordRing(40, spill_path=path)
+    for record in records(5):
+        ring.put(record)
+    with open(path, 'ab') as f:
+        f.write(b'\x00\x09{"r"')     # the power went during a write
+    ring = RecordRing(40, spill_path=path)
+    assert len(ring) == 2
+    assert os.path.getsize(path) == 2 * (2 + len(records(1)[0]))
+    for record in records(9)[5:]:
+        ring.put(record)
+    assert drain(ring, 16) == b''.join(records(2) + records(9)[5:])
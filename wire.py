@@ -0,0 +1,174 @@
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+import json
+from record import timestamp_text
+
+try:
+    from micropython import const
+except ImportError:
+    def const(x):
+        return x
+
+# Binary records from the gateways to the server, an alternative to the JSON
+# lines of record.py. Every record is length prefixed, all fields big endian:
+#
+#   byte 0     : record type, REC_*, always >= 0x80 so that records can be
+#                told apart from JSON lines (see framing.LineFramer)
+#   bytes 1-2  : length of the rest of the record
+#
+# REC_RIDE, sent once per ride and connection before its first REC_INFO:
+#
+#   byte 0     : ride id, chosen by the gateway
+#   bytes 1-2  : bike id
+#   5 fields   : rider name, company, badge number and event id as JSON
+#                values, RideTimestamp as text, each a length byte and the
+#                UTF-8 bytes
+#
+# REC_INFO, a ride record:
+#
+#   byte 0     : ride id
+#   byte 1     : RideStatus, index in STATUSES
+#   byte 2     : number of RideInfo entries that follow, n
+#   10 * n     : CounterTimestamp in ms (4 bytes), CrankCounter (2 bytes),
+#                WheelCounter (4 bytes)
+#
+# REC_INFO_TRACED is a REC_INFO followed by the latency trace of latency.py:
+# the Bike and Air ms (2 bytes each), the Rx and Tx ticks (4 bytes each).
+#
+# The gateway asks for binary records by sending HELLO as its first line,
+# and switches once the server has answered with the same line. Servers
+# that don't know about it count the line as a bad record, and gateways
+# that never ask keep sending JSON lines.
+
+PROTOCOL_VERSION = const(2)
+HELLO = b'{"Protocol": "binary", "Version": 2}\n'
+
+REC_RIDE = const(0x81)
+REC_INFO = const(0x82)
+REC_INFO_TRACED = const(0x83)
+
+HEADER_SIZE = const(3)
+_HEADER_FMT = '>BH'
+_RIDE_FMT = '>BH'
+_RIDE_SIZE = const(3)
+_INFO_FMT = '>BBB'
+_INFO_SIZE = const(3)
+_ENTRY_FMT = '>IHI'
+ENTRY_SIZE = const(10)
+_TRACE_FMT = '>HHII'
+_TRACE_SIZE = const(12)
+
+WIRE_BUFFER_SIZE = const(512)
+
+STATUSES = ('started', 'counting', 'finished', 'aborted')
+STATUS_INDEX = {'started': 0, 'counting': 1, 'finished': 2, 'aborted': 3}
+
+
+def ride_fields(name, company, badge, event_id, ride_timestamp):
+    """The fields of a REC_RIDE, as bytes. Raises ValueError if one doesn't
+    fit, the ride is then sent as JSON."""
+    fields = (json.dumps(name).encode(), json.dumps(company).encode(),
+              json.dumps(badge).encode(), json.dumps(event_id).encode(),
+              timestamp_text(ride_timestamp).encode())
+    for field in fields:
+        if len(field) > 255:
+            raise ValueError('field too long')
+    return fields
+
+
+class FrameWriter:
+    """Builds binary records into a buffer reused for every record."""
+
+    def __init__(self, size=WIRE_BUFFER_SIZE):
+        self.buf = bytearray(size)
+        self._mv = memoryview(self.buf)
+        self.n = 0
+        self._start = 0     # of the REC_INFO being built
+        self._count = 0
+
+    def reset(self):
+        self.n = 0
+
+    def ride(self, ride_id, bike_id, fields):
+        start = self.n
+        length = _RIDE_SIZE
+        for field in fields:
+            length += 1 + len(field)
+        self._reserve(HEADER_SIZE + length)
+        struct.pack_into(_HEADER_FMT, self.buf, start, REC_RIDE, length)
+        struct.pack_into(_RIDE_FMT, self.buf, start + HEADER_SIZE, ride_id, bike_id)
+        n = start + HEADER_SIZE + _RIDE_SIZE
+        for field in fields:
+            self.buf[n] = len(field)
+            self.buf[n + 1:n + 1 + len(field)] = field
+            n += 1 + len(field)
+        self.n = n
+
+    def begin(self, ride_id, status):
+        """Start a REC_INFO, status is the index of the RideStatus."""
+        self._start = self.n
+        self._count = 0
+        self._reserve(HEADER_SIZE + _INFO_SIZE)
+        struct.pack_into(_INFO_FMT, self.buf, self.n + HEADER_SIZE, ride_id, status, 0)
+        self.n += HEADER_SIZE + _INFO_SIZE
+
+    def add_info(self, timestamp_ms, crank, wheel):
+        self._reserve(ENTRY_SIZE)
+        struct.pack_into(_ENTRY_FMT, self.buf, self.n, timestamp_ms, crank, wheel)
+        self.n += ENTRY_SIZE
+        self._count += 1
+
+    def end(self, trace=None):
+        """Finish the REC_INFO, returns everything written since reset() as
+        a view valid until the next reset(). trace is (bike ms, air ms, rx
+        ticks, tx ticks), if set."""
+        kind = REC_INFO
+        if trace is not None:
+            kind = REC_INFO_TRACED
+            self._reserve(_TRACE_SIZE)
+            struct.pack_into(_TRACE_FMT, self.buf, self.n, trace[0], trace[1], trace[2], trace[3])
+            self.n += _TRACE_SIZE
+        start = self._start
+        struct.pack_into(_HEADER_FMT, self.buf, start, kind, self.n - start - HEADER_SIZE)
+        self.buf[start + HEADER_SIZE + 2] = self._count
+        return self._mv[:self.n]
+
+    def _reserve(self, length):
+        if self.n + length > len(self.buf):
+            self.buf = self.buf[:self.n] + bytearray(max(len(self.buf), length))
+            self._mv = memoryview(self.buf)
+
+
+def decode_ride(data):
+    """Returns (ride id, bike id, fields as str) of a REC_RIDE."""
+    ride_id, bike_id = struct.unpack_from(_RIDE_FMT, data, HEADER_SIZE)
+    fields = []
+    n = HEADER_SIZE + _RIDE_SIZE
+    while n < len(data):
+        length = data[n]
+        fields.append(str(bytes(data[n + 1:n + 1 + length]), 'utf-8'))
+        n += 1 + length
+    if len(fields) != 5 or n != len(data):
+        raise ValueError('bad ride record')
+    return ride_id, bike_id, fields
+
+
+def decode_info(data):
+    """Returns (ride id, status index, entry count, trace or None) of a
+    REC_INFO or REC_INFO_TRACED, the entries are read with entry()."""
+    ride_id, status, count = struct.unpack_from(_INFO_FMT, data, HEADER_SIZE)
+    size = HEADER_SIZE + _INFO_SIZE + count * ENTRY_SIZE
+    trace = None
+    if data[0] == REC_INFO_TRACED:
+        trace = struct.unpack_from(_TRACE_FMT, data, size)
+        size += _TRACE_SIZE
+    if size != len(data) or status >= len(STATUSES):
+        raise ValueError('bad info record')
+    return ride_id, status, count, trace
+
+
+def entry(data, i):
+    """(CounterTimestamp, CrankCounter, WheelCounter) of entry i of a REC_INFO."""
+    return struct.unpack_from(_ENTRY_FMT, data, HEADER_SIZE + _INFO_SIZE + i * ENTRY_SIZE)